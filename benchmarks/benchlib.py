@@ -0,0 +1,16 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+
+
+def percentiles(samples, points=(0.5, 0.9, 0.99)):
+    """
+    Summarize latency samples in seconds as {"p50_ms": ..., "max_ms": ...} for each of `points` and the maximum
+    """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda p: round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 2)  # NOQA
+    result = {"p{:g}_ms".format(point * 100): pick(point) for point in points}
+    result["max_ms"] = pick(1.0)
+    return result
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Replay mixed subsonic client traffic against pysonicd and report per-endpoint latency and throughput.
+
+Boots pysonicd against a synthetic library from synthlib, waits for the scan to finish, then runs --concurrency client
+threads for --duration seconds. Each request picks an endpoint by the weights in --mix: browsing (getIndexes,
+getMusicDirectory, getAlbumList paging, search2), cover art, direct and transcoded streams and savePlayQueue. Requests
+authenticate with token auth like current clients do. With --stub-ffmpeg a stand-in transcoder that copies its input is
+put on the server's PATH so the run needs no codecs. Everything runs locally; results are printed as JSON.
+"""
+import os
+import sys
+import json
+import stat
+import random
+import argparse
+import tempfile
+import subprocess
+from hashlib import md5
+from threading import Thread, Lock
+from collections import defaultdict
+from time import time, sleep
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthlib import make_library  # NOQA
+from benchlib import percentiles  # NOQA
+from pysonic.streaming import raise_fd_limit  # NOQA
+
+
+USERNAME = "bench"
+PASSWORD = "bench"
+DEFAULT_MIX = "getIndexes=5,getMusicDirectory=25,getAlbumList=20,search2=10,getCoverArt=20,stream=5," \
+              "stream_transcode=5,savePlayQueue=10"
+ALBUM_LIST_TYPES = ["newest", "alphabeticalByName", "random", "frequent", "recent"]
+PAGE_SIZE = 20
+
+STUB_FFMPEG = """#!/bin/sh
+# Stand-in for ffmpeg used by benchmarks: copies the -i input to the output, the last argument, or stdout for -
+input=
+for arg; do
+    if [ "$last" = "-i" ]; then
+        input="$arg"
+    fi
+    last="$arg"
+done
+if [ -z "$input" ]; then
+    exit 1
+fi
+if [ "$last" = "-" ]; then
+    exec cat "$input"
+fi
+exec cp "$input" "$last"
+"""
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        name, weight = item.split("=")
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - set(ENDPOINTS)
+    if unknown:
+        raise argparse.ArgumentTypeError("unknown endpoints: {}".format(", ".join(sorted(unknown))))
+    return mix
+
+
+class Client(object):
+    def __init__(self, base, timeout):
+        self.base = base
+        self.timeout = timeout
+
+    def url(self, view, params):
+        salt = os.urandom(6).hex()
+        query = dict(u=USERNAME, t=md5((PASSWORD + salt).encode()).hexdigest(), s=salt, v="1.15.0", c="bench",
+                     f="json")
+        return "{}/rest/{}.view?{}".format(self.base, view, urlencode(list(query.items()) + list(params), doseq=True))
+
+    def get(self, view, params=()):
+        """
+        Request a view and return the response body. Raises OSError on http errors and on failed subsonic responses.
+        """
+        with urlopen(self.url(view, params), timeout=self.timeout) as response:
+            body = response.read()
+            if response.headers.get_content_type() == "application/json" and b'"status": "failed"' in body:
+                raise OSError("{} failed: {}".format(view, body[:200]))
+            return body
+
+    def api(self, view, params=()):
+        return json.loads(self.get(view, params).decode())["subsonic-response"]
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if type(value) is list else [value]
+
+
+class Catalog(object):
+    """
+    Ids discovered by browsing the server the way a client would, used to build requests
+    """
+    def __init__(self, client):
+        self.artist_dirs = []
+        self.album_dirs = []
+        self.album_count = 0
+        self.covers = set()
+        self.mp3_songs = []
+        self.other_songs = []
+        self.words = set()
+
+        for index in as_list(client.api("getIndexes")["indexes"].get("index")):
+            for artist in as_list(index.get("artist")):
+                self.artist_dirs.append(artist["id"])
+                self.words.update(artist["name"].split())
+        for artist_dir in self.artist_dirs:
+            for album in as_list(client.api("getMusicDirectory", [("id", artist_dir)])["directory"].get("child")):
+                self.album_dirs.append(album["id"])
+                self.words.update(album["name"].split())
+                if "coverArt" in album:
+                    self.covers.add(album["coverArt"])
+        for album_dir in self.album_dirs:
+            for song in as_list(client.api("getMusicDirectory", [("id", album_dir)])["directory"].get("child")):
+                if song.get("contentType") == "audio/mpeg":
+                    self.mp3_songs.append(song["id"])
+                else:
+                    self.other_songs.append(song["id"])
+        self.album_count = len(self.album_dirs)
+        self.covers = sorted(self.covers)
+        self.words = sorted(self.words)
+
+    @property
+    def songs(self):
+        return self.mp3_songs + self.other_songs
+
+
+# endpoint name -> (view, function returning request params for a catalog)
+ENDPOINTS = {
+    "getIndexes": ("getIndexes", lambda c: []),
+    "getMusicDirectory": ("getMusicDirectory", lambda c: [("id", random.choice(c.artist_dirs + c.album_dirs))]),
+    "getAlbumList": ("getAlbumList", lambda c: [("type", random.choice(ALBUM_LIST_TYPES)),
+                                                ("size", PAGE_SIZE),
+                                                ("offset", PAGE_SIZE * random.randrange(max(1, c.album_count //
+                                                                                                PAGE_SIZE)))]),
+    "search2": ("search2", lambda c: [("query", random.choice(c.words).lower()), ("artistCount", 20),
+                                      ("albumCount", 20), ("songCount", 20)]),
+    "getCoverArt": ("getCoverArt", lambda c: [("id", random.choice(c.covers))]),
+    # 320 is above the synthetic mp3s' bitrate so they are sent as-is
+    "stream": ("stream", lambda c: [("id", random.choice(c.mp3_songs or c.songs)), ("maxBitRate", 320)]),
+    "stream_transcode": ("stream", lambda c: [("id", random.choice(c.other_songs or c.songs)), ("maxBitRate", 64)]),
+    "savePlayQueue": ("savePlayQueue", lambda c: [("id", i) for i in random.sample(c.songs, min(10, len(c.songs)))] +
+                                                 [("current", random.choice(c.songs)), ("position", 0)]),
+}
+
+
+class Results(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def add(self, name, seconds, nbytes):
+        with self.lock:
+            self.latency[name].append(seconds)
+            self.bytes[name] += nbytes
+
+    def error(self, name):
+        with self.lock:
+            self.errors[name] += 1
+
+    def report(self, elapsed):
+        endpoints = {}
+        for name in sorted(set(self.latency) | set(self.errors)):
+            samples = self.latency[name]
+            endpoints[name] = dict(percentiles(samples),
+                                   requests=len(samples) + self.errors[name],
+                                   errors=self.errors[name],
+                                   rps=round(len(samples) / elapsed, 2),
+                                   mbytes_per_s=round(self.bytes[name] / elapsed / 1024 / 1024, 3))
+        total = sum(len(samples) for samples in self.latency.values())
+        return {"elapsed_s": round(elapsed, 3),
+                "requests": total + sum(self.errors.values()),
+                "errors": sum(self.errors.values()),
+                "rps": round(total / elapsed, 2),
+                "latency": percentiles([s for samples in self.latency.values() for s in samples]),
+                "endpoints": endpoints}
+
+
+def worker(client, catalog, mix, deadline, results, seed):
+    rand = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while time() < deadline:
+        name = rand.choices(names, weights)[0]
+        view, make_params = ENDPOINTS[name]
+        start = time()
+        try:
+            body = client.get(view, make_params(catalog))
+        except OSError:
+            results.error(name)
+            continue
+        results.add(name, time() - start, len(body))
+
+
+def wait_ready(client, songs, timeout):
+    """
+    Wait for the server to come up and for the scanner to have read the metadata of every song
+    """
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            found = as_list(client.api("getRandomSongs", [("size", songs)]).get("randomSongs", {}).get("song"))
+            if len(found) >= songs and all("contentType" in song for song in found):
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        sleep(0.25)
+    raise SystemExit("server did not finish scanning within {}s".format(timeout))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=16, help="client threads")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run traffic for")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="endpoint weights as name=weight,... (default: {})".format(DEFAULT_MIX))
+    parser.add_argument("--scale", default="20x4x10", help="synthetic library size as ARTISTSxALBUMSxTRACKS")
+    parser.add_argument("--frames", type=int, default=400, help="mp3 frames per track, about 10s of audio")
+    parser.add_argument("--flac-ratio", type=float, default=0.25, help="fraction of albums generated as flac")
+    parser.add_argument("--stub-ffmpeg", action="store_true", help="transcode with a stand-in that copies the input")
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout")
+    parser.add_argument("--startup-timeout", type=float, default=300, help="time allowed for the initial scan")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--server-args", default="", help="extra arguments for pysonicd")
+    parser.add_argument("--server-log", help="write pysonicd's output to this file")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    artists, albums, tracks = [int(i) for i in args.scale.split("x")]
+    client = Client("http://127.0.0.1:{}".format(args.port), args.timeout)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        libdir = os.path.join(tmp, "library")
+        os.makedirs(libdir)
+        counts = make_library(libdir, artists=artists, albums=albums, tracks=tracks, flac_ratio=args.flac_ratio,
+                              frames=args.frames, seed=args.seed)
+
+        env = dict(os.environ)
+        if args.stub_ffmpeg:
+            bindir = os.path.join(tmp, "bin")
+            os.makedirs(bindir)
+            stub = os.path.join(bindir, "ffmpeg")
+            with open(stub, "w") as f:
+                f.write(STUB_FFMPEG)
+            os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+            env["PATH"] = bindir + os.pathsep + env.get("PATH", "")
+
+        log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+        server = subprocess.Popen([sys.executable, "-m", "pysonic.daemon", "-d", libdir, "-p", str(args.port),
+                                   "-s", os.path.join(tmp, "db.sqlite"),
+                                   "-u", "{}:{}".format(USERNAME, PASSWORD)] + args.server_args.split(),
+                                  env=env, stdout=log, stderr=subprocess.STDOUT,
+                                  cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        try:
+            start = time()
+            wait_ready(client, counts["songs"], args.startup_timeout)
+            ready_s = time() - start
+            catalog = Catalog(client)
+
+            results = Results()
+            start = time()
+            deadline = start + args.duration
+            threads = [Thread(target=worker, args=(client, catalog, args.mix, deadline, results, args.seed + i))
+                       for i in range(args.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            report = results.report(time() - start)
+        finally:
+            server.terminate()
+            server.wait()
+            if args.server_log:
+                log.close()
+
+    print(json.dumps(dict(library=counts,
+                          concurrency=args.concurrency,
+                          mix=args.mix,
+                          stub_ffmpeg=args.stub_ffmpeg,
+                          server_args=args.server_args,
+                          ready_s=round(ready_s, 3),
+                          **report), indent=4))
+
+
+if __name__ == '__main__':
+    main()
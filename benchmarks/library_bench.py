@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Time the scanner, database queries and response rendering against synthetic libraries.
+
+For each --scale (artists x albums x tracks) a library is generated with synthlib and scanned into a fresh database.
+The cold rescan, a warm rescan over the unchanged files, a full metadata rescan, each PysonicDatabase.get_* query,
+PysonicCatalog loading, memory and queries with each available column backend and ApiResponse XML/JSON rendering are
+timed. Results are printed as JSON so runs from different commits can be compared.
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+import platform
+import tempfile
+import subprocess
+from time import time, perf_counter
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthlib import make_library  # NOQA
+from pysonic import __version__  # NOQA
+from pysonic.database import PysonicDatabase  # NOQA
+from pysonic.library import PysonicLibrary  # NOQA
+from pysonic.apilib import ApiResponse  # NOQA
+from pysonic.api import PysonicSubsonicApi  # NOQA
+from pysonic.catalog import PysonicCatalog, ALBUM_LIST_TYPES, numpy  # NOQA
+
+
+def timed(func, repeat=1):
+    """
+    Call func `repeat` times and return timing stats in milliseconds
+    """
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        samples.append(perf_counter() - start)
+    return {"runs": repeat,
+            "min_ms": round(min(samples) * 1000, 3),
+            "median_ms": round(median(samples) * 1000, 3)}
+
+
+def parse_scale(value):
+    artists, albums, tracks = [int(i) for i in value.split("x")]
+    return dict(artists=artists, albums=albums, tracks=tracks)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_queries(db, repeat):
+    artist = db.get_artists()[0]
+    album = db.get_albums(limit=1)[0]
+    song_ids = [song["id"] for song in db.get_songs(limit=50)]
+    user_id = db.get_user("bench")["id"]
+    playlist_id = db.get_playlists(user_id)[0]["id"]
+    queries = {
+        "get_stats": lambda: db.get_stats(),
+        "get_libraries": lambda: db.get_libraries(),
+        "get_artists": lambda: db.get_artists(sortby="name", order="asc"),
+        "get_albums": lambda: db.get_albums(),
+        "get_albums_random_page": lambda: db.get_albums(sortby="random", limit=(0, 50)),
+        "get_albums_newest_page": lambda: db.get_albums(sortby="added", order="desc", limit=(0, 50)),
+        "get_songs": lambda: db.get_songs(),
+        "get_songs_random": lambda: db.get_songs(sortby="random", limit=50),
+        "get_songs_by_ids": lambda: db.get_songs(id=song_ids),
+        "get_song_file": lambda: db.get_song_file(song_ids[0]),
+        "get_genres": lambda: db.get_genres(),
+        "get_cover": lambda: db.get_cover(album["coverid"]),
+        "get_musicdir_artist": lambda: db.get_subsonic_musicdir(artist["dir"]),
+        "get_musicdir_album": lambda: db.get_subsonic_musicdir(album["dir"]),
+        "get_playlists": lambda: db.get_playlists(user_id),
+        "get_playlist_songs": lambda: db.get_playlist_songs(playlist_id),
+        "get_starred": lambda: db.get_starred(user_id),
+        "get_play_queue": lambda: db.get_play_queue(user_id),
+    }
+    return {name: timed(query, repeat) for name, query in queries.items()}
+
+
+def bench_catalog(db, repeat):
+    results = {}
+    for backend, use_numpy in [("array", False), ("numpy", True)][:2 if numpy is not None else 1]:
+        catalog = PysonicCatalog(db, use_numpy=use_numpy)
+        result = {"rebuild": timed(catalog.rebuild, repeat)}
+        songs = len(catalog.data.song_id)
+        genre = next(iter(catalog.data.genres), None)
+        result["bytes"] = catalog.nbytes()
+        result["bytes_per_100k_songs"] = int(catalog.nbytes() * 100000 / max(songs, 1))
+        for list_type in ALBUM_LIST_TYPES:
+            result["album_list_" + list_type] = timed(
+                lambda: catalog.album_list(list_type, 50, 50, from_year=2010, to_year=2000, genre=genre,
+                                           starred=catalog.data.album_id[:20]), repeat)
+        result["random_songs"] = timed(lambda: catalog.random_songs(50), repeat)
+        result["random_songs_filtered"] = timed(lambda: catalog.random_songs(50, genre=genre, from_year=2000,
+                                                                             to_year=2010), repeat)
+        results[backend] = result
+    return results
+
+
+def bench_render(db, repeat):
+    songs = db.get_songs()
+    albums = db.get_albums()
+
+    def song_list():
+        response = ApiResponse()
+        response.add_child("randomSongs")
+        for song in songs:
+            response.add_child("song", _parent="randomSongs", **PysonicSubsonicApi.render_song(song))
+        return response
+
+    def album_list():
+        response = ApiResponse()
+        response.add_child("albumList")
+        for album in albums:
+            response.add_child("album", _parent="albumList", **PysonicSubsonicApi.render_album(album, stars))
+        return response
+
+    stars = {"song": {}, "album": {}, "artist": {}}
+    songs_response = song_list()
+    albums_response = album_list()
+    return {"songs": len(songs),
+            "albums": len(albums),
+            "build_songs": timed(song_list, repeat),
+            "build_albums": timed(album_list, repeat),
+            "songs_xml": timed(songs_response.render_xml, repeat),
+            "songs_json": timed(songs_response.render_json, repeat),
+            "albums_xml": timed(albums_response.render_xml, repeat),
+            "albums_json": timed(albums_response.render_json, repeat)}
+
+
+def bench_scale(scale, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        libdir = os.path.join(tmp, "library")
+        os.makedirs(libdir)
+        start = time()
+        counts = make_library(libdir, flac_ratio=args.flac_ratio, seed=args.seed, **scale)
+        generate_s = time() - start
+
+        db = PysonicDatabase(os.path.join(tmp, "db.sqlite"))
+        library = PysonicLibrary(db)
+        library.add_root_dir(libdir)
+        root = db.get_libraries()[0]
+
+        result = dict(scale=scale, files=counts, generate_s=round(generate_s, 3))
+        result["rescan_cold"] = timed(library.scanner.rescan)
+        result["rescan_warm"] = timed(library.scanner.rescan, args.repeat)
+        result["scan_metadata_full"] = timed(lambda: library.scanner.scan_metadata(root["id"], root["path"]))
+
+        # Fixtures for the user related queries
+        db.add_user("bench", "bench")
+        user_id = db.get_user("bench")["id"]
+        song_ids = [song["id"] for song in db.get_songs(limit=200)]
+        db.add_playlist(user_id, "bench", song_ids)
+        db.set_starred(user_id, "song", song_ids[:50], int(time()))
+        db.apply_play_activity({}, {}, {user_id: (song_ids[:100], song_ids[0], 0, int(time()), "bench")})
+
+        result["queries"] = bench_queries(db, args.repeat)
+        result["catalog"] = bench_catalog(db, args.repeat)
+        result["render"] = bench_render(db, args.render_repeat)
+        db.db.close()
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", action="append", type=parse_scale,
+                        help="library size as ARTISTSxALBUMSxTRACKS, may be given more than once "
+                             "(default: 10x4x10 and 100x4x10)")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query timing")
+    parser.add_argument("--render-repeat", type=int, default=5, help="runs per rendering timing")
+    parser.add_argument("--flac-ratio", type=float, default=0.25, help="fraction of albums generated as flac")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show pysonic's log output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format="%(asctime)-15s %(levelname)-8s %(filename)s:%(lineno)d %(message)s")
+
+    results = {"pysonic_version": __version__,
+               "commit": git_commit(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "started": int(time()),
+               "scales": [bench_scale(scale, args)
+                          for scale in args.scale or [parse_scale("10x4x10"), parse_scale("100x4x10")]]}
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
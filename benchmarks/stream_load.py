@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Measure API latency while many clients hold open media streams.
+
+Boots pysonicd against a throwaway library holding one large mp3, opens --streams concurrent stream requests that read
+a little and then stall (like a player with a full buffer), and times ping requests before and while they are open.
+Results are printed as JSON. Run with --server-args=--no-stream-engine to compare against in-thread streaming.
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+import subprocess
+from time import time, sleep
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthlib import MP3_FRAME  # NOQA
+from benchlib import percentiles  # NOQA
+from pysonic.streaming import raise_fd_limit  # NOQA
+
+
+def make_library(root, size_mb):
+    album = os.path.join(root, "Artist", "Album")
+    os.makedirs(album)
+    frames = (size_mb * 1024 * 1024) // len(MP3_FRAME)
+    with open(os.path.join(album, "01 track.mp3"), "wb") as f:
+        f.write(MP3_FRAME * frames)
+
+
+def probe(base, count, timeout):
+    samples = []
+    failures = 0
+    for _ in range(count):
+        start = time()
+        try:
+            urlopen(base + "/rest/ping.view", timeout=timeout).read()
+            samples.append(time() - start)
+        except OSError:
+            failures += 1
+    return dict(percentiles(samples, points=(0.5, 0.95, 0.99)), requests=count, failures=failures)
+
+
+def open_stream(port, timeout):
+    """
+    Start a stream, read the first bytes of it and then stop reading. Returns the socket and whether data arrived.
+    """
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.settimeout(timeout)
+    sock.sendall(b"GET /rest/stream.view?id=1 HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    try:
+        return sock, bool(sock.recv(1024))
+    except socket.timeout:
+        return sock, False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--streams", type=int, default=500, help="concurrent streams to hold open")
+    parser.add_argument("--probes", type=int, default=100, help="ping requests per measurement")
+    parser.add_argument("--timeout", type=float, default=5, help="ping request timeout")
+    parser.add_argument("--size-mb", type=int, default=32, help="size of the streamed file")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--server-args", default="", help="extra arguments for pysonicd")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+
+    base = "http://127.0.0.1:{}".format(args.port)
+    with tempfile.TemporaryDirectory() as tmp:
+        libdir = os.path.join(tmp, "library")
+        make_library(libdir, args.size_mb)
+        server = subprocess.Popen([sys.executable, "-m", "pysonic.daemon", "-d", libdir, "-p", str(args.port),
+                                   "-s", os.path.join(tmp, "db.sqlite"), "--disable-auth", "--skip-transcode"] +
+                                  args.server_args.split())
+        streams = []
+        try:
+            # Wait for the server to come up and the scanner to find the track
+            for _ in range(100):
+                try:
+                    urlopen(base + "/rest/stream.view?id=1", timeout=1).read(1)
+                    break
+                except OSError:
+                    sleep(0.1)
+
+            idle = probe(base, args.probes, args.timeout)
+
+            start = time()
+            started = 0
+            for _ in range(args.streams):
+                sock, ok = open_stream(args.port, args.timeout)
+                streams.append(sock)
+                started += ok
+            opened = time() - start
+
+            loaded = probe(base, args.probes, args.timeout)
+        finally:
+            for sock in streams:
+                sock.close()
+            server.terminate()
+            server.wait()
+
+    print(json.dumps({"streams": args.streams,
+                      "server_args": args.server_args,
+                      "streams_started": started,
+                      "streams_opened_s": round(opened, 3),
+                      "idle": idle,
+                      "loaded": loaded}, indent=4))
+
+
+if __name__ == '__main__':
+    main()
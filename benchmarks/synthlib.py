@@ -0,0 +1,115 @@
+"""
+Generate synthetic music libraries for benchmarks.
+
+Libraries follow the layout the scanner expects, artist/album/track, and hold tiny but valid media files: MP3s of
+silent frames with ID3 tags and FLACs with a STREAMINFO block and Vorbis comments, plus a cover image per album. All
+files are written with mutagen so the scanner reads them the same way it reads a real library.
+"""
+import os
+import zlib
+import struct
+import random
+from mutagen.id3 import ID3, TIT2, TPE1, TALB, TRCK, TDRC, TCON
+from mutagen.flac import FLAC
+
+
+# MPEG-1 layer 3, 128kbps, 44.1khz frame of silence, about 26ms long
+MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x64]) + bytes(413)
+FLAC_SAMPLE_RATE = 44100
+GENRES = ["Rock", "Jazz", "Electronic", "Classical", "Hip Hop", "Folk", "Metal", "Ambient"]
+
+
+def png_image(width=8, height=8, color=(200, 40, 40)):
+    """
+    Return the bytes of a solid color RGB png
+    """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    row = b"\0" + bytes(color) * width
+    return b"\x89PNG\r\n\x1a\n" + \
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(row * height)) + \
+        chunk(b"IEND", b"")
+
+
+def flac_header(seconds):
+    """
+    Return a FLAC stream holding only a STREAMINFO block that describes `seconds` of 16 bit stereo audio
+    """
+    samples = seconds * FLAC_SAMPLE_RATE
+    info = struct.pack(">HH", 4096, 4096) + bytes(6) + \
+        ((FLAC_SAMPLE_RATE << 44) | (1 << 41) | (15 << 36) | samples).to_bytes(8, "big") + \
+        bytes(16)  # md5 of the decoded audio, unset
+    return b"fLaC" + bytes([0x80]) + len(info).to_bytes(3, "big") + info
+
+
+def write_mp3(path, tags, frames):
+    with open(path, "wb") as f:
+        f.write(MP3_FRAME * frames)
+    id3 = ID3()
+    id3.add(TIT2(encoding=3, text=tags["title"]))
+    id3.add(TPE1(encoding=3, text=tags["artist"]))
+    id3.add(TALB(encoding=3, text=tags["album"]))
+    id3.add(TRCK(encoding=3, text=str(tags["track"])))
+    id3.add(TDRC(encoding=3, text=str(tags["year"])))
+    id3.add(TCON(encoding=3, text=tags["genre"]))
+    id3.save(path)
+
+
+def write_flac(path, tags, seconds):
+    with open(path, "wb") as f:
+        f.write(flac_header(seconds))
+    audio = FLAC(path)
+    audio.add_tags()
+    audio["title"] = tags["title"]
+    audio["artist"] = tags["artist"]
+    audio["album"] = tags["album"]
+    audio["tracknumber"] = str(tags["track"])
+    audio["date"] = str(tags["year"])
+    audio["genre"] = tags["genre"]
+    audio.save()
+
+
+def make_library(root, artists=10, albums=4, tracks=10, flac_ratio=0.25, frames=8, covers=True, seed=0):
+    """
+    Write a synthetic library under `root`
+    :param artists: number of artist dirs
+    :param albums: albums per artist
+    :param tracks: tracks per album
+    :param flac_ratio: fraction of albums made of FLAC rather than MP3 files
+    :param frames: mp3 frames per track, which sets file size and duration
+    :param covers: write a cover image into each album dir
+    :param seed: random seed; the same arguments and seed produce the same library
+    :return: dict counting what was written
+    """
+    rand = random.Random(seed)
+    cover = png_image()
+    counts = dict(artists=0, albums=0, songs=0, covers=0, bytes=0)
+    for artist_num in range(artists):
+        artist = "Artist {:05d}".format(artist_num)
+        counts["artists"] += 1
+        for album_num in range(albums):
+            album = "Album {:03d}".format(album_num)
+            album_dir = os.path.join(root, artist, album)
+            os.makedirs(album_dir)
+            counts["albums"] += 1
+            is_flac = rand.random() < flac_ratio
+            year = rand.randint(1960, 2020)
+            genre = rand.choice(GENRES)
+            for track in range(1, tracks + 1):
+                tags = dict(title="Track {} of {}".format(track, album), artist=artist, album=album, track=track,
+                            year=year, genre=genre)
+                if is_flac:
+                    path = os.path.join(album_dir, "{:02d} track.flac".format(track))
+                    write_flac(path, tags, seconds=rand.randint(60, 600))
+                else:
+                    path = os.path.join(album_dir, "{:02d} track.mp3".format(track))
+                    write_mp3(path, tags, frames)
+                counts["songs"] += 1
+                counts["bytes"] += os.path.getsize(path)
+            if covers:
+                with open(os.path.join(album_dir, "cover.png"), "wb") as f:
+                    f.write(cover)
+                counts["covers"] += 1
+    return counts
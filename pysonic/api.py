@@ -1,20 +1,75 @@
+import os
+import json
+import math
 import logging
-import subprocess
 from time import time
+from urllib.parse import urlencode, quote
+from datetime import datetime
 from threading import Thread
 from pysonic.library import LETTER_GROUPS
-from pysonic.types import MUSIC_TYPES
+from pysonic.dirtree import DIR_ARTIST, DIR_ALBUM
+from pysonic.database import NotFoundError
+from pysonic.catalog import ALBUM_LIST_TYPES, MAX_YEAR
 from pysonic.apilib import formatresponse, ApiResponse
+from pysonic.streaming import send_stream, parse_range, FileSource
+from pysonic.zipstream import ZipEntry, ZipSource
+from pysonic.transcode import PROFILES, RAW_FORMAT, pick_transcode
 import cherrypy
 
 logging = logging.getLogger("api")
 
+HLS_AUTH_PARAMS = ["u", "p", "t", "s", "v", "c"]  # copied into playlist urls, players fetch them without our client
+
+
+def format_time(timestamp):
+    """
+    Format a unix timestamp the way subsonic does, e.g. 2017-08-07T20:16:24.596Z
+    """
+    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.000Z") if timestamp else None
+
+
+def int_list(value):
+    """
+    Return a query parameter that may be passed any number of times, including none, as a list of ints
+    """
+    return [int(i) for i in (value if type(value) is list else [value] if value else [])]
+
+
+class PysonicStatus(object):
+    def __init__(self, library):
+        """
+        Unauthenticated health checks for supervisors and load balancers. /health answers as long as the server is
+        up; /ready answers 503 until the library's directory tree is loaded and every endpoint can be served.
+        """
+        self.library = library
+        self.started = time()
+
+    @cherrypy.expose
+    def health(self, **kwargs):
+        return self.render(True)
+
+    @cherrypy.expose
+    def ready(self, **kwargs):
+        return self.render(self.library.dirtree.ready)
+
+    def render(self, ok):
+        cherrypy.response.status = 200 if ok else 503
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(dict(ready=self.library.dirtree.ready,
+                               uptime=round(time() - self.started, 3),
+                               scan=self.library.scanner.status())).encode()
+
 
 class PysonicSubsonicApi(object):
-    def __init__(self, db, library, options):
+    def __init__(self, db, library, options, auth, writer, transcodes, broker, prefetcher=None):
         self.db = db
         self.library = library
         self.options = options
+        self.auth = auth
+        self.writer = writer
+        self.transcodes = transcodes
+        self.broker = broker
+        self.prefetcher = prefetcher
 
     @cherrypy.expose
     @formatresponse
@@ -59,50 +114,85 @@ class PysonicSubsonicApi(object):
         # TODO deal with ignoredArticles
         response.add_child("indexes", lastModified="1502310831000", ignoredArticles="The El La Los Las Le Les")
         artists = self.library.get_artists(sortby="name", order="asc")
+        stars = self.library.get_stars(cherrypy.request.login)
         for letter in LETTER_GROUPS:
             index = response.add_child("index", _parent="indexes", name=letter.upper())
             for artist in artists:
                 if artist["name"][0].lower() in letter:
-                    response.add_child("artist", _real_parent=index, id=artist["dir"], name=artist["name"])
+                    response.add_child("artist", _real_parent=index, id=artist["dir"], name=artist["name"],
+                                       starred=format_time(stars["artist"].get(artist["id"])))
         return response
 
     @cherrypy.expose
     @formatresponse
-    def getAlbumList_view(self, type, size=250, offset=0, **kwargs):
-        qargs = {}
+    def getAlbumList_view(self, type, size=250, offset=0, fromYear=None, toYear=None, genre=None, **kwargs):
+        if type not in ALBUM_LIST_TYPES:
+            raise cherrypy.HTTPError(400, "Unknown album list type")
+        size, offset = int(size), int(offset)
+        stars = self.library.get_stars(cherrypy.request.login)
+        catalog, tree = self.library.catalog, self.library.dirtree
+        if catalog and catalog.ready and tree.ready:
+            albums = [tree.album_row(album_id)
+                      for album_id in catalog.album_list(type, size, offset, from_year=fromYear, to_year=toYear,
+                                                         genre=genre, starred=stars["album"])
+                      if album_id in tree.albums]
+        else:
+            albums = self.query_album_list(type, size, offset, fromYear, toYear, genre, stars)
+
+        response = ApiResponse()
+
+        response.add_child("albumList")
+
+        for album in albums:
+            response.add_child("album", _parent="albumList", **self.render_album(album, stars))
+        return response
+
+    def query_album_list(self, type, size, offset, fromYear, toYear, genre, stars):
+        """
+        getAlbumList from the database, for when the catalog is disabled or loading
+        """
+        qargs = dict(limit=(offset, size))
         if type == "random":
             qargs.update(sortby="random")
         elif type == "alphabeticalByName":
             qargs.update(sortby="name", order="asc")
+        elif type == "alphabeticalByArtist":
+            qargs.update(sortby="artistname, alb.name")
         elif type == "newest":
             qargs.update(sortby="added", order="desc")
         elif type == "recent":
             qargs.update(sortby="played", order="desc")
         elif type == "frequent":
             qargs.update(sortby="plays", order="desc")
-
-        qargs.update(limit=(offset, size))
-
-        albums = self.library.get_albums(**qargs)
-
-        response = ApiResponse()
-
-        response.add_child("albumList")
-
-        for album in albums:
-            album_kw = dict(id=album["dir"],
-                            parent=album["artistdir"],
-                            isDir="true",
-                            title=album["name"],
-                            album=album["name"],
-                            artist=album["artistname"],
-                            coverArt=album["coverid"]
-                            #year=TODO
-                            # playCount="0"
-                            # created="2016-05-08T05:31:31.000Z"/>)
-                            )
-            response.add_child("album", _parent="albumList", **album_kw)
-        return response
+        elif type == "starred":
+            if not stars["album"]:
+                return []
+            qargs.update(id=list(stars["album"]), sortby="name", order="asc")
+        elif type == "byYear":
+            first, last = int(fromYear or 0), int(toYear or MAX_YEAR)
+            qargs.update(years=(min(first, last), max(first, last)), sortby="year",
+                         order="desc" if first > last else "asc")
+        elif type == "byGenre":
+            qargs.update(genre=genre, sortby="name", order="asc")
+        return self.library.get_albums(**qargs)
+
+    @staticmethod
+    def render_album(album, stars):
+        """
+        Subsonic directory attributes for an album row from PysonicDatabase.get_albums()
+        """
+        return dict(id=album["dir"],
+                    parent=album["artistdir"],
+                    isDir="true",
+                    title=album["name"],
+                    album=album["name"],
+                    artist=album["artistname"],
+                    coverArt=album["coverid"],
+                    starred=format_time(stars["album"].get(album["id"]))
+                    #year=TODO
+                    # playCount="0"
+                    # created="2016-05-08T05:31:31.000Z"/>)
+                    )
 
     @cherrypy.expose
     @formatresponse
@@ -111,124 +201,218 @@ class PysonicSubsonicApi(object):
         List an artist dir
         """
         dir_id = int(id)
-        dirtype, dirinfo, entity = self.library.db.get_subsonic_musicdir(dirid=dir_id)
+        tree = self.library.dirtree
+        if not tree.ready:
+            raise cherrypy.HTTPError(503, "Library is loading")
+        try:
+            dirtype, parent, entity_id = tree.get_dir(dir_id)
+        except NotFoundError:
+            raise cherrypy.HTTPError(404, "Directory not found")
+        stars = self.library.get_stars(cherrypy.request.login)
 
         response = ApiResponse()
-        response.add_child("directory")
-        response.set_attrs(_path="directory", name=entity['name'], id=entity['id'],
-                           parent=dirinfo['parent'], playCount=420)
-
-        for childtype, child in entity["children"]:
-            # omit not dirs and media in browser
-            # if not item["isdir"] and item["type"] not in MUSIC_TYPES:
-            #     continue
-            # item_meta = item['metadata']
-            moreargs = {}
-            if childtype == "album":
-                moreargs.update(name=child["name"],
-                                isDir="true",  # TODO song files in artist dir
-                                parent=entity["id"],
-                                id=child["dir"])
-                if child["coverid"]:
-                    moreargs.update(coverArt=child["coverid"])
-                # album=item["name"],
-                #                title=item["name"],  # TODO dupe?
-                #                artist=artist["name"],
-                #                coverArt=item["coverid"],
-            elif childtype == "song":
-                moreargs.update(name=child["title"],
-                                artist=child["_artist"]["name"],
-                                contentType=child["format"],
-                                id=child["id"],
-                                duration=child["length"],
-                                isDir="false",
-                                parent=entity["dir"],
-                                # title=xxx
-                                )
-                if entity["coverid"]:
-                    moreargs.update(coverArt=entity["coverid"])
-                # duration="230" size="8409237" suffix="mp3" track="2"  year="2005"/>
-            response.add_child("child", _parent="directory",
-                               size="4096",
-                               type="music",
-                               **moreargs)
+        directory = response.add_child("directory", id=dir_id, parent=parent, playCount=420)
+
+        if dirtype == DIR_ARTIST:
+            response.set_attrs(_path="directory", name=tree.artists[entity_id][0])
+            for album_id in tree.artist_albums.get(entity_id, ()):
+                name, album_dir, _, cover_id = tree.albums[album_id]
+                size, duration = tree.album_totals(album_id)
+                response.add_child("child", _real_parent=directory,
+                                   id=album_dir,
+                                   parent=dir_id,
+                                   isDir="true",  # TODO song files in artist dir
+                                   name=name,
+                                   title=name,
+                                   coverArt=cover_id,
+                                   size=size,
+                                   duration=duration,
+                                   starred=format_time(stars["album"].get(album_id)),
+                                   type="music")
+        elif dirtype == DIR_ALBUM:
+            album_name, _, artist_id, cover_id = tree.albums[entity_id]
+            artist_name = tree.artists[artist_id][0]
+            response.set_attrs(_path="directory", name=album_name)
+            for song_id in tree.album_songs.get(entity_id, ()):
+                song = tree.songs[song_id]
+                response.add_child("child", _real_parent=directory,
+                                   id=song_id,
+                                   parent=dir_id,
+                                   isDir="false",
+                                   name=song["title"],
+                                   title=song["title"],
+                                   album=album_name,
+                                   artist=artist_name,
+                                   track=song["track"],
+                                   year=song["year"],
+                                   coverArt=cover_id,
+                                   size=song["size"],
+                                   contentType=song["format"],
+                                   suffix=song["file"].split(".")[-1],
+                                   duration=song["length"],
+                                   bitRate=int(song["bitrate"] / 1024) if song["bitrate"] else None,
+                                   albumId=entity_id,
+                                   artistId=artist_id,
+                                   starred=format_time(stars["song"].get(song_id)),
+                                   type="music")
 
         cherrypy.response.headers['Content-Type'] = 'text/xml; charset=utf-8'
         return response
 
     @cherrypy.expose
-    def stream_view(self, id, maxBitRate="256", **kwargs):
-        maxBitRate = int(maxBitRate)
+    def stream_view(self, id, maxBitRate="256", format=None, **kwargs):
+        maxBitRate = int(maxBitRate) or self.options.max_bitrate  # 0 means no limit
         assert maxBitRate >= 32 and maxBitRate <= 320
-        song = self.library.get_song(int(id))
+        song_id = int(id)
+        song = self.library.get_song(song_id)
         fpath = song["_fullpath"]
-        media_bitrate = song.get("bitrate") / 1024 if song.get("bitrate") else 320
-        to_bitrate = min(maxBitRate,
-                         self.options.max_bitrate,
-                         media_bitrate)
-        cherrypy.response.headers['Content-Type'] = 'audio/mpeg'
+        profile = self.pick_profile(format)
+        to_bitrate, profile = pick_transcode(song, maxBitRate, self.options, profile)
+        if self.prefetcher:
+            self.prefetcher.played(cherrypy.request.login, song_id, maxBitRate, profile)
+        cherrypy.response.headers['Content-Type'] = profile.mimetype if profile else song["format"] or 'audio/mpeg'
         #if "media_length" in meta:
         #    cherrypy.response.headers['X-Content-Duration'] = str(int(meta['media_length']))
         cherrypy.response.headers['X-Content-Kbitrate'] = str(to_bitrate)
-        if (self.options.skip_transcode or (song.get("bitrate") and media_bitrate == to_bitrate)) \
-           and song["format"] == "audio/mpeg":
-            def content():
-                with open(fpath, "rb") as f:
-                    while True:
-                        data = f.read(16 * 1024)
-                        if not data:
-                            break
-                        yield data
-            return content()
+        if not profile:
+            return send_stream(FileSource(fpath))
         else:
-            # transcode_meta = "transcoded_{}_size".format(to_bitrate)
-            # if transcode_meta in meta:
-            #     cherrypy.response.headers['Content-Length'] = str(int(meta[transcode_meta]))
-            transcode_args = ["ffmpeg", "-i", fpath, "-map", "0:0", "-b:a",
-                              "{}k".format(to_bitrate),
-                              "-v", "0", "-f", "mp3", "-"]
-            logging.info(' '.join(transcode_args))
-            proc = subprocess.Popen(transcode_args, stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-            def content(proc):
-                length = 0
-                # completed = False
-                start = time()
-                try:
-                    while True:
-                        data = proc.stdout.read(16 * 1024)
-                        if not data:
-                            # completed = True
-                            break
-                        yield data
-                        length += len(data)
-                finally:
-                    proc.poll()
-                    if proc.returncode is None or proc.returncode == 0:
-                        logging.warning("transcoded {} in {}s".format(id, int(time() - start)))
-                        # if completed:
-                        #     self.library.report_transcode(id, to_bitrate, length)
-                    else:
-                        logging.error("transcode of {} exited with code {} after {}s".format(id, proc.returncode,
-                                                                                             int(time() - start)))
-
-            def stopit(proc):
-                try:
-                    proc.wait(timeout=90)
-                except subprocess.TimeoutExpired:
-                    logging.warning("killing timed-out transcoder")
-                    proc.kill()
-                    proc.wait()
+            prefetched = self.transcodes.get(song_id, to_bitrate, profile.name)
+            if prefetched:
+                return send_stream(FileSource(prefetched))
+            return send_stream(self.broker.stream(song_id, fpath, to_bitrate, profile))
+    stream_view._cp_config = {'response.stream': True}
 
-            Thread(target=stopit, args=(proc, )).start()
+    @cherrypy.expose
+    def download_view(self, id=None, albumId=None, artistId=None, playlistId=None, **kwargs):
+        """
+        Send a song's original file, honoring Range requests, or an album, artist or playlist as an uncompressed zip
+        """
+        if id:
+            song = self.library.get_song(int(id))
+            try:
+                byte_range = parse_range(cherrypy.request.headers.get("Range"), song["size"])
+            except ValueError:
+                cherrypy.response.headers['Content-Range'] = "bytes */{}".format(song["size"])
+                raise cherrypy.HTTPError(416)
+            cherrypy.response.headers['Content-Type'] = song["format"] or "application/octet-stream"
+            cherrypy.response.headers['Accept-Ranges'] = "bytes"
+            cherrypy.response.headers['Content-Disposition'] = self.attachment(os.path.basename(song["_fullpath"]))
+            if byte_range:
+                cherrypy.response.headers['Content-Range'] = "bytes {}-{}/{}".format(byte_range[0], byte_range[1] - 1,
+                                                                                     song["size"])
+                return send_stream(FileSource(song["_fullpath"], *byte_range), status="206 Partial Content")
+            return send_stream(FileSource(song["_fullpath"]))
+
+        if albumId:
+            items = self.library.get_albums(id=int(albumId))
+            songs = self.library.db.get_songs(albumid=int(albumId), sortby="file")
+        elif artistId:
+            items = self.library.get_artists(id=int(artistId))
+            songs = self.library.db.get_songs(artistid=int(artistId), sortby="file")
+        elif playlistId:
+            plinfo, songs = self.library.get_playlist(int(playlistId))
+            items = [plinfo] if plinfo else []
+        else:
+            raise cherrypy.HTTPError(400, "Missing id")
+        if not items:
+            raise cherrypy.HTTPError(404)
+        files = {song["id"]: song["file"] for song in songs}  # playlists may repeat songs
+        checksums = self.library.get_crc32(list(files))
+        entries = {}
+        for song_id, path in files.items():
+            song = self.library.get_song(song_id)
+            entries[song_id] = ZipEntry(path, song["_fullpath"], song["size"], song["mtime"], checksums.get(song_id))
+
+        def store_checksums(computed):
+            computed = set(computed)
+            checksums = {song_id: entry.crc32 for song_id, entry in entries.items() if entry in computed}
+            # called from the stream engine's loop, which mustn't wait on the database
+            Thread(target=self.library.set_crc32, args=(checksums, ), daemon=True, name="checksums").start()
+
+        cherrypy.response.headers['Content-Type'] = "application/zip"
+        cherrypy.response.headers['Content-Disposition'] = self.attachment(items[0]["name"] + ".zip")
+        return send_stream(ZipSource(list(entries.values()), on_checksums=store_checksums))
+    download_view._cp_config = {'response.stream': True}
+
+    @staticmethod
+    def attachment(filename):
+        return "attachment; filename*=UTF-8''{}".format(quote(filename, safe=""))
+
+    def pick_profile(self, format=None):
+        """
+        Return the transcode profile for a request, or None to send original files. The format parameter wins, then
+        the format configured for the user and then for the client, then the default.
+        """
+        name = format or self.options.format_for.get(cherrypy.request.login) or \
+            self.options.format_for.get(cherrypy.request.params.get("c")) or self.options.default_format
+        if name == RAW_FORMAT:
+            return None
+        return PROFILES.get(name, PROFILES[self.options.default_format])
 
-            return content(proc)
-    stream_view._cp_config = {'response.stream': True}
+    def hls_bitrate(self, bitrate):
+        return max(32, min(int(bitrate), self.options.max_bitrate))
+
+    @cherrypy.expose
+    def hls_view(self, id, bitRate=None, **kwargs):
+        """
+        HLS playlist for a song, split into segments of --hls-segment seconds. When bitRate is given more than once a
+        master playlist with a variant per bitrate is returned instead.
+        """
+        song_id = int(id)
+        bitrates = [self.hls_bitrate(i) for i in int_list(bitRate) or [self.options.max_bitrate]]
+        auth = [(key, value) for key, value in cherrypy.request.params.items() if key in HLS_AUTH_PARAMS]
+        lines = ["#EXTM3U"]
+        if len(bitrates) > 1:
+            for bitrate in bitrates:
+                lines.append("#EXT-X-STREAM-INF:BANDWIDTH={}".format(bitrate * 1000))
+                lines.append("hls.view?" + urlencode([("id", song_id), ("bitRate", bitrate)] + auth))
+        else:
+            songs = self.library.db.get_songs(id=song_id)
+            if not songs or not songs[0]["length"]:
+                raise cherrypy.HTTPError(404, "Song not found or its length is unknown")
+            length = songs[0]["length"]
+            segment = self.options.hls_segment
+            lines += ["#EXT-X-VERSION:3",
+                      "#EXT-X-TARGETDURATION:{}".format(segment),
+                      "#EXT-X-MEDIA-SEQUENCE:0",
+                      "#EXT-X-PLAYLIST-TYPE:VOD"]
+            for index in range(math.ceil(length / segment)):
+                lines.append("#EXTINF:{:.3f},".format(min(segment, length - index * segment)))
+                lines.append("hlsSegment.view?" + urlencode([("id", song_id), ("bitRate", bitrates[0]),
+                                                             ("index", index)] + auth))
+            lines.append("#EXT-X-ENDLIST")
+        cherrypy.response.headers['Content-Type'] = 'application/vnd.apple.mpegurl'
+        return ("\n".join(lines) + "\n").encode('UTF-8')
+    hls_m3u8 = hls_view
+
+    @cherrypy.expose
+    def hlsSegment_view(self, id, bitRate, index, **kwargs):
+        """
+        One segment of an HLS playlist. Segments are transcoded on first request and kept in the transcode store, so
+        seeks, resumed playback and other listeners reuse them.
+        """
+        song_id = int(id)
+        bitrate = self.hls_bitrate(bitRate)
+        index = int(index)
+        fd = self.broker.open_stored(song_id, bitrate, "{:05d}.ts".format(index))
+        if fd is None:
+            song = self.library.get_song(song_id)
+            segment = self.options.hls_segment
+            start = index * segment
+            length = self.library.db.get_songs(id=song_id)[0]["length"] or 0
+            if index < 0 or start >= length:
+                raise cherrypy.HTTPError(404, "No such segment")
+            fd = self.broker.segment(song_id, song["_fullpath"], bitrate, index, start, segment)
+            if fd is None:
+                raise cherrypy.HTTPError(500, "Transcoding failed")
+        cherrypy.response.headers['Content-Type'] = 'video/MP2T'
+        return send_stream(FileSource(None, fd=fd))
+    hlsSegment_view._cp_config = {'response.stream': True}
 
     @cherrypy.expose
     def getCoverArt_view(self, id, **kwargs):
-        cover = self.library.get_cover(id)
+        cover = self.library.get_cover(int(id))
         fpath = cover["_fullpath"]
         type2ct = {
             'jpg': 'image/jpeg',
@@ -236,33 +420,115 @@ class PysonicSubsonicApi(object):
             'gif': 'image/gif'
         }
         cherrypy.response.headers['Content-Type'] = type2ct[fpath[-3:]]
-
-        def content():
-            total = 0
-            with open(fpath, "rb") as f:
-                while True:
-                    data = f.read(8192)
-                    if not data:
-                        break
-                    total += len(data)
-                    yield data
-            logging.info("\nSent {} bytes for {}".format(total, fpath))
-        return content()
+        return send_stream(FileSource(fpath))
     getCoverArt_view._cp_config = {'response.stream': True}
 
     @cherrypy.expose
     @formatresponse
-    def getArtistInfo_view(self, id, includeNotPresent="true", **kwargs):
-        info = self.library.get_artist_info(id)
+    def getArtistInfo_view(self, id, count=20, includeNotPresent="true", **kwargs):
+        """
+        Similar artists of an artist, or of an album's artist, by directory id. Biographies and images would need
+        last.fm and are left out.
+        """
+        return self.render_artist_info("artistInfo", self.find_artist(id), int(count), id3=False)
+
+    @cherrypy.expose
+    @formatresponse
+    def getArtistInfo2_view(self, id, count=20, includeNotPresent="true", **kwargs):
+        artist_id = self.find_id3_artist(id)
+        return self.render_artist_info("artistInfo2", artist_id, int(count), id3=True)
+
+    def render_artist_info(self, node, artist_id, count, id3):
+        tree = self.library.dirtree
+        stars = self.library.get_stars(cherrypy.request.login)
+        response = ApiResponse()
+        response.add_child(node)
+        for similar_id in self.library.get_similar_artists(artist_id, count):
+            name, artist_dir = tree.artists[similar_id]
+            response.add_child("similarArtist", _parent=node,
+                               id=similar_id if id3 else artist_dir,
+                               name=name,
+                               albumCount=len(tree.artist_albums.get(similar_id, ())) if id3 else None,
+                               starred=format_time(stars["artist"].get(similar_id)))
+        return response
+
+    def find_id3_artist(self, id):
+        """
+        Return the artist id for an ID3 artist id, checking the artist exists
+        """
+        tree = self.library.dirtree
+        if not tree.ready:
+            raise cherrypy.HTTPError(503, "Library is loading")
+        artist_id = int(id)
+        if artist_id not in tree.artists:
+            raise cherrypy.HTTPError(404, "Artist not found")
+        return artist_id
+
+    def find_artist(self, id, songs=False):
+        """
+        Return the artist id for the directory id of an artist or album, or with `songs` for a song id. Song ids are
+        tried first as the two overlap.
+        """
+        tree = self.library.dirtree
+        if not tree.ready:
+            raise cherrypy.HTTPError(503, "Library is loading")
+        item_id = int(id)
+        if songs and item_id in tree.songs:
+            return tree.albums[tree.songs[item_id]["albumid"]][2]
+        try:
+            dirtype, _, entity_id = tree.get_dir(item_id)
+        except NotFoundError:
+            raise cherrypy.HTTPError(404, "Not found")
+        if dirtype == DIR_ARTIST:
+            return entity_id
+        elif dirtype == DIR_ALBUM:
+            return tree.albums[entity_id][2]
+        raise cherrypy.HTTPError(404, "Not an artist or album")
+
+    @cherrypy.expose
+    @formatresponse
+    def getSimilarSongs_view(self, id, count=50, **kwargs):
+        """
+        Radio of songs like a song, or like an artist or album by directory id
+        """
+        artist_id = self.find_artist(id, songs=True)
+        song_id = int(id) if int(id) in self.library.dirtree.songs else None
+        return self.render_song_list("similarSongs", self.library.get_similar_songs(artist_id, song_id, int(count)))
+
+    @cherrypy.expose
+    @formatresponse
+    def getSimilarSongs2_view(self, id, count=50, **kwargs):
+        artist_id = self.find_id3_artist(id)
+        return self.render_song_list("similarSongs2", self.library.get_similar_songs(artist_id, count=int(count)))
+
+    @cherrypy.expose
+    @formatresponse
+    def getTopSongs_view(self, artist, count=50, **kwargs):
+        """
+        An artist's most played songs, by artist name
+        """
+        artist_ids = [artist_id for artist_id, (name, _) in self.library.dirtree.artists.items() if name == artist]
+        songs = self.library.db.get_songs(artistid=artist_ids, sortby="s.plays DESC, s.albumid, s.track",
+                                          limit=int(count)) if artist_ids else []
+        return self.render_song_list("topSongs", [song["id"] for song in songs])
+
+    def render_song_list(self, node, song_ids):
+        """
+        Respond with songs in the given order
+        """
+        songs = {song["id"]: song for song in self.library.db.get_songs(id=song_ids)} if song_ids else {}
+        stars = self.library.get_stars(cherrypy.request.login)
         response = ApiResponse()
-        response.add_child("artistInfo")
-        response.set_attrs("artistInfo", **info)
+        response.add_child(node)
+        for song_id in song_ids:
+            if song_id in songs:
+                response.add_child("song", _parent=node, **self.render_song(songs[song_id], stars))
         return response
 
     @cherrypy.expose
     @formatresponse
     def getUser_view(self, username, **kwargs):
-        user = {} if self.options.disable_auth else self.library.db.get_user(cherrypy.request.login)
+        user = {} if self.options.disable_auth else self.auth.get_user(cherrypy.request.login)
         response = ApiResponse()
         response.add_child("user",
                            username=user["username"],
@@ -286,29 +552,86 @@ class PysonicSubsonicApi(object):
 
     @cherrypy.expose
     @formatresponse
-    def star_view(self, id, **kwargs):
-        self.library.set_starred(cherrypy.request.login, int(id), starred=True)
+    def star_view(self, id=None, albumId=None, artistId=None, **kwargs):
+        self.set_starred(True, id, albumId, artistId)
         return ApiResponse()
 
     @cherrypy.expose
     @formatresponse
-    def unstar_view(self, id, **kwargs):
-        self.library.set_starred(cherrypy.request.login, int(id), starred=False)
+    def unstar_view(self, id=None, albumId=None, artistId=None, **kwargs):
+        self.set_starred(False, id, albumId, artistId)
         return ApiResponse()
 
+    def set_starred(self, starred, ids, album_ids, artist_ids):
+        """
+        Apply a star or unstar request. Each kind of id may be passed any number of times. `id` is a song id, or for
+        clients browsing by folder the directory id of an artist or album. The two overlap, and an id that is both a
+        song and an artist or album dir is refused rather than guessed at.
+        """
+        items = {"song": [], "album": int_list(album_ids), "artist": int_list(artist_ids)}
+        ids = int_list(ids)
+        if ids:
+            tree = self.library.dirtree
+            if not tree.ready:
+                raise cherrypy.HTTPError(503, "Library is loading")
+            for item_id in ids:
+                try:
+                    dirtype, _, entity_id = tree.get_dir(item_id)
+                except NotFoundError:
+                    dirtype = None
+                if dirtype in (DIR_ARTIST, DIR_ALBUM) and item_id in tree.songs:
+                    raise cherrypy.HTTPError(400, "Ambiguous id, use albumId or artistId for albums and artists")
+                if item_id in tree.songs:
+                    items["song"].append(item_id)
+                elif dirtype == DIR_ARTIST:
+                    items["artist"].append(entity_id)
+                elif dirtype == DIR_ALBUM:
+                    items["album"].append(entity_id)
+                else:
+                    raise cherrypy.HTTPError(404, "Not a song, artist or album")
+        for itemtype, item_ids in items.items():
+            if item_ids:
+                self.library.set_starred(cherrypy.request.login, item_ids, starred=starred, itemtype=itemtype)
+
     @cherrypy.expose
     @formatresponse
     def getStarred_view(self, **kwargs):
-        children = self.library.get_starred(cherrypy.request.login)
+        return self.render_starred("starred", id3=False)
+
+    @cherrypy.expose
+    @formatresponse
+    def getStarred2_view(self, **kwargs):
+        return self.render_starred("starred2", id3=True)
+
+    def render_starred(self, node, id3):
+        """
+        List the user's starred artists, albums and songs. getStarred identifies artists and albums by directory id,
+        getStarred2 by artist and album id.
+        """
+        stars = self.library.get_stars(cherrypy.request.login)
         response = ApiResponse()
-        response.add_child("starred")
-        for item in children:
-            # omit not dirs and media in browser
-            if not item["isdir"] and item["type"] not in MUSIC_TYPES:
-                continue
-            item_meta = item['metadata']
-            itemtype = "song" if item["type"] in MUSIC_TYPES else "album"
-            response.add_child(itemtype, _parent="starred", **self.render_node(item, item_meta, {}, {}))
+        response.add_child(node)
+        if stars["artist"]:
+            for artist in self.library.get_artists(id=list(stars["artist"]), sortby="name"):
+                response.add_child("artist", _parent=node,
+                                   id=artist["id"] if id3 else artist["dir"],
+                                   name=artist["name"],
+                                   starred=format_time(stars["artist"][artist["id"]]))
+        if stars["album"]:
+            for album in self.library.get_albums(id=list(stars["album"]), sortby="alb.name"):
+                if id3:
+                    album_kw = dict(id=album["id"],
+                                    name=album["name"],
+                                    artist=album["artistname"],
+                                    artistId=album["artistid"],
+                                    coverArt=album["coverid"],
+                                    starred=format_time(stars["album"][album["id"]]))
+                else:
+                    album_kw = self.render_album(album, stars)
+                response.add_child("album", _parent=node, **album_kw)
+        if stars["song"]:
+            for song in self.library.db.get_songs(id=list(stars["song"]), sortby="s.title"):
+                response.add_child("song", _parent=node, **self.render_song(song, stars))
         return response
 
     @cherrypy.expose
@@ -319,9 +642,18 @@ class PysonicSubsonicApi(object):
         :param genre: genre name to find songs under
         :type genre: str
         """
+        size = int(size)
+        years = (int(fromYear or 0), int(toYear or MAX_YEAR)) if fromYear or toYear else None
+        catalog, tree = self.library.catalog, self.library.dirtree
+        if catalog and catalog.ready and tree.ready:
+            children = [tree.song_row(song_id)
+                        for song_id in catalog.random_songs(size, genre=genre, from_year=fromYear, to_year=toYear)
+                        if song_id in tree.songs]
+        else:
+            children = self.library.db.get_songs(limit=size, sortby="random", genre=genre, years=years)
+        stars = self.library.get_stars(cherrypy.request.login)
         response = ApiResponse()
         response.add_child("randomSongs")
-        children = self.library.db.get_songs(limit=size, sortby="random")
         for song in children:
             moreargs = {}
             if song["format"]:
@@ -347,6 +679,7 @@ class PysonicSubsonicApi(object):
                                parent=song["albumid"],
                                size=song["size"],
                                suffix=file_extension,
+                               starred=format_time(stars["song"].get(song["id"])),
                                type="music",
                                **moreargs)
         return response
@@ -368,12 +701,19 @@ class PysonicSubsonicApi(object):
         :param submission: True if end of song reached. False on start of track.
         """
         submission = True if submission == "true" else False
-        # TODO save played track stats and/or do last.fm bullshit
+        ids = id if type(id) is list else [id]
+        times = kwargs.get("time", [])
+        times = times if type(times) is list else [times]
+        for index, song_id in enumerate(ids):
+            when = int(times[index]) / 1000 if index < len(times) else None  # subsonic sends milliseconds
+            self.writer.scrobble(cherrypy.request.login, int(song_id), when=when, submission=submission,
+                                 client=kwargs.get("c"))
+        # TODO do last.fm bullshit
         return ApiResponse()
 
     @cherrypy.expose
     @formatresponse
-    def search2_view(self, query, artistCount, albumCount, songCount, **kwargs):
+    def search2_view(self, query, artistCount=20, albumCount=20, songCount=20, **kwargs):
         response = ApiResponse()
         response.add_child("searchResult2")
 
@@ -381,32 +721,34 @@ class PysonicSubsonicApi(object):
         albumCount = int(albumCount)
         songCount = int(songCount)
 
-        query = query.replace("*", "")  # TODO handle this
+        query = query.replace("*", "").lower()  # TODO handle this
+        stars = self.library.get_stars(cherrypy.request.login)
 
+        # Rows are streamed from the database so each scan stops as soon as enough matches are found
+        # TODO make this more efficient
         artists = 0
-        for item in self.library.get_artists():
+        for item in self.library.db.iter_artists() if artistCount else []:
             if query in item["name"].lower():
-                response.add_child("artist", _parent="searchResult2", id=item["id"], name=item["name"])
+                response.add_child("artist", _parent="searchResult2", id=item["dir"], name=item["name"],
+                                   starred=format_time(stars["artist"].get(item["id"])))
                 artists += 1
                 if artists >= artistCount:
                     break
 
-        # TODO make this more efficient
         albums = 0
-        for item in self.library.get_artists():
+        for item in self.library.db.iter_albums() if albumCount else []:
             if query in item["name"].lower():
-                response.add_child("album", _parent="searchResult2", **self.render_node(item, item["metadata"], {}, {}))
+                response.add_child("album", _parent="searchResult2", **self.render_album(item, stars))
                 albums += 1
                 if albums >= albumCount:
                     break
 
-        # TODO make this more efficient
         songs = 0
-        for item in self.library.get_songs(limit=9999999, shuffle=False):
-            if query in item["name"].lower():
-                response.add_child("song", _parent="searchResult2", **self.render_node(item, item["metadata"], {}, {}))
+        for item in self.library.db.iter_songs() if songCount else []:
+            if query in item["title"].lower():
+                response.add_child("song", _parent="searchResult2", **self.render_song(item, stars))
                 songs += 1
-                if songs > songCount:
+                if songs >= songCount:
                     break
 
         return response
@@ -418,109 +760,165 @@ class PysonicSubsonicApi(object):
         pass
 
     @cherrypy.expose
-    def savePlayQueue_view(self, id, current, position, **kwargs):
-        print("TODO save playqueue with items {} current {} position {}".format(id, current, position))
-
-        song = self.library.get_song(int(current))
-        self.library.db.update_album_played(song['albumid'], time())
-        self.library.db.increment_album_plays(song['albumid'])
-        # TODO save playlist with items ['378', '386', '384', '380', '383'] current 383 position 4471
+    @formatresponse
+    def savePlayQueue_view(self, id, current=None, position=None, **kwargs):
         # id entries are strings!
+        ids = id if type(id) is list else [id]
+        user = self.auth.get_user(cherrypy.request.login)
+        self.writer.save_play_queue(user["id"], user["username"], [int(i) for i in ids],
+                                    current=int(current) if current else None,
+                                    position=int(position) if position else None,
+                                    client=kwargs.get("c"))
+        return ApiResponse()
 
     @cherrypy.expose
     @formatresponse
-    def createPlaylist_view(self, name, songId, **kwargs):
-        if type(songId) != list:
-            songId = [songId]
-        user = self.library.db.get_user(cherrypy.request.login)
-        self.library.db.add_playlist(user["id"], name, songId)
-        return ApiResponse()
-        #TODO the response should be the new playlist, check the cap
+    def getPlayQueue_view(self, **kwargs):
+        user = self.auth.get_user(cherrypy.request.login)
+        queue = self.writer.get_play_queue(user["id"])
+        response = ApiResponse()
+        if not queue:
+            return response
+        response.add_child("playQueue",
+                           current=queue["current"],
+                           position=queue["position"],
+                           username=user["username"],
+                           changed=format_time(queue["changed"]),
+                           changedBy=queue["changedby"])
+        songs = {song["id"]: song for song in self.library.db.get_songs(id=queue["songs"])} if queue["songs"] else {}
+        stars = self.library.get_stars(cherrypy.request.login)
+        for song_id in queue["songs"]:
+            if song_id in songs:
+                response.add_child("entry", _parent="playQueue", **self.render_song(songs[song_id], stars))
+        return response
+
+    @cherrypy.expose
+    @formatresponse
+    def getNowPlaying_view(self, **kwargs):
+        response = ApiResponse()
+        response.add_child("nowPlaying")
+        now = time()
+        stars = self.library.get_stars(cherrypy.request.login)
+        for username, info in self.writer.get_now_playing().items():
+            songs = self.library.db.get_songs(id=info["song_id"])
+            if not songs:
+                continue
+            response.add_child("entry", _parent="nowPlaying",
+                               username=username,
+                               minutesAgo=int((now - info["started"]) / 60),
+                               playerName=info["client"],
+                               **self.render_song(songs[0], stars))
+        return response
+
+    @staticmethod
+    def render_song(song, stars=None):
+        """
+        Subsonic child attributes for a song row from PysonicDatabase.get_songs()
+        :param stars: the requesting user's stars from PysonicLibrary.get_stars()
+        """
+        return dict(id=song["id"],
+                    parent=song["albumid"],
+                    isDir="false",
+                    title=song["title"],
+                    album=song["albumname"],
+                    artist=song["artistname"],
+                    track=song["track"],
+                    year=song["year"],
+                    genre=song["genrename"],
+                    coverArt=song["albumcoverid"],
+                    size=song["size"],
+                    contentType=song["format"],
+                    suffix=song["file"].split(".")[-1],
+                    duration=song["length"],
+                    bitRate=int(song["bitrate"] / 1024) if song["bitrate"] else None,
+                    path=song["file"],
+                    playCount=song["plays"],
+                    albumId=song["albumid"],
+                    artistId=song.get("artistid"),
+                    starred=format_time(stars["song"].get(song["id"])) if stars else None,
+                    type="music")
+
+    @cherrypy.expose
+    @formatresponse
+    def createPlaylist_view(self, name=None, songId=None, playlistId=None, **kwargs):
+        song_ids = int_list(songId)
+        if not name and not playlistId:
+            raise cherrypy.HTTPError(400, "Missing name or playlistId")
+        user = self.auth.get_user(cherrypy.request.login)
+        if playlistId:
+            # Clients replace the contents of an existing playlist this way
+            plinfo = self.library.db.get_playlist(int(playlistId))
+            assert plinfo["ownerid"] == user["id"]
+            self.library.db.replace_playlist_songs(plinfo["id"], song_ids)
+            playlist_id = plinfo["id"]
+        else:
+            playlist_id = self.library.db.add_playlist(user["id"], name, song_ids)
+        response = ApiResponse()
+        self.render_playlist(response, user, *self.library.get_playlist(playlist_id))
+        return response
+
+    def render_playlist(self, response, user, plinfo, songs=None, stars=None):
+        """
+        Add a playlist node, and its entries if `songs` is given, to an ApiResponse
+        """
+        node = response.add_child("playlist",
+                                  _parent="playlists" if songs is None else "",
+                                  id=plinfo["id"],
+                                  name=plinfo["name"],
+                                  owner=user["username"],  # TODO translate id to name
+                                  public="true" if plinfo["public"] else "false",
+                                  songCount=plinfo["songcount"],
+                                  duration=plinfo["duration"],
+                                  created=format_time(plinfo["created"]),
+                                  changed=format_time(plinfo["changed"]),
+                                  coverArt=plinfo["cover"])
+        for song in songs or []:
+            response.add_child("entry", _real_parent=node, **self.render_song(song, stars))
 
     @cherrypy.expose
     @formatresponse
     def getPlaylists_view(self, **kwargs):
-        user = self.library.db.get_user(cherrypy.request.login)
+        user = self.auth.get_user(cherrypy.request.login)
 
         response = ApiResponse()
         response.add_child("playlists")
         for playlist in self.library.db.get_playlists(user["id"]):
-            response.add_child("playlist",
-                               _parent="playlists",
-                               id=playlist["id"],
-                               name=playlist["name"],
-                               owner=user["username"],
-                               public=playlist["public"],
-                               songCount=69,
-                               duration=420,
-                               # changed="2018-04-05T23:23:38.263Z"
-                               # created="2018-04-05T23:23:38.252Z"
-                               # coverArt="pl-1"
-                               )
-
+            self.render_playlist(response, user, playlist)
         return response
 
     @cherrypy.expose
     @formatresponse
     def getPlaylist_view(self, id, **kwargs):
-        user = self.library.db.get_user(cherrypy.request.login)
+        user = self.auth.get_user(cherrypy.request.login)
         plinfo, songs = self.library.get_playlist(int(id))
+        if self.prefetcher:
+            self.prefetcher.saw_playlist(user["username"], [song["id"] for song in songs])
 
         response = ApiResponse()
-        response.add_child("playlist",
-                           id=plinfo["id"],
-                           name=plinfo["name"],  # TODO this element should match getPlaylists_view
-                           owner=user["username"],  # TODO translate id to name
-                           public=plinfo["public"],
-                           songCount=69,
-                           duration=420)
-        for song in songs:
-            response.add_child("entry",
-                               _parent="playlist",
-                               id=song["id"],
-                               parent=song["albumid"],  # albumid seems wrong? should be dir parent?
-                               isDir="false",
-                               title=song["title"],
-                               album=song["albumname"],
-                               artist=song["artistname"],
-                               track=song["track"],
-                               year=song["year"],
-                               genre=song["genrename"],
-                               coverArt=song["albumcoverid"],
-                               size=song["size"],
-                               contentType=song["format"],
-                               # suffix="mp3"
-                               duration=song["length"],
-                               bitRate=song["bitrate"] / 1024,
-                               path=song["file"],
-                               playCount="1",
-                               # created="2015-06-09T15:26:01.000Z"
-                               albumId=song["albumid"],
-                               artistId=song["artistid"],
-                               type="music")
+        self.render_playlist(response, user, plinfo, songs, self.library.get_stars(user["username"]))
         return response
 
     @cherrypy.expose
     @formatresponse
-    def updatePlaylist_view(self, playlistId, songIndexToRemove=None, songIdToAdd=None, **kwargs):
-        user = self.library.db.get_user(cherrypy.request.login)
-        plinfo, songs = self.library.get_playlist(int(playlistId))
+    def updatePlaylist_view(self, playlistId, name=None, public=None, songIndexToRemove=None, songIdToAdd=None,
+                            **kwargs):
+        user = self.auth.get_user(cherrypy.request.login)
+        plinfo = self.library.db.get_playlist(int(playlistId))
 
         assert plinfo["ownerid"] == user["id"]
 
-        if songIndexToRemove:
-            self.library.db.remove_index_from_playlist(playlistId, songIndexToRemove)
-        elif songIdToAdd:
-            self.library.db.add_to_playlist(playlistId, songIdToAdd)
-        #TODO there are more modification methods
-
+        self.library.db.update_playlist(plinfo["id"],
+                                        name=name,
+                                        public=None if public is None else public == "true",
+                                        remove_indexes=int_list(songIndexToRemove),
+                                        add_song_ids=int_list(songIdToAdd))
         return ApiResponse()
 
     @cherrypy.expose
     @formatresponse
     def deletePlaylist_view(self, id, **kwargs):
-        user = self.library.db.get_user(cherrypy.request.login)
-        plinfo, _ = self.library.get_playlist(int(id))
+        user = self.auth.get_user(cherrypy.request.login)
+        plinfo = self.library.db.get_playlist(int(id))
         assert plinfo["ownerid"] == user["id"]
 
         self.library.delete_playlist(plinfo["id"])
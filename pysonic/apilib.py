@@ -1,8 +1,8 @@
 from collections import defaultdict
-from bs4 import BeautifulSoup
 import re
 import cherrypy
 import json
+from pysonic.profiling import current_profile
 
 CALLBACK_RE = re.compile(r'^[a-zA-Z0-9_]+$')
 
@@ -20,20 +20,42 @@ def formatresponse(func):
     Decorator for rendering ApiResponse responses based on requested response type
     """
     def wrapper(*args, **kwargs):
-        response = func(*args, **kwargs)
-        response_format = kwargs.get("f", "xml")
-        callback = kwargs.get("callback", None)
-        cherrypy.response.headers['Content-Type'] = response_headers[response_format]
-        renderer = getattr(response, response_formats[response_format])
-        if response_format == "jsonp":
-            if callback is None:
-                return response.render_xml().encode('UTF-8')  # copy original subsonic behavior
-            else:
-                return renderer(callback).encode('UTF-8')
-        return renderer().encode('UTF-8')
+        profile = current_profile()
+        if profile is None:
+            response = func(*args, **kwargs)
+            return render_response(response, kwargs.get("f", "xml"), kwargs.get("callback", None))
+        with profile.timed("handler"):
+            response = func(*args, **kwargs)
+        with profile.timed("render"):
+            body = render_response(response, kwargs.get("f", "xml"), kwargs.get("callback", None))
+        profile.bytes_out = len(body)
+        return body
     return wrapper
 
 
+def render_response(response, response_format="xml", callback=None):
+    """
+    Render an ApiResponse as the requested response type and set the matching content type
+    """
+    cherrypy.response.headers['Content-Type'] = response_headers[response_format]
+    renderer = getattr(response, response_formats[response_format])
+    if response_format == "jsonp":
+        if callback is None:
+            return response.render_xml().encode('UTF-8')  # copy original subsonic behavior
+        else:
+            return renderer(callback).encode('UTF-8')
+    return renderer().encode('UTF-8')
+
+
+def error_response(code, message):
+    """
+    Build a failed ApiResponse carrying a subsonic error code
+    """
+    response = ApiResponse(status="failed")
+    response.add_child("error", code=code, message=message)
+    return response
+
+
 class ApiResponse(object):
     def __init__(self, status="ok", version="1.15.0"):
         """
@@ -107,6 +129,7 @@ class ApiResponse(object):
                       'folder']
         selftext_attrs = ['value']
         # These attributes will be placed in <hello>{{ value }}</hello> tags instead of hello="{{ value }}" on parent
+        from bs4 import BeautifulSoup  # slow to import and unused by json clients
         doc = BeautifulSoup('', features='lxml-xml')
         root = doc.new_tag("subsonic-response", xmlns="http://subsonic.org/restapi",
                            status=self.status,
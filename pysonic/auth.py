@@ -0,0 +1,192 @@
+import logging
+import binascii
+from base64 import b64decode
+from hashlib import md5
+from hmac import compare_digest
+from time import time
+from threading import Lock
+from collections import OrderedDict
+import cherrypy
+from pysonic.apilib import render_response, error_response
+from pysonic.database import check_password, NotFoundError
+
+
+logging = logging.getLogger("auth")
+
+# Subsonic API error codes
+ERR_MISSING_PARAM = 10
+ERR_BAD_CREDENTIALS = 40
+
+FAILED_TTL = 30  # seconds a credential that failed to verify is rejected without hashing it again
+MAX_FAILURES = 10  # failed attempts per client address or username...
+FAILURE_WINDOW = 60  # ...within this many seconds, after which new credentials from them are rejected unchecked
+
+
+class AuthError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class PysonicAuth(object):
+    def __init__(self, db, ttl=300, max_entries=4096, failed_ttl=FAILED_TTL, max_failures=MAX_FAILURES,
+                 failure_window=FAILURE_WINDOW):
+        """
+        Authenticates api requests against an in-memory copy of the users table. Subsonic clients authenticate with
+        query params on every request: u plus either p (plain or "enc:" hex encoded) or t/s, where t is
+        md5(password + s). Credentials that verify are remembered for `ttl` seconds so repeated requests from the same
+        client cost a dict lookup rather than a password hash. Failures are remembered too, so guessing passwords
+        can't keep the server busy hashing them: the same bad credential is rejected for `failed_ttl` seconds, and a
+        client address or username with `max_failures` failures in `failure_window` seconds gets no more checked until
+        the window ends. Credentials verified before that keep working.
+        :param db: PysonicDatabase
+        :param ttl: seconds a verified credential is trusted
+        :param max_entries: maximum number of verified credentials to remember
+        """
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.failed_ttl = failed_ttl
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+        self.users = {}
+        # Token auth needs the password itself. We only know it for users configured in this process and never store
+        # it on disk.
+        self.passwords = {}
+        self.verified = OrderedDict()
+        self.failed = OrderedDict()  # credential key -> rejected until
+        self.failures = OrderedDict()  # ("ip", address) or ("user", username) -> (failures, window end)
+        self.lock = Lock()
+        self.reload()
+
+    def reload(self):
+        """
+        Refresh the user cache from the database and forget previously verified credentials
+        """
+        users = {user["username"]: user for user in self.db.get_users()}
+        with self.lock:
+            self.users = users
+            self.verified.clear()
+            self.failed.clear()
+
+    def add_user(self, username, password, is_admin=False):
+        self.db.add_user(username, password, is_admin)
+        self.passwords[username] = password
+        self.reload()
+
+    def update_user(self, username, password, is_admin=False):
+        self.db.update_user(username, password, is_admin)
+        self.passwords[username] = password
+        self.reload()
+
+    def get_user(self, username):
+        try:
+            return self.users[username]
+        except KeyError:
+            raise NotFoundError("User doesn't exist")
+
+    def authenticate(self, params, authorization=None, remote=None):
+        """
+        Return the user identified by the request's credentials
+        :param params: request query params
+        :param authorization: value of the Authorization header, if any
+        :param remote: client address, failures from which are limited
+        :raises: AuthError
+        """
+        username = params.get("u")
+        if username and "t" in params and "s" in params:
+            key = ("t", username, params["t"], params["s"])
+        elif username and "p" in params:
+            key = ("p", username, params["p"])
+        elif authorization:
+            key = ("basic", authorization)
+        else:
+            raise AuthError(ERR_MISSING_PARAM, "Required parameter is missing.")
+
+        now = time()
+        with self.lock:
+            cached = self.verified.get(key)
+            if cached and cached[1] > now:
+                return self.users[cached[0]]
+            limits = [limit for limit in (("ip", remote), ("user", username)) if limit[1]]
+            if self.failed.get(key, 0) > now:
+                raise AuthError(ERR_BAD_CREDENTIALS, "Wrong username or password.")
+            for limit in limits:
+                failures, until = self.failures.get(limit, (0, 0))
+                if until > now and failures >= self.max_failures:
+                    raise AuthError(ERR_BAD_CREDENTIALS, "Too many failed attempts, try again later.")
+
+        username = self.verify(key)
+        if username is None:
+            with self.lock:
+                self.failed[key] = now + self.failed_ttl
+                for limit in limits:
+                    failures, until = self.failures.pop(limit, (0, 0))
+                    if until <= now:
+                        failures, until = 0, now + self.failure_window
+                    self.failures[limit] = (failures + 1, until)
+                for cache in (self.failed, self.failures):
+                    while len(cache) > self.max_entries:
+                        cache.popitem(last=False)
+            raise AuthError(ERR_BAD_CREDENTIALS, "Wrong username or password.")
+
+        with self.lock:
+            self.verified[key] = (username, now + self.ttl)
+            while len(self.verified) > self.max_entries:
+                self.verified.popitem(last=False)
+            return self.users[username]
+
+    def verify(self, key):
+        """
+        Check a credential key built by authenticate(). Returns the username or None.
+        """
+        kind = key[0]
+        if kind == "t":
+            _, username, token, salt = key
+            password = self.passwords.get(username)
+            if username not in self.users or password is None:
+                return None
+            expected = md5((password + salt).encode('UTF-8')).hexdigest()
+            return username if compare_digest(expected.encode('UTF-8'), token.lower().encode('UTF-8')) else None
+
+        if kind == "p":
+            _, username, password = key
+        else:
+            try:
+                scheme, encoded = key[1].split(" ", 1)
+                assert scheme.lower() == "basic"
+                username, password = b64decode(encoded).decode('UTF-8').split(":", 1)
+            except (ValueError, AssertionError, binascii.Error, UnicodeDecodeError):
+                return None
+
+        if password.startswith("enc:"):
+            try:
+                password = binascii.unhexlify(password[4:]).decode('UTF-8')
+            except (binascii.Error, UnicodeDecodeError):
+                return None
+
+        user = self.users.get(username)
+        if user is None:
+            return None
+        known = self.passwords.get(username)
+        if known is not None:
+            return username if compare_digest(known.encode('UTF-8'), password.encode('UTF-8')) else None
+        return username if check_password(user["password"], password) else None
+
+    def check_request(self):
+        """
+        CherryPy before_handler hook. Sets request.login on success, otherwise replaces the handler with a subsonic
+        error response.
+        """
+        request = cherrypy.request
+        try:
+            user = self.authenticate(request.params, request.headers.get("Authorization"), request.remote.ip)
+        except AuthError as e:
+            logging.warning("rejected request from %s: %s", request.remote.ip, e.message)
+            request.handler = None
+            cherrypy.response.body = render_response(error_response(e.code, e.message),
+                                                     request.params.get("f", "xml"),
+                                                     request.params.get("callback", None))
+            return
+        request.login = user["username"]
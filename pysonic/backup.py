@@ -0,0 +1,166 @@
+import os
+import gzip
+import json
+import sqlite3
+import logging
+from time import time
+from contextlib import closing
+from pysonic.database import PysonicDatabase
+
+
+logging = logging.getLogger("backup")
+
+IMPORT_BATCH = 10000  # rows inserted per executemany
+SNAPSHOT_FORMAT = "pysonic-catalog"
+SNAPSHOT_VERSION = 1
+
+# Tables carried by a catalog snapshot, in an order that keeps references pointing backwards. Derived tables
+# (similar) and server process state (changes) are rebuilt on the new node instead.
+CATALOG_TABLES = ["libraries", "dirs", "genres", "artists", "albums", "songs", "covers", "checksums", "users",
+                  "playlists", "playlist_entries", "playqueues", "starred"]
+
+
+def backup(path, dest):
+    """
+    Copy a live database to `dest` with sqlite's backup api. The copy is made in a single step: a write by any other
+    connection restarts a backup made in several steps from the first page, so against a busy server it might never
+    finish. The server keeps its database in WAL mode, where the step's read transaction doesn't block its writes, and
+    the copy is of the database as it was when the step began. The copy is written next to `dest` and renamed over it
+    once complete.
+    """
+    start = time()
+    temp_path = dest + ".part"
+    with closing(sqlite3.connect(path, timeout=30)) as source, closing(sqlite3.connect(temp_path)) as target:
+        source.backup(target, pages=-1)
+    os.rename(temp_path, dest)
+    logging.warning("backed up %s to %s in %ss", path, dest, round(time() - start, 3))
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute("PRAGMA table_info('{}')".format(table))]
+
+
+def export_catalog(path, dest):
+    """
+    Write the library catalog, users, playlists, stars and play statistics to a gzipped file of json lines: a header,
+    then for each table its column names followed by one array per row. Everything is read in one transaction, so the
+    snapshot is consistent while a server keeps writing.
+    """
+    start = time()
+    counts = {}
+    with closing(sqlite3.connect(path, timeout=30)) as conn, gzip.open(dest, "wt", encoding="utf-8") as f:
+        conn.execute("BEGIN")
+        version = int(conn.execute("SELECT value FROM meta WHERE key='db_version'").fetchone()[0])
+        f.write(json.dumps(dict(format=SNAPSHOT_FORMAT, version=SNAPSHOT_VERSION, db_version=version,
+                                exported=int(start))) + "\n")
+        for table in CATALOG_TABLES:
+            columns = table_columns(conn, table)
+            if not columns:
+                continue  # added by a later schema version
+            f.write(json.dumps(dict(table=table, columns=columns)) + "\n")
+            counts[table] = 0
+            select = "SELECT {} FROM '{}'".format(", ".join('"{}"'.format(column) for column in columns), table)
+            for row in conn.execute(select):
+                f.write(json.dumps(row, separators=(",", ":")) + "\n")
+                counts[table] += 1
+        conn.execute("COMMIT")
+    logging.warning("exported %s in %ss", ", ".join("{} {}".format(count, table) for table, count in counts.items()),
+                    round(time() - start, 3))
+    return counts
+
+
+def import_catalog(path, source, relocate=None):
+    """
+    Replace the catalog of a database with a snapshot written by export_catalog(), so a new server can serve the
+    library without scanning its files' metadata first. Tables in the snapshot are emptied and refilled in one
+    transaction; columns either side doesn't have are left out.
+    :param relocate: {old root path: new root path} for libraries mounted elsewhere on the new server
+    """
+    start = time()
+    PysonicDatabase(path=path).db.close()  # creates or migrates the schema
+    counts = {}
+    with closing(sqlite3.connect(path, timeout=30)) as conn, gzip.open(source, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != SNAPSHOT_FORMAT or header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("{} is not a pysonic catalog snapshot".format(source))
+        version = int(conn.execute("SELECT value FROM meta WHERE key='db_version'").fetchone()[0])
+        if header["db_version"] > version:
+            raise ValueError("snapshot is from a newer schema ({}) than the database ({})"
+                             .format(header["db_version"], version))
+
+        conn.execute("PRAGMA synchronous=OFF")  # nothing is visible until the single commit at the end
+        conn.execute("BEGIN")
+        table = insert = keep = None
+        batch = []
+
+        def flush():
+            if batch and insert:
+                conn.executemany(insert, [[row[index] for index in keep] for row in batch])
+                counts[table] += len(batch)
+                del batch[:]
+
+        for line in f:
+            item = json.loads(line)
+            if isinstance(item, dict):
+                flush()
+                table = item["table"]
+                counts[table] = 0
+                existing = table_columns(conn, table)
+                if not existing:
+                    insert = None  # dropped by a later schema version
+                    continue
+                keep = [index for index, column in enumerate(item["columns"]) if column in existing]
+                columns = [item["columns"][index] for index in keep]
+                insert = "INSERT INTO '{}' ({}) VALUES ({})".format(table, ", ".join('"{}"'.format(column)
+                                                                                     for column in columns),
+                                                                    ", ".join("?" * len(columns)))
+                conn.execute("DELETE FROM '{}'".format(table))
+                continue
+            batch.append(item)
+            if len(batch) >= IMPORT_BATCH:
+                flush()
+        flush()
+
+        for old, new in (relocate or {}).items():
+            conn.execute("UPDATE libraries SET path=? WHERE path=?", (new, old))
+        conn.execute("DELETE FROM similar")  # neighbour ids of the old catalog, rebuilt by the server
+        conn.execute("DELETE FROM meta WHERE key='similar_built'")
+        conn.execute("COMMIT")
+    logging.warning("imported %s in %ss", ", ".join("{} {}".format(count, table) for table, count in counts.items()),
+                    round(time() - start, 3))
+    return counts
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Back up, export and import pysonic databases")
+    parser.add_argument('-s', '--database-path', default="./db.sqlite", help="path to persistent sqlite database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_backup = subparsers.add_parser("backup", help="copy the database while a server is using it")
+    parser_backup.add_argument("dest", help="path of the copy")
+
+    parser_export = subparsers.add_parser("export", help="write a catalog snapshot")
+    parser_export.add_argument("dest", help="path of the snapshot, gzipped json lines")
+
+    parser_import = subparsers.add_parser("import", help="replace the database's catalog with a snapshot")
+    parser_import.add_argument("source", help="path of the snapshot")
+    parser_import.add_argument("--relocate", nargs="+", type=lambda x: x.split("="), default=[],
+                               help="old=new pairs of library root paths that moved")
+
+    args = parser.parse_args()
+
+    import logging as logs
+    logs.basicConfig(level=logs.WARNING, format="%(asctime)-15s %(levelname)-8s %(filename)s:%(lineno)d %(message)s")
+
+    if args.command == "backup":
+        backup(args.database_path, args.dest)
+    elif args.command == "export":
+        export_catalog(args.database_path, args.dest)
+    elif args.command == "import":
+        import_catalog(args.database_path, args.source, relocate=dict(args.relocate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+import sys
+import random
+import logging
+from array import array
+from itertools import compress
+from threading import Lock
+from contextlib import closing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logging = logging.getLogger("catalog")
+
+ALBUM_LIST_TYPES = ["random", "newest", "alphabeticalByName", "alphabeticalByArtist", "frequent", "recent", "starred",
+                    "byYear", "byGenre"]
+
+MAX_YEAR = 9999
+# column name -> array typecode. Timestamps need 64 bits, everything else fits in 32.
+ALBUM_COLUMNS = {"album_id": "i", "album_artist": "i", "album_name": "i", "album_artist_name": "i", "album_added": "q",
+                 "album_played": "q", "album_plays": "i", "album_year": "i"}
+SONG_COLUMNS = {"song_id": "i", "song_album": "i", "song_genre": "i", "song_year": "i", "song_length": "i",
+                "song_plays": "i"}
+COLUMNS = dict(ALBUM_COLUMNS, **SONG_COLUMNS)
+UPDATE_BATCH = 500  # ids per query when patching play counts
+
+
+class ArrayColumns(object):
+    """
+    Column operations over array.array columns, used when numpy isn't installed. Row sets are lists of row indexes.
+    """
+    @staticmethod
+    def column(typecode, values):
+        return array(typecode, values)
+
+    @staticmethod
+    def index(ids):
+        """
+        Return a column mapping id -> row, -1 for ids not present
+        """
+        index = array("i", [-1]) * (max(ids, default=0) + 1)
+        for row, item_id in enumerate(ids):
+            index[item_id] = row
+        return index
+
+    @staticmethod
+    def dropping(ids, drop_ids):
+        """
+        Return a mask of the rows whose id is not in `drop_ids`
+        """
+        return [item_id not in drop_ids for item_id in ids]
+
+    @staticmethod
+    def extend(column, mask, values):
+        """
+        Return the rows of `column` selected by `mask` followed by `values`
+        """
+        return array(column.typecode, compress(column, mask)) + array(column.typecode, values)
+
+    @staticmethod
+    def rows(count):
+        return range(count)
+
+    @staticmethod
+    def between(column, low, high, rows):
+        return [row for row in rows if low <= column[row] <= high]
+
+    @staticmethod
+    def equal(column, value, rows):
+        return [row for row in rows if column[row] == value]
+
+    @staticmethod
+    def sort(rows, column, reverse=False):
+        """
+        Stable sort of rows by a column
+        """
+        return sorted(rows, key=column.__getitem__, reverse=reverse)
+
+    @staticmethod
+    def subset(order, rows, count):
+        """
+        Return the rows of `order` that are in `rows`, in the order of `order`
+        """
+        rows = set(rows)
+        return [row for row in order if row in rows]
+
+    @staticmethod
+    def gather(column, rows):
+        return [column[row] for row in rows]
+
+    @staticmethod
+    def tolist(values):
+        return list(values)
+
+    @staticmethod
+    def nbytes(column):
+        return column.itemsize * len(column)
+
+
+class NumpyColumns(object):
+    """
+    Vectorized column operations over numpy arrays. Row sets are arrays of row indexes.
+    """
+    @staticmethod
+    def column(typecode, values):
+        return numpy.array(values, dtype=typecode)
+
+    @staticmethod
+    def index(ids):
+        index = numpy.full(int(ids.max(initial=0)) + 1, -1, dtype="i")
+        index[ids] = numpy.arange(len(ids))
+        return index
+
+    @staticmethod
+    def dropping(ids, drop_ids):
+        return ~numpy.isin(ids, list(drop_ids))
+
+    @staticmethod
+    def extend(column, mask, values):
+        return numpy.concatenate([column[mask], numpy.array(values, dtype=column.dtype)])
+
+    @staticmethod
+    def rows(count):
+        return numpy.arange(count)
+
+    @staticmethod
+    def between(column, low, high, rows):
+        values = column[rows]
+        return rows[(values >= low) & (values <= high)]
+
+    @staticmethod
+    def equal(column, value, rows):
+        return rows[column[rows] == value]
+
+    @staticmethod
+    def sort(rows, column, reverse=False):
+        keys = column[rows]
+        return rows[numpy.argsort(-keys if reverse else keys, kind="stable")]
+
+    @staticmethod
+    def subset(order, rows, count):
+        mask = numpy.zeros(count, dtype=bool)
+        mask[rows] = True
+        return order[mask[order]]
+
+    @staticmethod
+    def gather(column, rows):
+        return column[rows]
+
+    @staticmethod
+    def tolist(values):
+        return values.tolist()
+
+    @staticmethod
+    def nbytes(column):
+        return column.nbytes
+
+
+class CatalogColumns(object):
+    """
+    One snapshot of the catalog. Snapshots are replaced rather than resized so a query sees a consistent one.
+    """
+    def __init__(self, ops):
+        self.ops = ops
+        self.names = []  # interned album and artist names
+        self.name_ids = {}
+        self.genres = {}  # genre name -> id
+        for name, typecode in COLUMNS.items():
+            setattr(self, name, ops.column(typecode, []))
+        self.finish()
+
+    def intern(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(sys.intern(name or ""))
+        return name_id
+
+    def finish(self):
+        """
+        Derive the id indexes and the name orders once the columns are filled in
+        """
+        ops = self.ops
+        self.album_index = ops.index(self.album_id)
+        self.song_index = ops.index(self.song_id)
+        names, album_names, artist_names = self.names, self.album_name, self.album_artist_name
+        self.by_name = ops.column("i", sorted(range(len(album_names)), key=lambda row: names[album_names[row]]))
+        self.by_artist = ops.column("i", sorted(range(len(album_names)),
+                                                key=lambda row: (names[artist_names[row]], names[album_names[row]])))
+
+    def load(self, cursor, where="", params=(), keep_albums=None, keep_songs=None):
+        """
+        Read albums and songs matching `where` from the database. Without masks the columns are replaced, otherwise
+        the rows selected by the masks are kept and the loaded ones appended.
+        :param where: condition on the albums, aliased alb
+        """
+        ops = self.ops
+        albums = cursor.execute("SELECT alb.id, alb.artistid, alb.name, art.name as artistname, alb.added, "
+                                "IFNULL(alb.played, 0) as played, alb.plays FROM albums as alb "
+                                "INNER JOIN artists as art ON art.id = alb.artistid " + where, params).fetchall()
+        songs = cursor.execute("SELECT s.id, s.albumid, IFNULL(s.genre, 0) as genre, IFNULL(s.year, 0) as year, "
+                               "IFNULL(s.length, 0) as length, s.plays FROM songs as s "
+                               "INNER JOIN albums as alb ON alb.id = s.albumid " + where, params).fetchall()
+        years = {}
+        for song in songs:
+            years[song["albumid"]] = max(years.get(song["albumid"], 0), song["year"])
+        album_columns = {"album_id": [row["id"] for row in albums],
+                         "album_artist": [row["artistid"] for row in albums],
+                         "album_name": [self.intern(row["name"]) for row in albums],
+                         "album_artist_name": [self.intern(row["artistname"]) for row in albums],
+                         "album_added": [row["added"] for row in albums],
+                         "album_played": [row["played"] for row in albums],
+                         "album_plays": [row["plays"] for row in albums],
+                         "album_year": [years.get(row["id"], 0) for row in albums]}
+        song_columns = {"song_id": [row["id"] for row in songs],
+                        "song_album": [row["albumid"] for row in songs],
+                        "song_genre": [row["genre"] for row in songs],
+                        "song_year": [row["year"] for row in songs],
+                        "song_length": [row["length"] for row in songs],
+                        "song_plays": [row["plays"] for row in songs]}
+        for columns, mask in ((album_columns, keep_albums), (song_columns, keep_songs)):
+            for name, values in columns.items():
+                if mask is None:
+                    setattr(self, name, ops.column(COLUMNS[name], values))
+                else:
+                    setattr(self, name, ops.extend(getattr(self, name), mask, values))
+        self.genres = {row["name"]: row["id"] for row in cursor.execute("SELECT id, name FROM genres")}
+        self.finish()
+
+    def nbytes(self):
+        """
+        Approximate memory held by the snapshot, in bytes
+        """
+        columns = [value for name, value in vars(self).items() if name.startswith(("album_", "song_", "by_"))]
+        return sum(self.ops.nbytes(column) for column in columns) + sys.getsizeof(self.names) + \
+            sys.getsizeof(self.name_ids) + sum(sys.getsizeof(name) for name in self.names)
+
+
+class PysonicCatalog(object):
+    def __init__(self, db, use_numpy=None):
+        """
+        In-memory columns of the numbers album lists and random song picks sort and filter by: ids, interned names,
+        artist, genre, year, duration, added, play counts. Queries are answered by filtering and sorting whole columns,
+        vectorized with numpy when it is installed and with the array module otherwise. The columns are loaded by
+        rebuild() after scans, reloaded for the albums a running scan changed by update() and patched by update_plays()
+        as plays are written.
+        :param use_numpy: None to use numpy if it's available
+        """
+        self.db = db
+        self.ops = NumpyColumns if (numpy is not None if use_numpy is None else use_numpy) else ArrayColumns
+        self.lock = Lock()
+        self.ready = False
+        self.data = CatalogColumns(self.ops)
+
+    def rebuild(self):
+        """
+        Load the whole catalog, swapping it in when done
+        """
+        with self.lock:
+            data = CatalogColumns(self.ops)
+            with closing(self.db.connect()) as conn, closing(conn.cursor()) as cursor:
+                data.load(cursor)
+            self.data = data
+            self.ready = True
+        logging.info("catalog holds %s albums and %s songs in %s KiB", len(data.album_id), len(data.song_id),
+                     data.nbytes() // 1024)
+
+    def update(self, album_ids):
+        """
+        Reload some albums and their songs
+        """
+        album_ids = set(album_ids) - {None}
+        if not album_ids or not self.ready:
+            return
+        with self.lock:
+            old = self.data
+            data = CatalogColumns(self.ops)
+            # name ids stay valid as the old snapshot's name table is extended, never reordered
+            data.names, data.name_ids = list(old.names), dict(old.name_ids)
+            for name in COLUMNS:
+                setattr(data, name, getattr(old, name))
+            params = list(album_ids)
+            with closing(self.db.connect()) as conn, closing(conn.cursor()) as cursor:
+                data.load(cursor, "WHERE alb.id IN ({})".format(",".join("?" * len(params))), params,
+                          keep_albums=self.ops.dropping(old.album_id, album_ids),
+                          keep_songs=self.ops.dropping(old.song_album, album_ids))
+            self.data = data
+
+    def update_plays(self, song_ids):
+        """
+        Copy the play counts and last played times of some songs and their albums from the database
+        """
+        song_ids = list(song_ids)
+        if not song_ids or not self.ready:
+            return
+        with self.lock, closing(self.db.connect()) as conn:
+            data = self.data
+            for offset in range(0, len(song_ids), UPDATE_BATCH):
+                batch = song_ids[offset:offset + UPDATE_BATCH]
+                for row in conn.execute("SELECT s.id, s.plays, s.albumid, alb.plays as albumplays, "
+                                        "IFNULL(alb.played, 0) as albumplayed FROM songs as s "
+                                        "INNER JOIN albums as alb ON alb.id = s.albumid "
+                                        "WHERE s.id IN ({})".format(",".join("?" * len(batch))), batch):
+                    song_row = self.row(data.song_index, row["id"])
+                    album_row = self.row(data.album_index, row["albumid"])
+                    if song_row >= 0:
+                        data.song_plays[song_row] = row["plays"]
+                    if album_row >= 0:
+                        data.album_plays[album_row] = row["albumplays"]
+                        data.album_played[album_row] = row["albumplayed"]
+
+    @staticmethod
+    def row(index, item_id):
+        return int(index[item_id]) if 0 <= item_id < len(index) else -1
+
+    def album_list(self, list_type, size, offset=0, from_year=None, to_year=None, genre=None, starred=()):
+        """
+        Return the ids of a page of albums, as getAlbumList lists them
+        :param list_type: one of ALBUM_LIST_TYPES
+        :param from_year: first year for byYear, lists run backwards when it's after `to_year`
+        :param genre: genre name for byGenre
+        :param starred: album ids the user starred, for starred
+        """
+        data, ops = self.data, self.ops
+        count = len(data.album_id)
+        if list_type == "random":
+            return ops.tolist(ops.gather(data.album_id, random.sample(range(count), min(size, count))))
+        elif list_type == "newest":
+            rows = ops.sort(ops.rows(count), data.album_added, reverse=True)
+        elif list_type == "alphabeticalByName":
+            rows = data.by_name
+        elif list_type == "alphabeticalByArtist":
+            rows = data.by_artist
+        elif list_type == "frequent":
+            rows = ops.sort(ops.rows(count), data.album_plays, reverse=True)
+        elif list_type == "recent":
+            rows = ops.sort(ops.rows(count), data.album_played, reverse=True)
+        elif list_type == "starred":
+            rows = ops.subset(data.by_name, [row for row in (self.row(data.album_index, album_id)
+                                                             for album_id in starred) if row >= 0], count)
+        elif list_type == "byYear":
+            from_year, to_year = int(from_year or 0), int(to_year or MAX_YEAR)
+            rows = ops.between(data.album_year, min(from_year, to_year), max(from_year, to_year), data.by_name)
+            rows = ops.sort(rows, data.album_year, reverse=from_year > to_year)
+        elif list_type == "byGenre":
+            genre_id = data.genres.get(genre)
+            if genre_id is None:
+                return []
+            song_rows = ops.equal(data.song_genre, genre_id, ops.rows(len(data.song_id)))
+            rows = ops.subset(data.by_name, ops.gather(data.album_index, ops.gather(data.song_album, song_rows)),
+                              count)
+        else:
+            raise ValueError("Unknown album list type: {}".format(list_type))
+        return ops.tolist(ops.gather(data.album_id, rows[offset:offset + size]))
+
+    def random_songs(self, size, genre=None, from_year=None, to_year=None):
+        """
+        Return the ids of up to `size` random songs, optionally of a genre or released between two years
+        """
+        data, ops = self.data, self.ops
+        rows = ops.rows(len(data.song_id))
+        if genre:
+            genre_id = data.genres.get(genre)
+            if genre_id is None:
+                return []
+            rows = ops.equal(data.song_genre, genre_id, rows)
+        if from_year or to_year:
+            rows = ops.between(data.song_year, int(from_year or 0), int(to_year or MAX_YEAR), rows)
+        picks = ops.gather(rows, random.sample(range(len(rows)), min(size, len(rows))))
+        return ops.tolist(ops.gather(data.song_id, picks))
+
+    def nbytes(self):
+        return self.data.nbytes()
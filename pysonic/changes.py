@@ -0,0 +1,77 @@
+import os
+import json
+import sqlite3
+import logging
+from time import time
+from threading import Thread, Lock, Event
+
+
+logging = logging.getLogger("changes")
+
+
+class PysonicChangeBus(object):
+    def __init__(self, path, interval=1, keep=600):
+        """
+        Tells the other server processes sharing a database which of their cached library data went stale. Changes
+        are appended to the changes table; each process polls for rows written by other processes and passes them to
+        its subscribers. Polling is a PRAGMA data_version check unless the database was written to.
+        :param path: path to the sqlite database
+        :param interval: seconds between polls
+        :param keep: seconds to keep published changes for
+        """
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.interval = interval
+        self.keep = keep
+        self.pid = os.getpid()
+        self.lock = Lock()
+        self.subscribers = []
+        self.stopped = Event()
+        self.thread = None
+        self.data_version = None
+        self.last_id = self.db.execute("SELECT IFNULL(MAX(id), 0) FROM changes").fetchone()[0]
+
+    def subscribe(self, callback):
+        """
+        :param callback: called as callback(kind, item_ids) for each change published by another process
+        """
+        self.subscribers.append(callback)
+
+    def publish(self, kind, item_ids=None):
+        with self.lock:
+            now = int(time())
+            self.db.execute("INSERT INTO changes (pid, kind, items, time) VALUES (?, ?, ?, ?)",
+                            (self.pid, kind, json.dumps(item_ids), now))
+            self.db.execute("DELETE FROM changes WHERE time < ?", (now - self.keep, ))
+            self.db.commit()
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True, name="changes")
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("failed to read library changes")
+
+    def poll(self):
+        with self.lock:
+            data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self.data_version:
+                return
+            self.data_version = data_version
+            rows = self.db.execute("SELECT id, pid, kind, items FROM changes WHERE id > ? ORDER BY id",
+                                   (self.last_id, )).fetchall()
+        for change_id, pid, kind, items in rows:
+            self.last_id = change_id
+            if pid == self.pid:
+                continue
+            logging.info("applying %s change from process %s", kind, pid)
+            for callback in self.subscribers:
+                callback(kind, json.loads(items))
@@ -1,15 +1,27 @@
 import os
+import socket
+import signal
 import logging
 import cherrypy
+from time import sleep
 from sqlite3 import DatabaseError
-from pysonic.api import PysonicSubsonicApi
+from cherrypy.process.servers import ServerAdapter
+from pysonic.api import PysonicSubsonicApi, PysonicStatus
+from pysonic.auth import PysonicAuth
+from pysonic.writebehind import PysonicWriteBehind
 from pysonic.library import PysonicLibrary
+from pysonic.scanner import PysonicScanThrottle, BUSY_IOPS
+from pysonic.walker import ROOT_WALKERS
 from pysonic.database import PysonicDatabase, DuplicateRootException
+from pysonic.streaming import StreamEngine, StreamGateway, raise_fd_limit
+from pysonic.transcode import PROFILES, RAW_FORMAT, PACE_BURST, PysonicTranscodeStore, PysonicTranscodeBroker, \
+    PysonicPrefetcher
+from pysonic.changes import PysonicChangeBus
+from pysonic.profiling import PysonicRequestProfiler, PROFILE_PARAM
 
 
 def main():
     import argparse
-    import signal
 
     parser = argparse.ArgumentParser(description="Pysonic music streaming server")
 
@@ -19,53 +31,209 @@ def main():
                         help="user:password pairs for auth")
     parser.add_argument('--disable-auth', action="store_true", help="disable authentication")
     parser.add_argument('-s', '--database-path', default="./db.sqlite", help="path to persistent sqlite database")
-    parser.add_argument('--debug', action="store_true", help="enable development options")
+    parser.add_argument('--debug', action="store_true",
+                        help="enable development options, and profiling of requests that pass {}=1 or {}=cprofile"
+                             .format(PROFILE_PARAM, PROFILE_PARAM))
+    parser.add_argument('--profile-dir', help="where to write cProfile dumps of profiled requests (default: 'profiles' "
+                                              "next to the database)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of server processes to fork. They share the database, and only the first one "
+                             "scans the library")
 
     group = parser.add_argument_group("app options")
     group.add_argument("--skip-transcode", action="store_true", help="instead of trancoding mp3s, send as-is")
     group.add_argument("--no-rescan", action="store_true", help="don't perform simple scan on startup")
+    group.add_argument("--scan-delay", type=float, default=10,
+                       help="seconds after startup to wait before scanning the library")
+    group.add_argument("--scan-nice", type=int, default=10, help="cpu niceness of the library scan")
+    group.add_argument("--scan-walkers", type=int, default=ROOT_WALKERS,
+                       help="directories of each library root to list at once while scanning")
+    group.add_argument("--scan-iops", type=int, default=0,
+                       help="reads per second the metadata scan may make, 0 for no limit")
+    group.add_argument("--scan-bandwidth", type=int, default=0,
+                       help="kilobytes per second the metadata scan may read, 0 for no limit")
+    group.add_argument("--scan-busy-iops", type=int, default=BUSY_IOPS,
+                       help="reads per second the metadata scan is held to while media is being streamed")
     group.add_argument("--deep-rescap", action="store_true", help="perform deep scan (read id3 etc)")
     group.add_argument("--enable-prune", action="store_true", help="enable removal of media not found on disk")
     group.add_argument("--max-bitrate", type=int, default=320, help="maximum send bitrate")
     group.add_argument("--enable-cors", action="store_true", help="add response headers to allow cors")
+    group.add_argument("--no-catalog", action="store_true",
+                       help="answer album lists and random songs from the database instead of in-memory columns")
+    group.add_argument("--similarity-interval", type=float, default=24,
+                       help="hours between rebuilds of the similar artists and songs lists, 0 to disable")
+    group.add_argument("--flush-interval", type=int, default=30,
+                       help="seconds between writes of buffered scrobbles and play queues. With --workers play "
+                            "queues are written at once")
+    group.add_argument("--no-stream-engine", action="store_true",
+                       help="stream media from the http worker threads instead of the streaming engine")
+    group.add_argument("--stream-stall-timeout", type=int, default=300,
+                       help="seconds a stream may make no progress before it is dropped")
+    group.add_argument("--transcode-pace", type=float, default=4,
+                       help="multiple of real time to transcode streams at once the first {}s are sent, 0 for no "
+                            "limit".format(PACE_BURST))
+    group.add_argument("--transcode-dir", help="where to store transcoded files (default: 'transcodes' next to the "
+                                               "database)")
+    group.add_argument("--transcode-cache-size", type=int, default=2048,
+                       help="megabytes of transcoded files to keep")
+    group.add_argument("--prefetch", type=int, default=2,
+                       help="number of upcoming tracks per user to transcode ahead of time, 0 to disable")
+    group.add_argument("--prefetch-cpu", type=float, default=0.5,
+                       help="cpu cores prefetch transcoding may use on average")
+    group.add_argument("--hls-segment", type=int, default=10, help="length in seconds of HLS segments")
+    group.add_argument("--default-format", default="mp3", choices=sorted(PROFILES),
+                       help="transcoding profile used when a request doesn't ask for one")
+    group.add_argument("--format-for", nargs="+", type=lambda x: x.split("="), default=[],
+                       help="name=format pairs choosing a transcoding profile per username or client name; format may "
+                            "be {} or {}".format(", ".join(sorted(PROFILES)), RAW_FORMAT))
 
     args = parser.parse_args()
+    args.format_for = dict(args.format_for)
 
     logging.basicConfig(level=logging.INFO if args.debug else logging.WARNING,
                         format="%(asctime)-15s %(levelname)-8s %(filename)s:%(lineno)d %(message)s")
 
-    db = PysonicDatabase(path=args.database_path)
-    library = PysonicLibrary(db)
+    db = PysonicDatabase(path=args.database_path, profile=args.debug)
+    library = PysonicLibrary(db, catalog=not args.no_catalog)
     for dirname in args.dirs:
         assert os.path.exists(dirname) and dirname.startswith("/"), "--dirs must be absolute paths and exist!"
         try:
             library.add_root_dir(dirname)
         except DuplicateRootException:
             pass
-    library.update()
 
+    auth = PysonicAuth(db)
     for username, password in args.user:
         try:
-            db.add_user(username, password)
+            auth.add_user(username, password)
         except DatabaseError:
-            db.update_user(username, password)
+            auth.update_user(username, password)
 
     # logging.warning("Libraries: {}".format([i["name"] for i in library.get_libraries()]))
     # logging.warning("Artists: {}".format([i["name"] for i in library.get_artists()]))
     # logging.warning("Albums: {}".format(len(library.get_albums())))
 
-    api = PysonicSubsonicApi(db, library, args)
+    args.profile_dir = args.profile_dir or \
+        os.path.join(os.path.dirname(os.path.abspath(args.database_path)), "profiles")
+    args.transcode_dir = args.transcode_dir or \
+        os.path.join(os.path.dirname(os.path.abspath(args.database_path)), "transcodes")
+
+    if args.workers <= 1:
+        serve(args, db, library, auth)
+        return
+
+    PysonicTranscodeStore(args.transcode_dir, max_bytes=args.transcode_cache_size * 1024 * 1024)  # clears partials
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', args.port))
+    listener.listen(1024)
+    db.db.close()  # sqlite connections must not cross a fork, each worker opens its own
+
+    def start_worker(worker):
+        db.open()
+        serve(args, db, library, auth, worker, listener)
+
+    run_workers(args.workers, start_worker)
+
+
+def run_workers(count, start_worker):
+    """
+    Fork `count` server processes and restart any that die, until a signal tells us to stop
+    :param start_worker: called in the new process with the worker's number
+    """
+    children = {}  # pid -> worker number
+    stopping = []
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                start_worker(worker)
+            except BaseException:
+                logging.exception("worker %s failed", worker)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = worker
+        logging.warning("started worker %s as pid %s", worker, pid)
+
+    def signal_handler(signum, stack):
+        logging.critical('Got sig {}, stopping workers...'.format(signum))
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    for worker in range(count):
+        spawn(worker)
+    while children:
+        pid, status = os.wait()
+        worker = children.pop(pid, None)
+        if worker is not None and not stopping:
+            logging.error("worker %s exited with status %s, restarting it", worker, status)
+            sleep(1)
+            spawn(worker)
+
+
+def serve_from(listener):
+    """
+    Make cherrypy accept connections from a socket the worker processes share instead of binding its own. The stock
+    server adapter is swapped out because it waits for the port to be free before starting and after stopping.
+    """
+    httpserver = cherrypy.server.httpserver
+
+    def bind(family, type, proto=0):
+        httpserver.socket = listener
+        return listener
+
+    httpserver.bind = bind
+    cherrypy.server.unsubscribe()
+    ServerAdapter(cherrypy.engine, httpserver).subscribe()
+
+
+def serve(args, db, library, auth, worker=0, listener=None):
+    """
+    Run the http server until a signal stops it
+    :param worker: number of this server process, the first one scans the library
+    :param listener: listening socket shared with other server processes
+    """
+    bus = None
+    if listener:
+        bus = PysonicChangeBus(args.database_path)
+        bus.subscribe(lambda kind, item_ids: library.invalidate(kind, item_ids, publish=False))
+        library.bus = bus
+        bus.start()
+
+    writer = PysonicWriteBehind(db, interval=args.flush_interval,
+                                on_write=lambda song_ids: library.invalidate("plays", song_ids), bus=bus)
+    if bus:
+        bus.subscribe(writer.apply_change)
+    writer.start()
+
+    transcodes = PysonicTranscodeStore(args.transcode_dir, max_bytes=args.transcode_cache_size * 1024 * 1024,
+                                       clean=listener is None)
+    prefetcher = None
+    if args.prefetch > 0 and args.prefetch_cpu > 0:
+        prefetcher = PysonicPrefetcher(library, transcodes, writer, auth, args, depth=args.prefetch,
+                                       cpu_budget=args.prefetch_cpu)
+        prefetcher.start()
+
+    broker = PysonicTranscodeBroker(transcodes, pace=args.transcode_pace or None, burst=PACE_BURST,
+                                    stall_timeout=args.stream_stall_timeout)
+    api = PysonicSubsonicApi(db, library, args, auth, writer, transcodes, broker, prefetcher)
     api_config = {}
     if args.disable_auth:
         logging.warning("starting up with auth disabled")
     else:
-        def validate_password(realm, username, password):
-            print("I JUST VALIDATED {}:{} ({})".format(username, password, realm))
-            return True
-
-        api_config.update({'tools.auth_basic.on': True,
-                           'tools.auth_basic.realm': 'pysonic',
-                           'tools.auth_basic.checkpassword': validate_password})
+        cherrypy.tools.subsonic_auth = cherrypy.Tool('before_handler', auth.check_request)
+        api_config.update({'tools.subsonic_auth.on': True})
+    if args.debug:
+        api_config.update(PysonicRequestProfiler(args.profile_dir).install())
     if args.enable_cors:
         def cors():
             cherrypy.response.headers["Access-Control-Allow-Origin"] = "*"
@@ -73,6 +241,7 @@ def main():
         api_config.update({'tools.cors.on': True})
 
     cherrypy.tree.mount(api, '/rest/', {'/': api_config})
+    cherrypy.tree.mount(PysonicStatus(library), '/')
 
     cherrypy.config.update({
         'sessionFilter.on': True,
@@ -87,9 +256,21 @@ def main():
         'server.show_tracebacks': True,
         'server.socket_timeout': 5,
         'log.screen': False,
-        'engine.autoreload.on': args.debug
+        'engine.autoreload.on': args.debug and not listener  # re-executing would orphan the other workers
     })
 
+    cherrypy.server.httpserver, _ = cherrypy.server.httpserver_from_self()
+    if listener:
+        serve_from(listener)
+
+    streamer = None
+    if not args.no_stream_engine:
+        logging.info("fd limit raised to %s", raise_fd_limit())
+        streamer = StreamEngine(stall_timeout=args.stream_stall_timeout)
+        StreamGateway.engine = streamer
+        cherrypy.server.httpserver.gateway = StreamGateway
+        streamer.start()
+
     def signal_handler(signum, stack):
         logging.critical('Got sig {}, exiting...'.format(signum))
         cherrypy.engine.exit()
@@ -99,10 +280,26 @@ def main():
 
     try:
         cherrypy.engine.start()
+        # Clients are served from the existing database while the library loads and rescans in the background
+        throttle = PysonicScanThrottle(iops=args.scan_iops, bandwidth=args.scan_bandwidth * 1024,
+                                       busy_iops=args.scan_busy_iops,
+                                       streams=(lambda: len(streamer.sessions)) if streamer else None)
+        library.update(scan=worker == 0 and not args.no_rescan, delay=args.scan_delay, nice=args.scan_nice,
+                       throttle=throttle, walkers=args.scan_walkers)
+        if worker == 0 and args.similarity_interval > 0:
+            library.similarity.start(args.similarity_interval * 3600)
         cherrypy.engine.block()
     finally:
         logging.info("API has shut down")
         cherrypy.engine.exit()
+        writer.stop()
+        library.similarity.stop()
+        if prefetcher:
+            prefetcher.stop()
+        if streamer:
+            streamer.stop()
+        if bus:
+            bus.stop()
 
 
 if __name__ == '__main__':
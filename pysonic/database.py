@@ -1,19 +1,186 @@
+import os
 import sqlite3
 import logging
-from hashlib import sha512
+from hashlib import sha512, pbkdf2_hmac
+from hmac import compare_digest
 from time import time
 from contextlib import closing
-from collections import Iterable
+from bisect import bisect_left
+from collections import defaultdict, deque
+from collections.abc import Iterable
+from pysonic.profiling import ProfilingConnection
 
 logging = logging.getLogger("database")
 keys_in_table = ["title", "album", "artist", "type", "size"]
 
+PLAYLIST_GAP = 1024.0  # spacing between order keys of appended playlist entries
+PLAYLIST_MIN_GAP = 1e-6  # neighbours closer than this get renumbered before inserting between them
+ALBUM_YEAR = "(SELECT MAX(year) FROM songs WHERE albumid = alb.id)"  # albums are dated by their latest song
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+
+def playlist_gap_keys(low, high, count):
+    """
+    Return `count` ascending playlist order keys between `low` and `high`, either of which may be None for the ends of
+    the list, or None if the gap is too narrow
+    """
+    if high is None:
+        return [(low or 0.0) + PLAYLIST_GAP * (i + 1) for i in range(count)]
+    if low is None:
+        return [high - PLAYLIST_GAP * (count - i) for i in range(count)]
+    step = (high - low) / (count + 1)
+    if step < PLAYLIST_MIN_GAP:
+        return None
+    return [low + step * (i + 1) for i in range(count)]
+
+
+def longest_increasing(values):
+    """
+    Return the indexes of a longest strictly increasing subsequence of `values`
+    """
+    tails = []  # tails[n]: index of the smallest value ending an increasing run of length n + 1
+    tail_values = []
+    previous = [None] * len(values)
+    for index, value in enumerate(values):
+        length = bisect_left(tail_values, value)
+        previous[index] = tails[length - 1] if length else None
+        if length == len(tails):
+            tails.append(index)
+            tail_values.append(value)
+        else:
+            tails[length] = index
+            tail_values[length] = value
+    indexes = []
+    index = tails[-1] if tails else None
+    while index is not None:
+        indexes.append(index)
+        index = previous[index]
+    return indexes[::-1]
+
+
+# Schema changes applied on top of the version 1 schema created in PysonicDatabase.migrate(). Entry N upgrades a
+# database from version N + 1 to N + 2.
+migrations = [
+    # 2: play statistics and saved play queues
+    ["""ALTER TABLE 'songs' ADD COLUMN 'played' INTEGER""",
+     """ALTER TABLE 'songs' ADD COLUMN 'plays' INTEGER NOT NULL DEFAULT 0""",
+     """CREATE TABLE 'playqueues' (
+            'userid'    INTEGER PRIMARY KEY NOT NULL,
+            'songs'     TEXT,  -- comma separated song ids
+            'current'   INTEGER,
+            'position'  INTEGER,
+            'changed'   INTEGER,
+            'changedby' TEXT)"""],
+    # 3: ordered playlist entries and cached playlist summaries
+    ["""CREATE INDEX 'playlist_entries_order' ON 'playlist_entries' ('playlistid', 'order')""",
+     """UPDATE playlist_entries SET "order" = rowid * 1024.0 WHERE "order" IS NULL""",
+     """ALTER TABLE 'playlists' ADD COLUMN 'songcount' INTEGER NOT NULL DEFAULT 0""",
+     """ALTER TABLE 'playlists' ADD COLUMN 'duration' INTEGER NOT NULL DEFAULT 0""",
+     """UPDATE playlists SET
+            songcount=(SELECT COUNT(*) FROM playlist_entries WHERE playlistid=playlists.id),
+            duration=(SELECT IFNULL(SUM(s.length), 0) FROM playlist_entries AS pe
+                      INNER JOIN songs AS s ON s.id = pe.songid WHERE pe.playlistid=playlists.id)"""],
+    # 4: stars for albums and artists as well as songs
+    ["""CREATE TABLE 'starred' (
+            'userid'    INTEGER NOT NULL,
+            'itemtype'  TEXT NOT NULL,  -- song, album or artist
+            'itemid'    INTEGER NOT NULL,
+            'starred'   INTEGER NOT NULL,
+            PRIMARY KEY ('userid', 'itemtype', 'itemid'))""",
+     """INSERT INTO starred (userid, itemtype, itemid, starred)
+            SELECT userid, 'song', songid, CAST(strftime('%s', 'now') AS INTEGER) FROM stars""",
+     """DROP TABLE stars"""],
+    # 5: checksums of song files, used to build zip downloads without reading the files
+    ["""CREATE TABLE 'checksums' (
+            'songid'    INTEGER PRIMARY KEY NOT NULL,
+            'size'      INTEGER NOT NULL,
+            'mtime'     INTEGER NOT NULL,
+            'crc32'     INTEGER NOT NULL)"""],
+    # 6: cache invalidations passed between server processes, see PysonicChangeBus
+    ["""CREATE TABLE 'changes' (
+            'id'        INTEGER PRIMARY KEY AUTOINCREMENT,
+            'pid'       INTEGER NOT NULL,
+            'kind'      TEXT NOT NULL,
+            'items'     TEXT,  -- json list of ids
+            'time'      INTEGER NOT NULL)"""],
+    # 7: nearest neighbours of artists and songs, see PysonicSimilarity
+    ["""CREATE TABLE 'similar' (
+            'itemtype'  TEXT NOT NULL,  -- song or artist
+            'itemid'    INTEGER NOT NULL,
+            'similarid' INTEGER NOT NULL,
+            'score'     REAL NOT NULL,
+            PRIMARY KEY ('itemtype', 'itemid', 'similarid'))"""],
+]
+
+
+class Row(tuple):
+    """
+    A result row. Subclasses are generated per query shape by row_class() and map column names to tuple positions, so
+    a row costs little more than the tuple sqlite3 builds anyway. Rows support the parts of the dict interface pysonic
+    uses. Keys that aren't columns may be added and are kept in the instance dict; columns are read-only.
+    """
+    _index = {}
+
+    def __getitem__(self, key):
+        index = self._index.get(key)
+        if index is None:
+            return self.__dict__[key]
+        return tuple.__getitem__(self, index)
+
+    def __setitem__(self, key, value):
+        if key in self._index:
+            raise TypeError("column '{}' is read-only".format(key))
+        self.__dict__[key] = value
+
+    def __contains__(self, key):
+        return key in self._index or key in self.__dict__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._index) + list(self.__dict__)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+_row_classes = {}
+_columns = (None, Row)  # (cursor.description, row class) of the last query shape seen by row_factory
+
+
+def row_class(names):
+    """
+    Return the Row subclass for a tuple of column names
+    """
+    cls = _row_classes.get(names)
+    if cls is None:
+        cls = _row_classes.setdefault(names, type("Row", (Row, ), {"_index": {name: index for index, name
+                                                                             in enumerate(names)}}))
+    return cls
+
+
+def row_factory(cursor, row):
+    """
+    sqlite3 hands out the same description object for every row of a statement, so the row class is only looked up
+    when the statement changes. Holding a reference to the description means its identity can't be reused by another
+    statement.
+    """
+    global _columns
+    description, cls = _columns
+    if description is not cursor.description:
+        description = cursor.description
+        cls = row_class(tuple(col[0] for col in description))
+        _columns = (description, cls)
+    return cls(row)
 
 
 class NotFoundError(Exception):
@@ -24,8 +191,27 @@ class DuplicateRootException(Exception):
     pass
 
 
-def hash_password(unicode_string):
-        return sha512(unicode_string.encode('UTF-8')).hexdigest()
+PASSWORD_ITERATIONS = 100000
+
+
+def hash_password(unicode_string, salt=None, iterations=PASSWORD_ITERATIONS):
+    """
+    Return a salted pbkdf2 hash of the password, formatted as algorithm$iterations$salt$hash
+    """
+    salt = salt or os.urandom(16).hex()
+    digest = pbkdf2_hmac("sha512", unicode_string.encode('UTF-8'), salt.encode('UTF-8'), iterations).hex()
+    return "pbkdf2_sha512${}${}${}".format(iterations, salt, digest)
+
+
+def check_password(stored, unicode_string):
+    """
+    Check a password against a hash produced by hash_password. Unsalted sha512 hashes written by older versions are
+    still accepted.
+    """
+    if "$" not in stored:
+        return compare_digest(stored, sha512(unicode_string.encode('UTF-8')).hexdigest())
+    _, iterations, salt, _ = stored.split("$")
+    return compare_digest(stored, hash_password(unicode_string, salt, int(iterations)))
 
 
 def readcursor(func):
@@ -42,17 +228,51 @@ def readcursor(func):
     return wrapped
 
 
+def itercursor(func):
+    """
+    Like readcursor, for generator methods. A cursor created here stays open until the generator is exhausted or
+    closed.
+    """
+    def wrapped(*args, **kwargs):
+        self = args[0]
+        if len(args) >= 2 and isinstance(args[1], sqlite3.Cursor):
+            return func(*args, **kwargs)
+        return _iter_with_cursor(func, self, args[1:], kwargs)
+    return wrapped
+
+
+def _iter_with_cursor(func, self, args, kwargs):
+    with closing(self.db.cursor()) as cursor:
+        yield from func(self, cursor, *args, **kwargs)
+
+
 class PysonicDatabase(object):
-    def __init__(self, path):
-        self.sqlite_opts = dict(check_same_thread=False)
+    def __init__(self, path, profile=False):
+        """
+        :param profile: record the statements run on behalf of requests being profiled, see pysonic.profiling
+        """
+        self.sqlite_opts = dict(check_same_thread=False, timeout=30)
+        if profile:
+            self.sqlite_opts["factory"] = ProfilingConnection
         self.path = path
         self.db = None
         self.open()
         self.migrate()
 
     def open(self):
-        self.db = sqlite3.connect(self.path, **self.sqlite_opts)
-        self.db.row_factory = dict_factory
+        self.db = self.connect()
+        # WAL lets readers in other processes carry on while one writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+    def connect(self):
+        """
+        Return a new connection to the database, for long reads that shouldn't hold a transaction open on the shared
+        connection
+        """
+        db = sqlite3.connect(self.path, **self.sqlite_opts)
+        db.row_factory = row_factory
+        return db
 
     def migrate(self):
         # Create db
@@ -143,11 +363,15 @@ class PysonicDatabase(object):
                 for query in queries:
                     cursor.execute(query)
                 cursor.execute("COMMIT")
-            else:
-                # Migrate if old db exists
-                # cursor.execute("""UPDATE meta SET value=? WHERE key="db_version";""", (str(version), ))
-                # logging.warning("db schema is version {}".format(version))
-                pass
+
+            # Migrate if old db exists
+            version = int(cursor.execute("SELECT value FROM meta WHERE key='db_version'").fetchone()['value'])
+            for target, migration in enumerate(migrations[version - 1:], start=version + 1):
+                logging.warning("migrating db schema to version {}".format(target))
+                for query in migration:
+                    cursor.execute(query)
+                cursor.execute("""UPDATE meta SET value=? WHERE key="db_version";""", (str(target), ))
+                cursor.execute("COMMIT")
 
     @readcursor
     def get_stats(self, cursor):
@@ -172,6 +396,8 @@ class PysonicDatabase(object):
             cursor.execute("COMMIT")
             return cursor.lastrowid
         except sqlite3.IntegrityError:
+            # the failed insert leaves the shared connection's write transaction open, locking out other writers
+            cursor.execute("ROLLBACK")
             raise DuplicateRootException("Root '{}' already exists".format(path))
 
     @readcursor
@@ -191,15 +417,21 @@ class PysonicDatabase(object):
         return libs
 
     @readcursor
-    def get_artists(self, cursor, id=None, dirid=None, sortby=None, order=None):
+    def get_artists(self, cursor, *args, **kwargs):
+        return list(self.iter_artists(cursor, *args, **kwargs))
+
+    @itercursor
+    def iter_artists(self, cursor, id=None, dirid=None, sortby=None, order=None):
         assert order in ["asc", "desc", None]
-        artists = []
         q = "SELECT * FROM artists"
         params = []
         conditions = []
-        if id:
+        if id and isinstance(id, int):
             conditions.append("id = ?")
             params.append(id)
+        elif id and isinstance(id, Iterable):
+            conditions.append("id IN ({})".format(",".join("?" * len(id))))
+            params += id
         if dirid:
             conditions.append("dir = ?")
             params.append(dirid)
@@ -207,23 +439,26 @@ class PysonicDatabase(object):
             q += " WHERE " + " AND ".join(conditions)
         if sortby:
             q += " ORDER BY {} {}".format(sortby, order.upper() if order else "ASC")
-        cursor.execute(q, params)
-        for row in cursor:
-            artists.append(row)
-        return artists
+        yield from cursor.execute(q, params)
 
     @readcursor
-    def get_albums(self, cursor, id=None, artist=None, sortby=None, order=None, limit=None):
+    def get_albums(self, cursor, *args, **kwargs):
+        return list(self.iter_albums(cursor, *args, **kwargs))
+
+    @itercursor
+    def iter_albums(self, cursor, id=None, artist=None, sortby=None, order=None, limit=None, genre=None, years=None):
         """
         :param limit: int or tuple of int, int. translates directly to sql logic.
+        :param genre: genre name any of the album's songs must have
+        :param years: (first, last) years the album's latest song must be from
         """
         if order:
             order = {"asc": "ASC", "desc": "DESC"}[order]
 
         if sortby and sortby == "random":
             sortby = "RANDOM()"
-
-        albums = []
+        elif sortby == "year":
+            sortby = ALBUM_YEAR
 
         q = """
             SELECT
@@ -239,12 +474,22 @@ class PysonicDatabase(object):
         params = []
 
         conditions = []
-        if id:
-            conditions.append("id = ?")
+        if id and isinstance(id, int):
+            conditions.append("alb.id = ?")
             params.append(id)
+        elif id and isinstance(id, Iterable):
+            conditions.append("alb.id IN ({})".format(",".join("?" * len(id))))
+            params += id
         if artist:
             conditions.append("artistid = ?")
             params.append(artist)
+        if genre:
+            conditions.append("alb.id IN (SELECT s.albumid FROM songs as s INNER JOIN genres as g ON g.id = s.genre "
+                              "WHERE g.name = ?)")
+            params.append(genre)
+        if years:
+            conditions.append("{} BETWEEN ? AND ?".format(ALBUM_YEAR))
+            params += years
         if conditions:
             q += " WHERE " + " AND ".join(conditions)
 
@@ -257,28 +502,30 @@ class PysonicDatabase(object):
             q += " LIMIT {}".format(limit) if isinstance(limit, int) \
                 else " LIMIT {}, {}".format(*limit)
 
-        cursor.execute(q, params)
-        for row in cursor:
-            albums.append(row)
-        return albums
+        yield from cursor.execute(q, params)
 
     @readcursor
-    def get_songs(self, cursor, id=None, genre=None, sortby=None, order=None, limit=None):
-        # TODO make this query massively uglier by joining albums and artists so that artistid etc can be a filter
-        # or maybe lookup those IDs in the library layer?
+    def get_songs(self, cursor, *args, **kwargs):
+        return list(self.iter_songs(cursor, *args, **kwargs))
+
+    @itercursor
+    def iter_songs(self, cursor, id=None, genre=None, sortby=None, order=None, limit=None, albumid=None,
+                   artistid=None, years=None):
+        """
+        :param years: (first, last) years songs must be from
+        """
         if order:
             order = {"asc": "ASC", "desc": "DESC"}[order]
 
         if sortby and sortby == "random":
             sortby = "RANDOM()"
 
-        songs = []
-
         q = """
             SELECT
                 s.*,
                 alb.name as albumname,
                 alb.coverid as albumcoverid,
+                alb.artistid as artistid,
                 art.name as artistname,
                 g.name as genrename
             FROM songs as s
@@ -293,15 +540,19 @@ class PysonicDatabase(object):
         params = []
 
         conditions = []
-        if id and isinstance(id, int):
-            conditions.append("s.id = ?")
-            params.append(id)
-        elif id and isinstance(id, Iterable):
-            conditions.append("s.id IN ({})".format(",".join("?" * len(id))))
-            params += id
+        for column, value in [("s.id", id), ("alb.id", albumid), ("art.id", artistid)]:
+            if value and isinstance(value, int):
+                conditions.append("{} = ?".format(column))
+                params.append(value)
+            elif value and isinstance(value, Iterable):
+                conditions.append("{} IN ({})".format(column, ",".join("?" * len(value))))
+                params += value
         if genre:
             conditions.append("g.name = ?")
             params.append(genre)
+        if years:
+            conditions.append("s.year BETWEEN ? AND ?")
+            params += years
         if conditions:
             q += " WHERE " + " AND ".join(conditions)
 
@@ -313,10 +564,7 @@ class PysonicDatabase(object):
         if limit:
             q += " LIMIT {}".format(limit)  # TODO support limit pagination
 
-        cursor.execute(q, params)
-        for row in cursor:
-            songs.append(row)
-        return songs
+        yield from cursor.execute(q, params)
 
     @readcursor
     def get_genres(self, cursor, genre_id=None):
@@ -334,6 +582,13 @@ class PysonicDatabase(object):
             genres.append(row)
         return genres
 
+    @readcursor
+    def get_song_file(self, cursor, song_id):
+        """
+        Return just the columns needed to locate and serve a song's file, without the joins get_songs() does
+        """
+        return cursor.execute("SELECT id, library, file, format, bitrate FROM songs WHERE id=?", (song_id, )).fetchone()
+
     @readcursor
     def get_cover(self, cursor, coverid):
         cover = None
@@ -396,20 +651,161 @@ class PysonicDatabase(object):
     @readcursor
     def add_playlist(self, cursor, ownerid, name, song_ids, public=False):
         """
-        Create a playlist
+        Create a playlist. Returns the new playlist's id.
         """
         now = time()
         cursor.execute("INSERT INTO playlists (ownerid, name, public, created, changed) VALUES (?, ?, ?, ?, ?)",
                        (ownerid, name, public, now, now))
         plid = cursor.lastrowid
-        for song_id in song_ids:
-            self.add_to_playlist(cursor, plid, song_id)
+        self.add_to_playlist(cursor, plid, song_ids)
+        self.update_playlist_cover(cursor, plid)
         cursor.execute("COMMIT")
+        return plid
 
     @readcursor
-    def add_to_playlist(self, cursor, playlist_id, song_id):
-        # TODO deal with order column
-        cursor.execute("INSERT INTO playlist_entries (playlistid, songid) VALUES (?, ?)", (playlist_id, song_id))
+    def add_to_playlist(self, cursor, playlist_id, song_ids):
+        """
+        Append songs to a playlist, without committing. Entries are ordered by a fractional key, so appending reads only
+        the last key and reordering (see replace_playlist_songs()) rewrites only the entries that moved.
+        :param song_ids: list of song ids. Ids that don't exist are skipped.
+        """
+        lengths = {}
+        for row in cursor.execute("SELECT id, length FROM songs WHERE id IN ({})".format(",".join("?" * len(song_ids))),
+                                  song_ids):
+            lengths[row["id"]] = row["length"] or 0
+        song_ids = [int(i) for i in song_ids if int(i) in lengths]
+        if not song_ids:
+            return
+
+        last = cursor.execute("""SELECT MAX("order") AS last FROM playlist_entries WHERE playlistid=?""",
+                              (playlist_id, )).fetchone()["last"]
+        keys = playlist_gap_keys(last, None, len(song_ids))
+
+        cursor.executemany("""INSERT INTO playlist_entries (playlistid, songid, "order") VALUES (?, ?, ?)""",
+                           [(playlist_id, song_id, key) for song_id, key in zip(song_ids, keys)])
+        cursor.execute("UPDATE playlists SET songcount = songcount + ?, duration = duration + ? WHERE id=?",
+                       (len(song_ids), sum(lengths[i] for i in song_ids), playlist_id))
+
+    def _renumber_playlist(self, cursor, playlist_id):
+        """
+        Spread a playlist's order keys back out to PLAYLIST_GAP intervals
+        """
+        logging.info("renumbering playlist %s", playlist_id)
+        entries = [row["rowid"] for row in cursor.execute(
+            """SELECT rowid FROM playlist_entries WHERE playlistid=? ORDER BY "order" """, (playlist_id, ))]
+        cursor.executemany("""UPDATE playlist_entries SET "order"=? WHERE rowid=?""",
+                           [(PLAYLIST_GAP * (i + 1), entry) for i, entry in enumerate(entries)])
+
+    @readcursor
+    def remove_indexes_from_playlist(self, cursor, playlist_id, indexes):
+        """
+        Remove the entries at the given positions from a playlist, without committing. Positions refer to the playlist
+        as it was before any of them are removed.
+        """
+        indexes = sorted(set(int(i) for i in indexes))
+        if not indexes:
+            return
+        entries = cursor.execute("""SELECT pe.rowid AS entry, IFNULL(s.length, 0) AS length
+                                    FROM playlist_entries AS pe
+                                        LEFT JOIN songs AS s
+                                            ON s.id = pe.songid
+                                    WHERE pe.playlistid=?
+                                    ORDER BY pe."order"
+                                    LIMIT ?""", (playlist_id, indexes[-1] + 1)).fetchall()
+        removed = [entries[i] for i in indexes if i < len(entries)]
+        cursor.executemany("DELETE FROM playlist_entries WHERE rowid=?", [(row["entry"], ) for row in removed])
+        cursor.execute("UPDATE playlists SET songcount = songcount - ?, duration = duration - ? WHERE id=?",
+                       (len(removed), sum(row["length"] for row in removed), playlist_id))
+
+    @readcursor
+    def update_playlist(self, cursor, playlist_id, name=None, public=None, remove_indexes=None, add_song_ids=None):
+        """
+        Apply a batch of playlist edits in one transaction. Removals are applied before additions, which are appended.
+        """
+        if name is not None:
+            cursor.execute("UPDATE playlists SET name=? WHERE id=?", (name, playlist_id))
+        if public is not None:
+            cursor.execute("UPDATE playlists SET public=? WHERE id=?", (public, playlist_id))
+        if remove_indexes:
+            self.remove_indexes_from_playlist(cursor, playlist_id, remove_indexes)
+        if add_song_ids:
+            self.add_to_playlist(cursor, playlist_id, add_song_ids)
+        self.update_playlist_cover(cursor, playlist_id)
+        cursor.execute("COMMIT")
+
+    @readcursor
+    def replace_playlist_songs(self, cursor, playlist_id, song_ids):
+        """
+        Replace a playlist's entries in one transaction. The Subsonic API has no way to move an entry, so clients
+        reorder a playlist by replacing its songs with the same songs in a new order; that case only rewrites the order
+        keys of the entries that moved.
+        """
+        song_ids = [int(i) for i in song_ids]
+        entries = cursor.execute("""SELECT rowid, songid, "order" FROM playlist_entries WHERE playlistid=?
+                                    ORDER BY "order" """, (playlist_id, )).fetchall()
+        if sorted(song_ids) == sorted(entry["songid"] for entry in entries):
+            if not self._reorder_playlist(cursor, entries, song_ids):
+                self._renumber_playlist(cursor, playlist_id)
+                entries = cursor.execute("""SELECT rowid, songid, "order" FROM playlist_entries WHERE playlistid=?
+                                            ORDER BY "order" """, (playlist_id, )).fetchall()
+                self._reorder_playlist(cursor, entries, song_ids)
+        else:
+            cursor.execute("DELETE FROM playlist_entries WHERE playlistid=?", (playlist_id, ))
+            cursor.execute("UPDATE playlists SET songcount=0, duration=0 WHERE id=?", (playlist_id, ))
+            self.add_to_playlist(cursor, playlist_id, song_ids)
+        self.update_playlist_cover(cursor, playlist_id)
+        cursor.execute("COMMIT")
+
+    def _reorder_playlist(self, cursor, entries, song_ids):
+        """
+        Put a playlist's entries in the order of `song_ids`, a permutation of their songs, without committing. The
+        longest run of entries already in order keeps its keys and every other entry gets a key between its new
+        neighbours. Returns False, having written nothing, if a gap is too narrow to split.
+        :param entries: the playlist's rows in their current order
+        """
+        positions = defaultdict(deque)
+        for position, song_id in enumerate(song_ids):
+            positions[song_id].append(position)
+        targets = [positions[entry["songid"]].popleft() for entry in entries]
+        placed = [None] * len(entries)
+        for entry, target in zip(entries, targets):
+            placed[target] = entry
+
+        kept = set(targets[i] for i in longest_increasing(targets))
+        updates = []
+        low = None
+        run = []
+        for target, entry in enumerate(placed + [None]):
+            if entry is not None and target not in kept:
+                run.append(entry)
+                continue
+            high = entry["order"] if entry is not None else None
+            if run:
+                keys = playlist_gap_keys(low, high, len(run))
+                if keys is None:
+                    return False
+                updates.extend((key, moved["rowid"]) for key, moved in zip(keys, run))
+                run = []
+            low = high
+        cursor.executemany("""UPDATE playlist_entries SET "order"=? WHERE rowid=?""", updates)
+        return True
+
+    @readcursor
+    def update_playlist_cover(self, cursor, playlist_id):
+        """
+        Point the playlist's cover at the first entry's album cover and bump its changed time, without committing
+        """
+        cursor.execute("""UPDATE playlists SET changed=?, cover=(
+                              SELECT alb.coverid
+                              FROM playlist_entries AS pe
+                                  INNER JOIN songs AS s
+                                      ON s.id = pe.songid
+                                  INNER JOIN albums AS alb
+                                      ON alb.id = s.albumid
+                              WHERE pe.playlistid=?
+                              ORDER BY pe."order"
+                              LIMIT 1)
+                          WHERE id=?""", (time(), playlist_id, playlist_id))
 
     @readcursor
     def get_playlist(self, cursor, playlist_id):
@@ -424,7 +820,7 @@ class PysonicDatabase(object):
                 alb.name as albumname,
                 alb.coverid as albumcoverid,
                 art.name as artistname,
-                art.name as artistid,
+                art.id as artistid,
                 g.name as genrename
             FROM playlist_entries as pe
                 INNER JOIN songs as s
@@ -436,7 +832,7 @@ class PysonicDatabase(object):
                 LEFT JOIN genres as g
                     on s.genre == g.id
             WHERE pe.playlistid = ?
-            ORDER BY pe.'order' ASC;
+            ORDER BY pe."order" ASC;
         """
         for row in cursor.execute(q, (playlist_id, )):
             songs.append(row)
@@ -449,11 +845,6 @@ class PysonicDatabase(object):
             playlists.append(row)
         return playlists
 
-    @readcursor
-    def remove_index_from_playlist(self, cursor, playlist_id, index):
-        cursor.execute("DELETE FROM playlist_entries WHERE playlistid=? LIMIT ?, 1", (playlist_id, index, ))
-        cursor.execute("COMMIT")
-
     @readcursor
     def empty_playlist(self, cursor, playlist_id):
         #TODO combine with # TODO combine with
@@ -466,14 +857,40 @@ class PysonicDatabase(object):
         cursor.execute("COMMIT")
 
     @readcursor
-    def update_album_played(self, cursor, album_id, last_played=None):
-        cursor.execute("UPDATE albums SET played=? WHERE id=?", (last_played, album_id, ))
-        cursor.execute("COMMIT")
+    def apply_play_activity(self, cursor, song_plays, song_played, play_queues):
+        """
+        Write batched play activity in a single transaction. Album stats are derived from the songs' albums.
+        :param song_plays: dict of song id -> number of plays to add
+        :param song_played: dict of song id -> last played timestamp
+        :param play_queues: dict of user id -> (song id list, current song id, position, changed, changed by)
+        """
+        try:
+            cursor.executemany("UPDATE songs SET plays = plays + ? WHERE id=?",
+                               [(count, song_id) for song_id, count in song_plays.items()])
+            cursor.executemany("UPDATE albums SET plays = plays + ? WHERE id=(SELECT albumid FROM songs WHERE id=?)",
+                               [(count, song_id) for song_id, count in song_plays.items()])
+            cursor.executemany("UPDATE songs SET played = MAX(IFNULL(played, 0), ?) WHERE id=?",
+                               [(played, song_id) for song_id, played in song_played.items()])
+            cursor.executemany("UPDATE albums SET played = MAX(IFNULL(played, 0), ?) "
+                               "WHERE id=(SELECT albumid FROM songs WHERE id=?)",
+                               [(played, song_id) for song_id, played in song_played.items()])
+            cursor.executemany("INSERT OR REPLACE INTO playqueues "
+                               "(userid, songs, current, position, changed, changedby) VALUES (?, ?, ?, ?, ?, ?)",
+                               [(user_id, ",".join(str(i) for i in songs), current, position, changed, changedby)
+                                for user_id, (songs, current, position, changed, changedby) in play_queues.items()])
+            cursor.execute("COMMIT")
+        except Exception:
+            # undo what did run, or the next commit on the shared connection would write it with the batch requeued
+            if cursor.connection.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
 
     @readcursor
-    def increment_album_plays(self, cursor, album_id):
-        cursor.execute("UPDATE albums SET plays = plays + 1 WHERE id=?", (album_id, ))
-        cursor.execute("COMMIT")
+    def get_play_queue(self, cursor, user_id):
+        queue = cursor.execute("SELECT * FROM playqueues WHERE userid=?", (user_id, )).fetchone()
+        if queue:
+            queue = dict(queue.items(), songs=[int(i) for i in queue["songs"].split(",") if i])
+        return queue
 
     # User related
     @readcursor
@@ -488,6 +905,67 @@ class PysonicDatabase(object):
                        (hash_password(password), is_admin, username))
         cursor.execute("COMMIT")
 
+    @readcursor
+    def get_users(self, cursor):
+        return cursor.execute("SELECT * FROM users").fetchall()
+
+    @readcursor
+    def get_starred(self, cursor, user_id):
+        """
+        Return all of a user's starred items as rows of itemtype, itemid and starred (unix timestamp)
+        """
+        return cursor.execute("SELECT itemtype, itemid, starred FROM starred WHERE userid=?", (user_id, )).fetchall()
+
+    @readcursor
+    def set_starred(self, cursor, user_id, itemtype, item_ids, starred=None):
+        """
+        Star or unstar items of one type for a user
+        :param itemtype: song, album or artist
+        :param starred: unix timestamp to star the items at, or None to unstar them
+        """
+        if starred:
+            cursor.executemany("INSERT OR IGNORE INTO starred (userid, itemtype, itemid, starred) VALUES (?, ?, ?, ?)",
+                               [(user_id, itemtype, item_id, starred) for item_id in item_ids])
+        else:
+            cursor.executemany("DELETE FROM starred WHERE userid=? AND itemtype=? AND itemid=?",
+                               [(user_id, itemtype, item_id) for item_id in item_ids])
+        cursor.execute("COMMIT")
+
+    @readcursor
+    def get_checksums(self, cursor, song_ids):
+        """
+        Return {song id: (size, mtime, crc32)} for the songs whose files have been checksummed
+        """
+        checksums = {}
+        for row in cursor.execute("SELECT * FROM checksums WHERE songid IN ({})".format(",".join("?" * len(song_ids))),
+                                  list(song_ids)):
+            checksums[row["songid"]] = (row["size"], row["mtime"], row["crc32"])
+        return checksums
+
+    @readcursor
+    def set_checksums(self, cursor, checksums):
+        """
+        :param checksums: {song id: (size, mtime, crc32)}
+        """
+        cursor.executemany("REPLACE INTO checksums (songid, size, mtime, crc32) VALUES (?, ?, ?, ?)",
+                           [(song_id, ) + tuple(values) for song_id, values in checksums.items()])
+        cursor.execute("COMMIT")
+
+    @readcursor
+    def get_similar(self, cursor, itemtype, item_id, limit=None):
+        """
+        Return an artist's or song's neighbours as rows of similarid and score, closest first
+        """
+        q = "SELECT similarid, score FROM similar WHERE itemtype=? AND itemid=? ORDER BY score DESC"
+        if limit:
+            q += " LIMIT {}".format(int(limit))
+        return cursor.execute(q, (itemtype, item_id)).fetchall()
+
+    @readcursor
+    def get_meta(self, cursor, key):
+        row = cursor.execute("SELECT value FROM meta WHERE key=?", (key, )).fetchone()
+        return row["value"] if row else None
+
     @readcursor
     def get_user(self, cursor, user):
         try:
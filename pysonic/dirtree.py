@@ -0,0 +1,161 @@
+import logging
+from array import array
+from threading import Lock
+from contextlib import closing
+from pysonic.database import NotFoundError
+
+
+logging = logging.getLogger("dirtree")
+
+DIR_OTHER = 0
+DIR_ARTIST = 1
+DIR_ALBUM = 2
+
+SONG_COLUMNS = ["id", "albumid", "title", "format", "length", "size", "bitrate", "track", "year", "file"]
+
+
+class PysonicDirTree(object):
+    def __init__(self, db):
+        """
+        In-memory copy of the dirs hierarchy and of which artist, album and songs each dir holds, used to answer
+        getMusicDirectory without going to the database. Per-dir data lives in integer arrays indexed by dir id; an
+        artist's albums and an album's songs are arrays of ids. Arrays of children are replaced rather than modified so
+        readers never take a lock. The tree is built with rebuild() on startup and after each full scan, and kept
+        current in between by the scanner calling update() as it commits.
+        """
+        self.db = db
+        self.lock = Lock()
+        self.ready = False
+        self.clear()
+
+    def clear(self):
+        self.dir_parent = array("l")
+        self.dir_kind = array("b")
+        self.dir_entity = array("l")  # artist or album id
+        self.artists = {}  # id -> (name, dir id)
+        self.albums = {}  # id -> (name, dir id, artist id, cover id)
+        self.artist_albums = {}  # artist id -> array of album ids
+        self.album_songs = {}  # album id -> array of song ids, in track order
+        self.songs = {}  # id -> row of SONG_COLUMNS
+
+    def rebuild(self):
+        """
+        Load the whole tree from the database. The new tree is built on the side and swapped in, so lookups made
+        meanwhile are answered from the old one.
+        """
+        with self.lock:
+            fresh = PysonicDirTree(self.db)
+            with closing(self.db.connect()) as conn, closing(conn.cursor()) as cursor:
+                for row in cursor.execute("SELECT id, parent FROM dirs"):
+                    fresh._set_dir(row["id"], row["parent"], DIR_OTHER, 0)
+                fresh._load(cursor, "")
+            self.dir_parent, self.dir_kind, self.dir_entity = fresh.dir_parent, fresh.dir_kind, fresh.dir_entity
+            self.artists, self.albums, self.songs = fresh.artists, fresh.albums, fresh.songs
+            self.artist_albums, self.album_songs = fresh.artist_albums, fresh.album_songs
+            self.ready = True
+        logging.info("dir tree holds %s dirs, %s albums and %s songs", len(self.dir_parent), len(self.albums),
+                     len(self.songs))
+
+    def update(self, album_ids):
+        """
+        Reload some albums along with their dirs, artists and songs
+        """
+        album_ids = list(set(album_ids) - {None})
+        if not album_ids or not self.ready:
+            return
+        with self.lock, closing(self.db.connect()) as conn, closing(conn.cursor()) as cursor:
+            params = ",".join("?" * len(album_ids))
+            for row in cursor.execute("""SELECT d.id, d.parent FROM dirs as d WHERE d.id IN (
+                                                 SELECT dir FROM albums WHERE id IN ({0}) UNION
+                                                 SELECT art.dir FROM artists as art
+                                                     INNER JOIN albums as alb ON alb.artistid = art.id
+                                                     WHERE alb.id IN ({0}))""".format(params),
+                                      album_ids + album_ids):
+                self._set_dir(row["id"], row["parent"], DIR_OTHER, 0)
+            self._load(cursor, "WHERE alb.id IN ({})".format(params), album_ids)
+
+    def _load(self, cursor, where, params=()):
+        """
+        Load albums matching `where`, with their artists and songs, into the tree
+        """
+        artist_ids = set()
+        album_ids = []
+        for row in cursor.execute("SELECT alb.id, alb.name, alb.dir, alb.artistid, alb.coverid FROM albums as alb "
+                                  + where, params):
+            self.albums[row["id"]] = (row["name"], row["dir"], row["artistid"], row["coverid"])
+            self._set_dir(row["dir"], None, DIR_ALBUM, row["id"])
+            artist_ids.add(row["artistid"])
+            album_ids.append(row["id"])
+
+        songs = {album_id: [] for album_id in album_ids}
+        for row in cursor.execute("SELECT {} FROM songs as s INNER JOIN albums as alb ON alb.id = s.albumid {} "
+                                  "ORDER BY s.albumid, s.track, s.file"
+                                  .format(", ".join("s." + column for column in SONG_COLUMNS), where), params):
+            self.songs[row["id"]] = row
+            songs[row["albumid"]].append(row["id"])
+        for album_id, song_ids in songs.items():
+            self.album_songs[album_id] = array("l", song_ids)
+
+        if not artist_ids:
+            return
+        artist_ids = list(artist_ids)
+        for row in cursor.execute("SELECT id, name, dir FROM artists WHERE id IN ({})"
+                                  .format(",".join("?" * len(artist_ids))), artist_ids):
+            self.artists[row["id"]] = (row["name"], row["dir"])
+            self._set_dir(row["dir"], None, DIR_ARTIST, row["id"])
+        artist_albums = {artist_id: [] for artist_id in artist_ids}
+        for row in cursor.execute("SELECT artistid, id FROM albums WHERE artistid IN ({}) ORDER BY artistid, name"
+                                  .format(",".join("?" * len(artist_ids))), artist_ids):
+            artist_albums[row["artistid"]].append(row["id"])
+        for artist_id, album_ids in artist_albums.items():
+            self.artist_albums[artist_id] = array("l", album_ids)
+
+    def _set_dir(self, dir_id, parent, kind, entity):
+        if dir_id >= len(self.dir_parent):
+            grow = dir_id + 1 - len(self.dir_parent)
+            self.dir_parent.extend([-1] * grow)
+            self.dir_kind.extend([DIR_OTHER] * grow)
+            self.dir_entity.extend([0] * grow)
+        if parent is not None:
+            self.dir_parent[dir_id] = parent or 0
+        if kind != DIR_OTHER:
+            self.dir_kind[dir_id] = kind
+            self.dir_entity[dir_id] = entity
+
+    def get_dir(self, dir_id):
+        """
+        Return (kind, parent dir id, artist or album id) for a dir
+        :raises: NotFoundError
+        """
+        if not 0 < dir_id < len(self.dir_parent) or self.dir_parent[dir_id] == -1:
+            raise NotFoundError("Directory doesn't exist")
+        return self.dir_kind[dir_id], self.dir_parent[dir_id], self.dir_entity[dir_id]
+
+    def album_row(self, album_id):
+        """
+        Return an album as a dict with the columns of PysonicDatabase.get_albums() that listings use
+        """
+        name, dir_id, artist_id, cover_id = self.albums[album_id]
+        artist_name, artist_dir = self.artists[artist_id]
+        return dict(id=album_id, name=name, dir=dir_id, artistid=artist_id, coverid=cover_id, artistname=artist_name,
+                    artistdir=artist_dir)
+
+    def song_row(self, song_id):
+        """
+        Return a song as a dict with the columns of PysonicDatabase.get_songs() that listings use, less genre and plays
+        """
+        song = self.songs[song_id]
+        album_name, _, artist_id, cover_id = self.albums[song["albumid"]]
+        return dict(song.items(), albumname=album_name, albumcoverid=cover_id, artistid=artist_id,
+                    artistname=self.artists[artist_id][0])
+
+    def album_totals(self, album_id):
+        """
+        Return the total size in bytes and duration in seconds of an album's songs
+        """
+        size = duration = 0
+        for song_id in self.album_songs.get(album_id, ()):
+            song = self.songs[song_id]
+            size += max(song["size"], 0)
+            duration += song["length"] or 0
+        return size, duration
@@ -1,6 +1,12 @@
 import os
 import logging
+from time import time
+from threading import Lock
 from pysonic.scanner import PysonicFilesystemScanner
+from pysonic.resolver import PysonicResolver
+from pysonic.dirtree import PysonicDirTree
+from pysonic.catalog import PysonicCatalog
+from pysonic.similarity import PysonicSimilarity, weighted_sample, NEIGHBOUR_SHARE
 from pysonic.types import MUSIC_TYPES
 
 
@@ -8,6 +14,9 @@ LETTER_GROUPS = ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l", "m"
                  "u", "v", "w", "xyz", "0123456789"]
 
 
+STAR_TYPES = ["song", "album", "artist"]
+
+
 logging = logging.getLogger("library")
 
 
@@ -29,23 +38,39 @@ class NoDataException(Exception):
 
 
 class PysonicLibrary(object):
-    def __init__(self, database):
+    def __init__(self, database, catalog=True):
+        """
+        :param catalog: keep a PysonicCatalog to answer album lists and random songs from
+        """
         self.db = database
 
         self.get_libraries = self.db.get_libraries
         self.get_artists = self.db.get_artists
         self.get_albums = self.db.get_albums
-        # self.get_song = self.db.get_song
-        # self.get_cover = self.db.get_cover
+
+        # username -> {item type: {item id: starred timestamp}}, loaded on a user's first request
+        self.stars = {}
+        self.stars_lock = Lock()
+
+        self.resolver = PysonicResolver(self.db)
+        self.get_song = self.resolver.get_song
+        self.get_cover = self.resolver.get_cover
+
+        self.dirtree = PysonicDirTree(self.db)
+        self.catalog = PysonicCatalog(self.db) if catalog else None
+        self.similarity = PysonicSimilarity(self.db)
+
+        # PysonicChangeBus, set when other processes share the database and its changes
+        self.bus = None
 
         self.scanner = PysonicFilesystemScanner(self)
         logging.info("library ready")
 
-    def update(self):
+    def update(self, scan=True, delay=0, nice=0, throttle=None, walkers=None):
         """
-        Start the library media scanner ands
+        Start the library media scanner ands. See PysonicFilesystemScanner.init_scan()
         """
-        self.scanner.init_scan()
+        self.scanner.init_scan(scan=scan, delay=delay, nice=nice, throttle=throttle, walkers=walkers)
 
     def add_root_dir(self, path):
         """
@@ -53,6 +78,7 @@ class PysonicLibrary(object):
         """
         path = os.path.abspath(os.path.normpath(path))
         self.db.add_root(path)
+        self.resolver.invalidate()
 
     # def get_artists(self, *args, **kwargs):
     #     artists = self.db.get_artists(*args, **kwargs)
@@ -66,33 +92,136 @@ class PysonicLibrary(object):
     #         item["parent"] = item["artistid"]
     #     return albums
 
-    def get_artist_info(self, item_id):
-        #TODO
-        return {"biography": "placeholder biography",
-                "musicBrainzId": "playerholder",
-                "lastFmUrl": "https://www.last.fm/music/Placeholder",
-                "smallImageUrl": "",
-                "mediumImageUrl": "",
-                "largeImageUrl": "",
-                "similarArtists": []}
-
-    def get_cover(self, cover_id):
-        cover = self.db.get_cover(cover_id)
-        library = self.db.get_libraries(cover["library"])[0]
-        cover['_fullpath'] = os.path.join(library["path"], cover["path"])
-        return cover
-
-    def get_song(self, song_id):
-        song = self.db.get_songs(id=song_id)[0]
-        library = self.db.get_libraries(song["library"])[0]
-        song['_fullpath'] = os.path.join(library["path"], song["file"])
-        return song
+    def get_similar_artists(self, artist_id, count=20):
+        """
+        Return ids of the artists most like an artist that are in the directory tree, closest first
+        """
+        return [row["similarid"] for row in self.db.get_similar("artist", artist_id, limit=count)
+                if row["similarid"] in self.dirtree.artists]
+
+    def get_similar_songs(self, artist_id, song_id=None, count=50):
+        """
+        Pick song ids for a radio started from an artist or one of their songs. Candidates are the artist's songs,
+        songs of similar artists weighted by how similar they are and, strongest, songs played near the starting song
+        in playlists and play queues.
+        """
+        tree = self.dirtree
+        weights = {}
+        artists = [(artist_id, 1.0)] + [(row["similarid"], row["score"])
+                                        for row in self.db.get_similar("artist", artist_id)]
+        for other_id, score in artists:
+            for album_id in tree.artist_albums.get(other_id, ()):
+                for other_song_id in tree.album_songs.get(album_id, ()):
+                    weights[other_song_id] = score
+        if song_id is not None:
+            weights.pop(song_id, None)
+            neighbours = {row["similarid"]: row["score"] for row in self.db.get_similar("song", song_id)
+                          if row["similarid"] in tree.songs}
+            scale = (sum(weights.values()) or 1) * NEIGHBOUR_SHARE / (1 - NEIGHBOUR_SHARE) / \
+                (sum(neighbours.values()) or 1)
+            for other_song_id, score in neighbours.items():
+                weights[other_song_id] = weights.get(other_song_id, 0) + score * scale
+        return weighted_sample(weights, count)
+
+    def get_stars(self, username):
+        """
+        Return the user's starred items as {item type: {item id: starred timestamp}}. The database is read once per
+        user, after that listings can check stars with dict lookups. Treat the result as read-only.
+        """
+        stars = self.stars.get(username)
+        if stars is not None:
+            return stars
+        with self.stars_lock:
+            if username not in self.stars:
+                stars = {itemtype: {} for itemtype in STAR_TYPES}
+                if username is not None:
+                    for row in self.db.get_starred(self.db.get_user(username)["id"]):
+                        stars[row["itemtype"]][row["itemid"]] = row["starred"]
+                self.stars[username] = stars
+            return self.stars[username]
+
+    def set_starred(self, username, item_ids, starred=True, itemtype="song"):
+        """
+        Star or unstar items for a user. Written to the database before the in-memory index is updated.
+        :param item_ids: list of song, album or artist ids
+        :param itemtype: one of STAR_TYPES
+        """
+        assert itemtype in STAR_TYPES
+        self.get_stars(username)
+        now = int(time())
+        with self.stars_lock:
+            self.db.set_starred(self.db.get_user(username)["id"], itemtype, item_ids, now if starred else None)
+            # Copy on write so readers iterating the previous index aren't disturbed
+            items = dict(self.stars[username][itemtype])
+            for item_id in item_ids:
+                if starred:
+                    items.setdefault(item_id, now)
+                else:
+                    items.pop(item_id, None)
+            self.stars[username] = dict(self.stars[username], **{itemtype: items})
+        if self.bus:
+            self.bus.publish("stars", [username])
+
+    def invalidate(self, kind, item_ids=None, publish=True):
+        """
+        Refresh in-memory copies of library data after it changed in the database, and tell other processes sharing
+        the database to do the same
+        :param kind: "song" to forget resolved song files, "album" to reload albums in the directory tree and catalog,
+                     "tree" to rebuild both, "plays" to reload songs' play counts into the catalog, or "stars" to
+                     forget users' stars
+        :param item_ids: song or album ids, or usernames
+        :param publish: False when applying a change published by another process
+        """
+        if kind == "song":
+            self.resolver.invalidate("song", item_ids)
+        elif kind == "album":
+            self.dirtree.update(item_ids)
+            if self.catalog:
+                self.catalog.update(item_ids)
+        elif kind == "tree":
+            self.dirtree.rebuild()
+            if self.catalog:
+                self.catalog.rebuild()
+        elif kind == "plays":
+            if self.catalog:
+                self.catalog.update_plays(item_ids)
+        elif kind == "stars":
+            with self.stars_lock:
+                for username in item_ids:
+                    self.stars.pop(username, None)
+        if publish and self.bus:
+            self.bus.publish(kind, item_ids)
 
     def get_playlist(self, playlist_id):
         playlist_info = self.db.get_playlist(playlist_id)
         songs = self.db.get_playlist_songs(playlist_id)
         return (playlist_info, songs)
 
+    def get_crc32(self, song_ids):
+        """
+        Return {song id: crc32 of the song's file} for the songs whose checksum is stored and whose file's size and
+        mtime haven't changed since. Others are checksummed while they're sent and stored with set_crc32().
+        """
+        stored = self.db.get_checksums(song_ids)
+        checksums = {}
+        for song_id in song_ids:
+            song = self.get_song(song_id)
+            if stored.get(song_id, ())[:2] == (song["size"], int(song["mtime"])):
+                checksums[song_id] = stored[song_id][2]
+        return checksums
+
+    def set_crc32(self, checksums):
+        """
+        Store checksums computed while sending songs' files
+        :param checksums: {song id: crc32}
+        """
+        computed = {}
+        for song_id, crc32 in checksums.items():
+            song = self.get_song(song_id)
+            computed[song_id] = (song["size"], int(song["mtime"]), crc32)
+        logging.info("checksummed %s files", len(computed))
+        self.db.set_checksums(computed)
+
     def delete_playlist(self, playlist_id):
         self.db.empty_playlist(playlist_id)
         self.db.delete_playlist(playlist_id)
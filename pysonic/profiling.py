@@ -0,0 +1,192 @@
+import os
+import json
+import sqlite3
+import logging
+import cProfile
+from time import time, perf_counter
+from threading import local
+from contextlib import contextmanager
+import cherrypy
+
+
+logging = logging.getLogger("profiling")
+
+PROFILE_PARAM = "_profile"  # query parameter asking for a profile: 1 for a summary, cprofile to dump a cProfile too
+PROFILE_HEADER = "X-Pysonic-Profile"
+SLOWEST_QUERIES = 5  # statements listed in the summary header
+
+requests = local()
+
+
+def current_profile():
+    """
+    Return the RequestProfile of the request being handled by this thread, None if it isn't being profiled
+    """
+    return getattr(requests, "profile", None)
+
+
+class RequestProfile(object):
+    def __init__(self, path, cprofile=False):
+        """
+        Where the time handling one request went: the handler, rendering, and each SQL statement with its duration and
+        row count
+        :param cprofile: also run cProfile over the request
+        """
+        self.path = path
+        self.started = perf_counter()
+        self.times = {}
+        self.bytes_out = None
+        self.queries = []
+        self.profiler = cProfile.Profile() if cprofile else None
+
+    @contextmanager
+    def timed(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + perf_counter() - start
+
+    def query(self, sql):
+        entry = dict(sql=" ".join(sql.split()), seconds=0, rows=0)
+        self.queries.append(entry)
+        return entry
+
+    def summary(self):
+        def ms(seconds):
+            return round(seconds * 1000, 3)
+
+        slowest = sorted(self.queries, key=lambda entry: entry["seconds"], reverse=True)[:SLOWEST_QUERIES]
+        return dict(total_ms=ms(perf_counter() - self.started),
+                    bytes=self.bytes_out,
+                    sql_count=len(self.queries),
+                    sql_ms=ms(sum(entry["seconds"] for entry in self.queries)),
+                    sql_rows=sum(entry["rows"] for entry in self.queries),
+                    slowest=[dict(sql=entry["sql"][:100], ms=ms(entry["seconds"]), rows=entry["rows"])
+                             for entry in slowest],
+                    **{name + "_ms": ms(seconds) for name, seconds in self.times.items()})
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Cursor that records each statement it runs, with the time spent running and fetching it and the rows fetched, in
+    the current request's profile
+    """
+    entry = None
+
+    def execute(self, sql, parameters=()):
+        profile = current_profile()
+        if profile is None:
+            self.entry = None
+            return super().execute(sql, parameters)
+        self.entry = profile.query(sql)
+        start = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.entry["seconds"] += perf_counter() - start
+
+    def executemany(self, sql, seq_of_parameters):
+        profile = current_profile()
+        if profile is None:
+            self.entry = None
+            return super().executemany(sql, seq_of_parameters)
+        self.entry = profile.query(sql)
+        start = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.entry["seconds"] += perf_counter() - start
+            self.entry["rows"] = max(self.rowcount, 0)
+
+    def _fetched(self, fetch, *args):
+        if self.entry is None:
+            return fetch(*args)
+        start = perf_counter()
+        rows = fetch(*args)
+        self.entry["seconds"] += perf_counter() - start
+        return rows
+
+    def __next__(self):
+        row = self._fetched(super().__next__)
+        if self.entry is not None:
+            self.entry["rows"] += 1
+        return row
+
+    def fetchone(self):
+        row = self._fetched(super().fetchone)
+        if self.entry is not None and row is not None:
+            self.entry["rows"] += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._fetched(super().fetchmany, *args)
+        if self.entry is not None:
+            self.entry["rows"] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._fetched(super().fetchall)
+        if self.entry is not None:
+            self.entry["rows"] += len(rows)
+        return rows
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """
+    Connection handing out ProfilingCursors, including for the execute() shortcuts
+    """
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class PysonicRequestProfiler(object):
+    def __init__(self, dump_dir):
+        """
+        Profiles requests that ask for it with the _profile query parameter or the X-Pysonic-Profile header. A summary
+        goes back in the X-Pysonic-Profile response header and every statement is logged. With "cprofile" as the value
+        a cProfile of the request is written to `dump_dir` and its name sent in X-Pysonic-Profile-File. Only installed
+        with --debug, so requests aren't touched otherwise.
+        """
+        self.dump_dir = dump_dir
+
+    def install(self):
+        cherrypy.tools.profile = cherrypy.Tool('before_handler', self.start, priority=10)
+        return {'tools.profile.on': True}
+
+    def start(self):
+        request = cherrypy.request
+        mode = request.params.pop(PROFILE_PARAM, None) or request.headers.get(PROFILE_HEADER)
+        if not mode or mode == "0":
+            return
+        profile = RequestProfile(request.path_info, cprofile=mode == "cprofile")
+        requests.profile = profile
+        request.hooks.attach('before_finalize', self.finish, priority=10)
+        request.hooks.attach('on_end_request', self.clear)
+        if profile.profiler:
+            profile.profiler.enable()
+
+    def finish(self):
+        profile = current_profile()
+        if profile is None:
+            return
+        if profile.profiler:
+            profile.profiler.disable()
+            os.makedirs(self.dump_dir, exist_ok=True)
+            name = "{}-{}.prof".format(int(time() * 1000), profile.path.strip("/").replace("/", "_") or "root")
+            profile.profiler.dump_stats(os.path.join(self.dump_dir, name))
+            cherrypy.response.headers[PROFILE_HEADER + "-File"] = name
+        summary = profile.summary()
+        cherrypy.response.headers[PROFILE_HEADER] = json.dumps(summary, separators=(",", ":"))
+        logging.warning("%s took %sms: %s", profile.path, summary["total_ms"],
+                        ", ".join("{sql} ({rows} rows) {ms}ms".format(ms=round(entry["seconds"] * 1000, 3), **entry)
+                                  for entry in profile.queries))
+
+    def clear(self):
+        requests.profile = None
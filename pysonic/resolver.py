@@ -0,0 +1,96 @@
+import os
+import logging
+from threading import Lock
+from collections import OrderedDict
+from pysonic.database import NotFoundError
+
+
+logging = logging.getLogger("resolver")
+
+
+class PysonicResolver(object):
+    def __init__(self, db, max_entries=4096):
+        """
+        Maps song and cover ids to files on disk without going to the database for ids that were resolved recently.
+        Library roots and a bounded LRU of resolved ids are kept in memory. Entries are dicts holding _fullpath,
+        format, bitrate, size and mtime. The scanner calls invalidate() when it changes a file's metadata.
+        :param db: PysonicDatabase
+        :param max_entries: maximum number of ids to remember
+        """
+        self.db = db
+        self.max_entries = max_entries
+        self.roots = {}
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_root(self, library_id):
+        try:
+            return self.roots[library_id]
+        except KeyError:
+            self.roots = {library["id"]: library["path"] for library in self.db.get_libraries()}
+            return self.roots[library_id]
+
+    def get_song(self, song_id):
+        return self.resolve("song", song_id)
+
+    def get_cover(self, cover_id):
+        return self.resolve("cover", cover_id)
+
+    def resolve(self, kind, item_id):
+        """
+        Return the entry for a song or cover
+        :param kind: "song" or "cover"
+        :raises: NotFoundError
+        """
+        key = (kind, item_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = self.load_song(item_id) if kind == "song" else self.load_cover(item_id)
+
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def load_song(self, song_id):
+        row = self.db.get_song_file(song_id)
+        if not row:
+            raise NotFoundError("Song doesn't exist")
+        return self.make_entry(row["library"], row["file"], format=row["format"], bitrate=row["bitrate"])
+
+    def load_cover(self, cover_id):
+        row = self.db.get_cover(cover_id)
+        if not row:
+            raise NotFoundError("Cover doesn't exist")
+        return self.make_entry(row["library"], row["path"], format=row["type"], bitrate=None)
+
+    def make_entry(self, library_id, path, format, bitrate):
+        fullpath = os.path.join(self.get_root(library_id), path)
+        stat = os.stat(fullpath)
+        return dict(_fullpath=fullpath, format=format, bitrate=bitrate, size=stat.st_size, mtime=stat.st_mtime)
+
+    def invalidate(self, kind=None, item_ids=None):
+        """
+        Forget resolved ids. With no arguments the whole cache, including library roots, is dropped.
+        :param kind: "song" or "cover"
+        :param item_ids: ids to forget; all ids of `kind` if omitted
+        """
+        with self.lock:
+            if kind is None:
+                self.entries.clear()
+                self.roots = {}
+            elif item_ids is None:
+                for key in [key for key in self.entries if key[0] == kind]:
+                    del self.entries[key]
+            else:
+                for item_id in item_ids:
+                    self.entries.pop((kind, item_id), None)
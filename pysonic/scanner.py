@@ -1,55 +1,164 @@
 import os
 import re
+import sys
 import logging
 from contextlib import closing
 import mimetypes
-from time import time
-from threading import Thread
+from time import time, sleep
+from threading import Thread, get_native_id
+from pysonic.tagreader import read_tags, prefetch_head, HEAD_SIZE
+from pysonic.walker import PysonicWalker, ROOT_WALKERS
 from pysonic.types import KNOWN_MIMES, MUSIC_TYPES, MPX_TYPES, FLAC_TYPES, WAV_TYPES, MUSIC_EXTENSIONS, IMAGE_EXTENSIONS, IMAGE_TYPES
-from mutagen.id3 import ID3
-from mutagen import MutagenError
-from mutagen.id3._util import ID3NoHeaderError
-from mutagen.flac import FLAC
-from mutagen.mp3 import MP3
 
 
 logging = logging.getLogger("scanner")
 RE_NUMBERS = re.compile(r'^([0-9]+)')
+BUSY_IOPS = 10  # reads per second the metadata scan is held to while files are being streamed, at most
+STREAMS_CHECK_INTERVAL = 1  # seconds between checks for active streams
+REFRESH_INTERVAL = 10  # seconds between reloads of the albums a running scan changed into the dir tree and catalog
+
+
+class PysonicScanThrottle(object):
+    def __init__(self, iops=0, bandwidth=0, busy_iops=BUSY_IOPS, streams=None):
+        """
+        Paces the metadata scan to a budget of reads and bytes per second, so a rescan of a slow disk or network mount
+        leaves room for the listeners sharing it. While `streams()` reports active streams the scan backs off to
+        `busy_iops`.
+        :param iops: reads per second, 0 for no limit
+        :param bandwidth: bytes per second, 0 for no limit
+        :param streams: callable returning the number of streams being served
+        """
+        self.iops = iops
+        self.bandwidth = bandwidth
+        self.busy_iops = busy_iops
+        self.streams = streams
+        self.busy = False
+        self.checked = 0
+        self.next_read = time()
+
+    def is_busy(self, now):
+        if self.streams and now - self.checked >= STREAMS_CHECK_INTERVAL:
+            self.checked = now
+            busy = self.streams() > 0
+            if busy != self.busy:
+                logging.info("%s scan while files are streamed", "slowing" if busy else "resuming")
+            self.busy = busy
+        return self.busy
+
+    def spend(self, reads, nbytes):
+        """
+        Account for reads made, sleeping until the budget allows them
+        """
+        now = time()
+        iops = self.iops
+        if self.is_busy(now):
+            iops = min(iops, self.busy_iops) if iops else self.busy_iops
+        cost = max(reads / iops if iops else 0, nbytes / self.bandwidth if self.bandwidth else 0)
+        # time not spent while the scan waited on the disk isn't saved up for bursts later
+        self.next_read = max(self.next_read, now - 1) + cost
+        if self.next_read > now:
+            sleep(self.next_read - now)
 
 
 class PysonicFilesystemScanner(object):
     def __init__(self, library):
         self.library = library
-
-    def init_scan(self):
-        self.scanner = Thread(target=self.rescan, daemon=True)
+        self.scanner = None
+        self.throttle = PysonicScanThrottle()
+        self.walkers = ROOT_WALKERS
+        self.state = "idle"  # idle, loading, waiting or scanning
+        self.phase = None  # files or metadata while scanning
+        self.started = None
+        self.finished = None
+        self.changed_albums = set()  # changed by the running scan, not yet reloaded
+        self.refreshed = 0
+
+    def init_scan(self, scan=True, delay=0, nice=0, throttle=None, walkers=None):
+        """
+        Load the directory tree and then, unless `scan` is false, rescan the library, all from a background thread so
+        the server can start serving from the existing database right away.
+        :param delay: seconds to wait before scanning, letting the first clients in ahead of the scan
+        :param nice: niceness to scan at
+        :param throttle: PysonicScanThrottle pacing the metadata scan's reads
+        :param walkers: directories of each library root to list at once
+        """
+        if throttle:
+            self.throttle = throttle
+        if walkers:
+            self.walkers = walkers
+        self.state = "loading"
+        self.scanner = Thread(target=self.background_scan, args=(scan, delay, nice), daemon=True, name="scanner")
         self.scanner.start()
 
+    def background_scan(self, scan, delay, nice):
+        self.library.invalidate("tree", publish=False)
+        if not scan:
+            self.state = "idle"
+            return
+        self.state = "waiting"
+        sleep(delay)
+        if nice and sys.platform.startswith("linux"):
+            # linux threads have their own niceness, this leaves the http threads alone. it lowers the scan's io
+            # priority too when the io scheduler derives it from niceness.
+            os.setpriority(os.PRIO_PROCESS, get_native_id(), nice)
+        self.rescan()
+
     def rescan(self):
         """
         Perform a full scan of the media library's files
         """
         start = time()
+        self.state = "scanning"
+        self.started = int(start)
         logging.warning("Beginning library rescan")
-        for parent in self.library.db.get_libraries():
-            logging.info("Scanning {}".format(parent["path"]))
-            self.scan_root(parent["id"], parent["path"])
+        try:
+            # all roots are walked at once, then their files' metadata is read one root after another
+            libraries = self.library.db.get_libraries()
+            self.scan_files(libraries)
+            for parent in libraries:
+                self.scan_root_metadata(parent["id"], parent["path"])
+            self.changed_albums.clear()  # the rebuild covers them
+            self.library.invalidate("tree")
+            self.library.similarity.request()
+        finally:
+            self.state = "idle"
+            self.phase = None
+            self.finished = int(time())
         logging.warning("Rescan complete in %ss", round(time() - start, 3))
 
+    def status(self):
+        return dict(state=self.state, phase=self.phase, started=self.started, finished=self.finished)
+
     def scan_root(self, pid, root):
         """
         Scan a single root the library
         :param pid: parent ID
         :param root: absolute path to scan
         """
-        logging.warning("Beginning file scan for library %s", pid)
-        root_depth = len(self.split_path(root))
-        for path, dirs, files in os.walk(root):
+        self.scan_files([dict(id=pid, path=root)])
+        self.scan_root_metadata(pid, root)
+        self.refresh_albums()
+
+    def scan_files(self, libraries):
+        """
+        Walk library roots in parallel, adding the dirs and files found as their listings come in
+        :param libraries: rows of the libraries table
+        """
+        self.phase = "files"
+        roots = {}  # path -> (library id, depth)
+        for parent in libraries:
+            logging.warning("Beginning file scan for library %s", parent["id"])
+            roots[parent["path"]] = parent["id"], len(self.split_path(parent["path"]))
+        walker = PysonicWalker(list(roots), root_walkers=self.walkers)
+        for root, path, dirs, files in walker.walk():
+            pid, root_depth = roots[root]
             child = self.split_path(path)[root_depth:]
             # dirid = self.create_or_get_dbdir_tree(pid, child)  # dumb table for Subsonic
             self.scan_dir(pid, root, child, dirs, files)
 
+    def scan_root_metadata(self, pid, root):
         logging.warning("Beginning metadata scan for library %s", pid)
+        self.phase = "metadata"
         self.scan_metadata(pid, root, freshonly=True)
 
         logging.warning("Finished scan for library %s", pid)
@@ -140,6 +249,7 @@ class PysonicFilesystemScanner(object):
 
             if new_files:  # Commit after each dir IF audio files were found. no audio == dump the artist
                 cursor.execute("COMMIT")
+                self.albums_changed([album_id])
 
     def add_music_if_new(self, cursor, pid, root_dir, album_id, fdir, fname):
         fpath = os.path.join(fdir, fname)
@@ -220,19 +330,28 @@ class PysonicFilesystemScanner(object):
         Iterate through files in the library and update metadata
         :param freshonly: only update metadata on files that have never been scanned before
         """
-        q = "SELECT * FROM songs "
+        q = "SELECT id, file, albumid FROM songs WHERE library = ? "
         if freshonly:
-            q += "WHERE lastscan = -1 "
-        q += "ORDER BY albumid"
+            q += "AND lastscan = -1 "
 
         #TODO scraping ID3 etc from the media files can be parallelized
         with closing(self.library.db.db.cursor()) as reader, \
                 closing(self.library.db.db.cursor()) as writer:
             processed = 0  # commit batching counter
-            for row in reader.execute(q):
+            updated = []  # songs to drop from the resolver cache once committed
+            updated_albums = []
+            # Fetched up front: a read left open across our commits would stop them once another process has written
+            rows = self.disk_order(root, reader.execute(q, (pid, )).fetchall())
+            for index, row in enumerate(rows):
+                # The next file's head is read by the kernel while this one is parsed
+                if index + 1 < len(rows):
+                    prefetch_head(os.path.join(root, rows[index + 1]['file']))
                 # Find meta, bail if the file was unreadable
-                # TODO file metadata scanning could be done in parallel
                 meta = self.scan_file_metadata(os.path.join(root, row['file']))
+                if meta and "reads" in meta:
+                    self.throttle.spend(meta["reads"], meta["bytes_read"])
+                else:
+                    self.throttle.spend(2, HEAD_SIZE)  # mutagen doesn't count its reads, guess a head and a tail
                 if not meta:
                     continue
                 # Meta may have additional keys that arent in the songs table, omit them
@@ -265,12 +384,57 @@ class PysonicFilesystemScanner(object):
 
                 # Commit every 50 items
                 processed += 1
+                updated.append(row["id"])
+                updated_albums.append(row["albumid"])
                 if processed > 50:
                     writer.execute("COMMIT")
+                    self.library.invalidate("song", updated)
+                    self.albums_changed(updated_albums)
                     processed = 0
+                    updated = []
+                    updated_albums = []
 
             if processed != 0:
                 writer.execute("COMMIT")
+                self.library.invalidate("song", updated)
+                self.albums_changed(updated_albums)
+
+    def albums_changed(self, album_ids):
+        """
+        Queue albums the scan changed to be reloaded into the dir tree and catalog. A reload passes over the whole
+        catalog, so albums are reloaded together every REFRESH_INTERVAL seconds rather than as each one is committed.
+        """
+        self.changed_albums.update(album_ids)
+        if time() - self.refreshed >= REFRESH_INTERVAL:
+            self.refresh_albums()
+
+    def refresh_albums(self):
+        self.refreshed = time()
+        if self.changed_albums:
+            album_ids, self.changed_albums = list(self.changed_albums), set()
+            self.library.invalidate("album", album_ids)
+
+    def disk_order(self, root, rows):
+        """
+        Sort song rows into the order their files are likely laid out on disk, by the inode of their directory and
+        then their own, so the metadata scan doesn't seek back and forth. Inodes come from listing each directory once.
+        """
+        dirs = {}
+        for row in rows:
+            dirs.setdefault(os.path.dirname(row['file']), []).append(row)
+        ordered = []
+        for dirname, dir_rows in dirs.items():
+            path = os.path.join(root, dirname)
+            try:
+                dir_inode = os.stat(path).st_ino
+                with os.scandir(path) as entries:
+                    inodes = {entry.name: entry.inode() for entry in entries}
+            except OSError:
+                dir_inode, inodes = 0, {}
+            for row in dir_rows:
+                ordered.append(((dir_inode, inodes.get(os.path.basename(row['file']), 0)), row))
+        ordered.sort(key=lambda item: item[0])
+        return [row for _, row in ordered]
 
     def get_genre_id(self, cursor, genre_name):
         genre_name = genre_name.title().strip()  # normalize
@@ -287,9 +451,20 @@ class PysonicFilesystemScanner(object):
         ftype, extra = mimetypes.guess_type(fpath)
 
         if ftype in MUSIC_TYPES:
+            meta = read_tags(fpath, ftype)
+            if meta is not None:
+                return meta
+            logging.info("reading %s with mutagen", fpath)
             return self.scan_mutagen_metadata(fpath, ftype)
 
     def scan_mutagen_metadata(self, fpath, ftype):
+        # imported here so that starting the server doesn't wait on mutagen
+        from mutagen.id3 import ID3
+        from mutagen import MutagenError
+        from mutagen.id3._util import ID3NoHeaderError
+        from mutagen.flac import FLAC
+        from mutagen.mp3 import MP3
+
         meta = {"format": ftype}
         try:
             # Open file with mutagen
@@ -0,0 +1,191 @@
+import math
+import heapq
+import random
+import logging
+from time import time
+from threading import Thread, Event
+from collections import defaultdict, Counter
+from contextlib import closing
+
+
+logging = logging.getLogger("similarity")
+
+TOP_K = 25  # neighbours kept per artist or song
+YEAR_BUCKET = 5  # artists active within the same span of years share a feature
+MAX_POSTINGS = 200  # neighbours are looked for among this many of the strongest holders of each feature
+COOCCURRENCE_WINDOW = 10  # songs up to this many places apart in a playlist or play queue co-occur
+NEIGHBOUR_SHARE = 0.5  # chance of each radio pick being a song played near the starting song, when there are some
+
+
+def weigh(counts):
+    """
+    Turn {id: {feature: count}} into vectors weighted by tf-idf, so features most items share count for little
+    """
+    df = Counter(feature for features in counts.values() for feature in features)
+    total = len(counts)
+    vectors = {}
+    for item_id, features in counts.items():
+        size = sum(features.values())
+        vectors[item_id] = {feature: count / size * math.log(1 + total / df[feature])
+                            for feature, count in features.items()}
+    return vectors
+
+
+def cosine_neighbours(vectors, k=TOP_K, max_postings=MAX_POSTINGS):
+    """
+    Return {id: [(neighbour id, score), ...]} with the k nearest ids by cosine similarity of sparse vectors. Candidates
+    come from an inverted index truncated to each feature's `max_postings` heaviest holders, which keeps common features
+    from making the job quadratic.
+    :param vectors: {id: {feature: weight}}
+    """
+    postings = defaultdict(list)
+    for item_id, vector in vectors.items():
+        for feature, weight in vector.items():
+            postings[feature].append((weight, item_id))
+    for items in postings.values():
+        items.sort(reverse=True)
+        del items[max_postings:]
+    norms = {item_id: math.sqrt(sum(weight * weight for weight in vector.values()))
+             for item_id, vector in vectors.items()}
+
+    neighbours = {}
+    for item_id, vector in vectors.items():
+        candidates = {other for feature in vector for _, other in postings[feature]}
+        candidates.discard(item_id)
+        scores = []
+        for other in candidates:
+            other_vector = vectors[other]
+            dot = sum(weight * other_vector.get(feature, 0) for feature, weight in vector.items())
+            if dot > 0:
+                scores.append((dot / (norms[item_id] * norms[other]), other))
+        neighbours[item_id] = [(other, score) for score, other in heapq.nlargest(k, scores)]
+    return neighbours
+
+
+def cooccurrence_neighbours(lists, k=TOP_K, window=COOCCURRENCE_WINDOW):
+    """
+    Return {id: [(neighbour id, score), ...]} for ids that appear near each other in ordered lists. Pairs score the
+    inverse of their distance, normalized by how many lists each id is in.
+    """
+    pairs = defaultdict(float)
+    appearances = Counter()
+    for items in lists:
+        for position, item_id in enumerate(items):
+            appearances[item_id] += 1
+            for distance, other in enumerate(items[position + 1:position + 1 + window], start=1):
+                if other != item_id:
+                    pairs[min(item_id, other), max(item_id, other)] += 1.0 / distance
+    scored = defaultdict(list)
+    for (first, second), score in pairs.items():
+        score /= math.sqrt(appearances[first] * appearances[second])
+        scored[first].append((score, second))
+        scored[second].append((score, first))
+    return {item_id: [(other, score) for score, other in heapq.nlargest(k, scores)]
+            for item_id, scores in scored.items()}
+
+
+def weighted_sample(weights, count):
+    """
+    Pick up to `count` distinct keys of {key: weight}, each draw favouring heavier keys
+    """
+    keys = [(random.random() ** (1.0 / weight), key) for key, weight in weights.items() if weight > 0]
+    return [key for _, key in heapq.nlargest(count, keys)]
+
+
+class PysonicSimilarity(object):
+    def __init__(self, db):
+        """
+        Offline similarity of artists and songs, built from the library alone: shared genres and years weighted by
+        play counts, and co-occurrence in playlists, play queues and stars. A background job computes top-K neighbour
+        lists into the similar table, so radio style requests only look them up.
+        """
+        self.db = db
+        self.interval = None
+        self.running = False
+        self.wakeup = Event()
+        self.thread = None
+
+    def start(self, interval):
+        """
+        Rebuild the neighbour lists whenever they are older than `interval` seconds, and on request()
+        """
+        self.interval = interval
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True, name="similarity")
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+
+    def request(self):
+        """
+        Ask for a rebuild, after the library changed
+        """
+        self.wakeup.set()
+
+    def run(self):
+        while self.running:
+            wait = self.built() + self.interval - time()
+            if wait <= 0 or self.wakeup.is_set():
+                self.wakeup.clear()
+                try:
+                    self.rebuild()
+                except Exception:
+                    logging.exception("failed to build similarity lists")
+                    self.wakeup.wait(self.interval)
+                continue
+            self.wakeup.wait(wait)
+
+    def built(self):
+        """
+        Return when the neighbour lists were last built, 0 if never
+        """
+        return int(self.db.get_meta("similar_built") or 0)
+
+    def rebuild(self):
+        start = time()
+        with closing(self.db.connect()) as conn:
+            songs = conn.execute("SELECT s.id, alb.artistid, s.genre, s.year, s.plays FROM songs as s "
+                                 "INNER JOIN albums as alb ON alb.id = s.albumid").fetchall()
+            playlists = defaultdict(list)
+            for row in conn.execute('SELECT playlistid, songid FROM playlist_entries ORDER BY playlistid, "order"'):
+                playlists[row["playlistid"]].append(row["songid"])
+            queues = {row["userid"]: [int(i) for i in row["songs"].split(",") if i]
+                      for row in conn.execute("SELECT userid, songs FROM playqueues")}
+            album_artists = {row["id"]: row["artistid"] for row in conn.execute("SELECT id, artistid FROM albums")}
+            stars = conn.execute("SELECT userid, itemtype, itemid FROM starred").fetchall()
+
+            song_artists = {song["id"]: song["artistid"] for song in songs}
+            counts = defaultdict(Counter)
+            for song in songs:
+                weight = 1 + math.log1p(song["plays"])
+                if song["genre"]:
+                    counts[song["artistid"]]["genre", song["genre"]] += weight
+                if song["year"]:
+                    counts[song["artistid"]]["year", song["year"] // YEAR_BUCKET] += weight
+            for kind, lists in (("playlist", playlists), ("queue", queues)):
+                for list_id, song_ids in lists.items():
+                    for song_id in song_ids:
+                        if song_id in song_artists:
+                            counts[song_artists[song_id]][kind, list_id] += 1
+            for row in stars:
+                artist_id = {"song": song_artists.get, "album": album_artists.get,
+                             "artist": lambda item_id: item_id}[row["itemtype"]](row["itemid"])
+                if artist_id is not None:
+                    counts[artist_id]["stars", row["userid"]] += 1
+
+            artists = cosine_neighbours(weigh(counts))
+            song_neighbours = cooccurrence_neighbours(list(playlists.values()) + list(queues.values()))
+
+            conn.execute("DELETE FROM similar")
+            for itemtype, neighbours in (("artist", artists), ("song", song_neighbours)):
+                conn.executemany("INSERT INTO similar (itemtype, itemid, similarid, score) VALUES (?, ?, ?, ?)",
+                                 [(itemtype, item_id, other, score)
+                                  for item_id, scores in neighbours.items() for other, score in scores])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('similar_built', ?)", (str(int(start)), ))
+            conn.commit()
+        logging.warning("built similarity lists for %s artists and %s songs in %ss", len(artists),
+                        len(song_neighbours), round(time() - start, 3))
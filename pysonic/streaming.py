@@ -0,0 +1,607 @@
+import os
+import socket
+import logging
+import resource
+import select
+import selectors
+from time import time, sleep
+from queue import Queue, Empty
+from threading import Thread, Lock
+from cheroot.wsgi import Gateway_10
+import cherrypy
+
+
+logging = logging.getLogger("streaming")
+
+HANDOFF_KEY = "pysonic.stream_handoff"
+CHUNK_SIZE = 64 * 1024
+HIGH_WATER = 256 * 1024
+SPILL_MEMORY = 4 * 1024 * 1024  # output shared between streams is moved to a file past this size
+SEND_BUFFER = 256 * 1024  # caps kernel memory held per stream, autotuning would grow it to several MB
+SKIP_HEADERS = ["content-length", "transfer-encoding", "connection"]
+
+
+def raise_fd_limit():
+    """
+    Every detached stream holds a socket and a file or pipe open. Raise the soft open file limit to the hard limit so
+    the number of concurrent streams isn't capped by the default of 1024.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class StreamGateway(Gateway_10):
+    """
+    WSGI gateway that lets a request handler detach the client connection from the worker thread. The handler calls the
+    callable stored under HANDOFF_KEY in the environ with a response status, headers and a stream source; the socket is
+    duplicated and handed to the StreamEngine, and cheroot is told the response was already sent so the worker thread
+    is freed as soon as the handler returns.
+    """
+    engine = None
+
+    def __init__(self, req):
+        self.handed_off = False
+        super().__init__(req)
+
+    def get_environ(self):
+        env = super().get_environ()
+        # Plain TCP only, a duplicated TLS socket can't share the wrapper's session state
+        if self.engine and not self.req.conn.ssl_env:
+            env[HANDOFF_KEY] = self.handoff
+        return env
+
+    def start_response(self, status, headers, exc_info=None):
+        write = super().start_response(status, headers, exc_info)
+        if self.handed_off:
+            # cheroot must neither write a response nor close the kernel socket; our duplicate keeps it alive
+            self.req.sent_headers = True
+            self.req.close_connection = True
+            self.req.conn.linger = True
+        return write
+
+    def write(self, chunk):
+        if not self.handed_off:
+            super().write(chunk)
+
+    def handoff(self, status, headers, source):
+        req = self.req
+        sock = socket.socket(fileno=os.dup(req.conn.socket.fileno()))
+
+        lines = ["{} {}".format(req.server.protocol, status)]
+        for key, value in headers:
+            if key.lower() not in SKIP_HEADERS:
+                lines.append("{}: {}".format(key, value))
+        if source.length is not None:
+            lines.append("Content-Length: {}".format(source.length))
+        lines.append("Connection: close")
+        header = ("\r\n".join(lines) + "\r\n\r\n").encode("ISO-8859-1")
+
+        self.handed_off = True
+        self.engine.submit(StreamSession(sock, header, source))
+
+
+def parse_range(header, size):
+    """
+    Parse a Range header for a single byte range of a `size` byte file. Returns (start, end) with `end` exclusive, or
+    None if the whole file should be sent. Multiple ranges aren't supported and are answered with the whole file.
+    :raises: ValueError if the range can't be satisfied
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[6:].strip().partition("-")
+    try:
+        if not start:  # suffix range, the last `end` bytes
+            start, end = max(0, size - int(end)), size
+        else:
+            start, end = int(start), min(size, int(end) + 1) if end else size
+    except ValueError:
+        return None
+    if start >= end:
+        raise ValueError("unsatisfiable range {}".format(header))
+    return start, end
+
+
+class FileSource(object):
+    """
+    Stream a file, or a byte range of one, from disk. Sent with sendfile() by the StreamEngine.
+    """
+    def __init__(self, path, start=0, end=None, chunk_size=CHUNK_SIZE, fd=None):
+        """
+        :param start: offset of the first byte to send
+        :param end: offset to stop sending at, the end of the file if omitted
+        :param fd: the file already opened, for files that may be deleted before they're sent. The source owns it.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.end = (os.path.getsize(path) if fd is None else os.fstat(fd).st_size) if end is None else end
+        self.length = self.end - start
+        self.fd = fd
+        self.offset = start
+
+    def open(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        os.posix_fadvise(self.fd, self.offset, self.length, os.POSIX_FADV_SEQUENTIAL)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def send(self, sock):
+        """
+        Send the next chunk to a non-blocking socket. Returns the number of bytes sent, 0 once the source is done.
+        """
+        count = min(self.chunk_size, self.end - self.offset)
+        if count <= 0:
+            return 0
+        sent = os.sendfile(sock.fileno(), self.fd, self.offset, count)
+        if sent == 0:
+            raise OSError("{} shrank while being sent".format(self.path))
+        self.offset += sent
+        return sent
+
+    def iter_chunks(self):
+        """
+        Fallback used when the connection can't be detached; streams from the worker thread.
+        """
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        try:
+            while self.offset < self.end:
+                data = os.pread(self.fd, min(self.chunk_size, self.end - self.offset), self.offset)
+                if not data:
+                    break
+                self.offset += len(data)
+                yield data
+        finally:
+            self.close()
+
+
+class PipeSource(object):
+    """
+    Stream the stdout of a subprocess, such as a transcoder.
+    """
+    length = None
+
+    def __init__(self, proc, on_close=None, chunk_size=CHUNK_SIZE, rate=None, burst=0, stall_timeout=None):
+        """
+        :param proc: subprocess.Popen object with stdout=PIPE
+        :param on_close: callable invoked with the process after the stream ends
+        :param rate: bytes per second to read the output at once `burst` bytes have been read, no limit if None. The
+                     process blocks on the full pipe while it's ahead, so this paces it.
+        :param stall_timeout: seconds the process may produce nothing before it is killed, when streamed from a worker
+                              thread. The StreamEngine applies its own.
+        """
+        self.proc = proc
+        self.on_close = on_close
+        self.chunk_size = chunk_size
+        self.rate = rate
+        self.burst = burst
+        self.stall_timeout = stall_timeout
+        self.fd = proc.stdout.fileno()
+        self.started = time()
+        self.nread = 0
+        self.eof = False
+
+    def open(self):
+        os.set_blocking(self.fd, False)
+        self.started = time()
+
+    def read(self):
+        """
+        Read the next chunk of output, b"" once the process has closed it
+        :raises: BlockingIOError if the pipe is non-blocking and empty
+        """
+        data = os.read(self.fd, self.chunk_size)
+        self.nread += len(data)
+        self.eof = not data
+        return data
+
+    def wait(self, now):
+        """
+        Return how many seconds to wait before reading more to keep to the pace, 0 if it may be read now
+        """
+        if not self.rate:
+            return 0
+        return max(0, self.started + (self.nread - self.burst) / self.rate - now)
+
+    def close(self):
+        if not self.eof and self.proc.poll() is None:
+            # the client went away or skipped ahead, nobody will hear the rest
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        if self.on_close:
+            self.on_close(self.proc)
+
+    def iter_chunks(self):
+        self.started = time()
+        try:
+            while True:
+                sleep(self.wait(time()))
+                if not select.select([self.fd], [], [], self.stall_timeout)[0]:
+                    logging.warning("giving up on a stream source that produced nothing for %ss", self.stall_timeout)
+                    break
+                try:
+                    data = self.read()
+                except BlockingIOError:
+                    continue
+                if not data:
+                    break
+                yield data
+        finally:
+            self.close()
+
+
+class SharedOutput(object):
+    def __init__(self, spill_path, memory=SPILL_MEMORY):
+        """
+        Output of one producer, such as a transcoder, read by any number of SharedSources. It is held in memory until
+        it grows past `memory` bytes and then moved to a file at `spill_path`, which readers read back with pread.
+        """
+        self.spill_path = spill_path
+        self.memory = memory
+        self.lock = Lock()
+        self.data = bytearray()
+        self.spill_fd = None
+        self.size = 0
+        self.done = False
+        self.readers = set()
+
+    def append(self, data):
+        with self.lock:
+            if self.spill_fd is None and self.size + len(data) > self.memory:
+                self.spill_fd = os.open(self.spill_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+                os.write(self.spill_fd, self.data)
+                self.data = None
+            if self.spill_fd is None:
+                self.data += data
+            else:
+                os.write(self.spill_fd, data)
+            self.size += len(data)
+            # under the lock, so a reader can't close its pipe in between
+            for reader in self.readers:
+                reader.notify()
+
+    def finish(self):
+        """
+        Mark the output complete, readers reaching its end get eof
+        """
+        with self.lock:
+            self.done = True
+            for reader in self.readers:
+                reader.notify()
+
+    def save(self):
+        """
+        Write the output to `spill_path` if it's still in memory, and return the path
+        """
+        with self.lock:
+            if self.spill_fd is None:
+                with open(self.spill_path, "wb") as f:
+                    f.write(self.data)
+        return self.spill_path
+
+    def read(self, offset, length):
+        with self.lock:
+            length = min(length, self.size - offset)
+            if length <= 0:
+                return b""
+            if self.spill_fd is None:
+                return bytes(self.data[offset:offset + length])
+            spill_fd = self.spill_fd
+        return os.pread(spill_fd, length, offset)
+
+    def close(self):
+        with self.lock:
+            if self.spill_fd is not None:
+                os.close(self.spill_fd)
+                self.spill_fd = None
+            self.data = None
+
+
+class SharedSource(PipeSource):
+    """
+    Stream a SharedOutput from the start, following it as it grows. The StreamEngine treats it like a pipe: `fd` is
+    the read end of a pipe that becomes readable when there is more output to read.
+    """
+    def __init__(self, output, on_close=None, chunk_size=CHUNK_SIZE, stall_timeout=None):
+        """
+        :param on_close: callable invoked with this source after the stream ends
+        """
+        self.output = output
+        self.on_close = on_close
+        self.chunk_size = chunk_size
+        self.rate = None
+        self.stall_timeout = stall_timeout
+        self.started = time()
+        self.nread = 0
+        self.eof = False
+        self.fd, self.notify_fd = os.pipe()
+        os.set_blocking(self.fd, False)
+        os.set_blocking(self.notify_fd, False)
+        with output.lock:
+            output.readers.add(self)
+        self.notify()
+
+    def notify(self):
+        try:
+            os.write(self.notify_fd, b"\0")
+        except BlockingIOError:
+            pass  # a wakeup is already pending
+
+    def read(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        data = self.output.read(self.nread, self.chunk_size)
+        if data:
+            self.nread += len(data)
+            self.notify()  # there may be more, come back for it
+            return data
+        if self.output.done:
+            self.eof = True
+            return b""
+        raise BlockingIOError()
+
+    def close(self):
+        with self.output.lock:
+            self.output.readers.discard(self)
+        os.close(self.fd)
+        os.close(self.notify_fd)
+        if self.on_close:
+            self.on_close(self)
+
+
+class StreamSession(object):
+    """
+    A single detached client connection and the source feeding it.
+    """
+    def __init__(self, sock, header, source):
+        self.sock = sock
+        self.source = source
+        self.buf = bytearray(header)
+        self.eof = False
+        self.sent = 0
+        self.started = time()
+        self.last_progress = self.started
+        self.src_registered = False
+
+    @property
+    def done(self):
+        return self.eof and not self.buf
+
+
+class StreamEngine(object):
+    def __init__(self, stall_timeout=300):
+        """
+        Selector based I/O loop that serves file and pipe streams for connections detached from the http server's
+        worker threads. Concurrent streams are bounded by bandwidth and file descriptors rather than by threads.
+        :param stall_timeout: seconds a session may make no progress before it is dropped
+        """
+        self.stall_timeout = stall_timeout
+        self.selector = selectors.DefaultSelector()
+        self.sessions = set()
+        self.paced = {}  # session -> when its source may be read again
+        self.pending = Queue()
+        self.running = False
+        self.thread = None
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    def start(self):
+        self.running = True
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self.thread = Thread(target=self.run, daemon=True, name="streamer")
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake()
+        if self.thread:
+            self.thread.join()
+
+    def submit(self, session):
+        """
+        Hand a session to the I/O loop. Safe to call from any thread.
+        """
+        self.pending.put(session)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            pass  # a wakeup is already pending
+
+    def run(self):
+        last_sweep = time()
+        try:
+            while self.running:
+                timeout = 1
+                if self.paced:
+                    timeout = min(timeout, max(0, min(self.paced.values()) - time()))
+                for key, events in self.selector.select(timeout=timeout):
+                    if key.data is None:
+                        self._drain_wakeups()
+                        continue
+                    session, kind = key.data
+                    if session not in self.sessions:
+                        continue  # closed earlier in this batch
+                    try:
+                        if kind == "src":
+                            self._on_source_readable(session)
+                            continue
+                        if events & selectors.EVENT_READ and not self._on_client_readable(session):
+                            continue
+                        if events & selectors.EVENT_WRITE:
+                            self._on_client_writable(session)
+                    except OSError as e:
+                        logging.info("stream ended early: %s", e)
+                        self._close(session)
+                now = time()
+                for session, resume in list(self.paced.items()):
+                    if resume <= now:
+                        del self.paced[session]
+                        self._update_interest(session)
+                if now - last_sweep >= 1:
+                    self._sweep(now)
+                    last_sweep = now
+        finally:
+            for session in list(self.sessions):
+                self._close(session)
+            self.selector.close()
+
+    def _drain_wakeups(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                session = self.pending.get_nowait()
+            except Empty:
+                break
+            self._add(session)
+
+    def _add(self, session):
+        try:
+            session.source.open()
+        except OSError as e:
+            logging.error("could not open stream source: %s", e)
+            session.sock.close()
+            return
+        session.sock.setblocking(False)
+        session.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        self.sessions.add(session)
+        self.selector.register(session.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, (session, "sock"))
+        self._update_interest(session)
+
+    def _update_interest(self, session):
+        """
+        Pipe sources are read only while the output buffer is below the high water mark and the source's pace allows,
+        which backpressures the producer. The client socket is watched for writability only while there is something
+        to send.
+        """
+        if isinstance(session.source, PipeSource):
+            want_src = not session.eof and len(session.buf) < HIGH_WATER
+            if want_src and session not in self.paced:
+                wait = session.source.wait(time())
+                if wait:
+                    self.paced[session] = time() + wait
+            want_src = want_src and session not in self.paced
+            if want_src and not session.src_registered:
+                self.selector.register(session.source.fd, selectors.EVENT_READ, (session, "src"))
+                session.src_registered = True
+            elif not want_src and session.src_registered:
+                self.selector.unregister(session.source.fd)
+                session.src_registered = False
+            want_write = bool(session.buf)
+        else:
+            want_write = not session.done
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+        if self.selector.get_key(session.sock).events != events:
+            self.selector.modify(session.sock, events, (session, "sock"))
+
+    def _on_source_readable(self, session):
+        try:
+            data = session.source.read()
+        except BlockingIOError:
+            return
+        if data:
+            session.buf += data
+        else:
+            session.eof = True
+        if session.done:
+            self._close(session)
+        else:
+            self._update_interest(session)
+
+    def _on_client_readable(self, session):
+        """
+        We don't expect anything from the client once streaming starts; a readable socket that returns no data means
+        the client hung up.
+        :return: True if the session is still alive
+        """
+        try:
+            if session.sock.recv(4096):
+                return True
+        except BlockingIOError:
+            return True
+        self._close(session)
+        return False
+
+    def _on_client_writable(self, session):
+        if session.buf:
+            try:
+                sent = session.sock.send(session.buf)
+            except BlockingIOError:
+                return
+            del session.buf[:sent]
+            self._progress(session, sent)
+        elif not isinstance(session.source, PipeSource):
+            try:
+                sent = session.source.send(session.sock)
+            except BlockingIOError:
+                return
+            if sent == 0:
+                session.eof = True
+            self._progress(session, sent)
+        if session.done:
+            self._close(session)
+        else:
+            self._update_interest(session)
+
+    def _progress(self, session, nbytes):
+        if nbytes:
+            session.sent += nbytes
+            session.last_progress = time()
+
+    def _sweep(self, now):
+        for session in list(self.sessions):
+            if now - session.last_progress > self.stall_timeout:
+                logging.warning("dropping stalled stream after %ss", int(now - session.last_progress))
+                self._close(session)
+
+    def _close(self, session):
+        if session not in self.sessions:
+            return
+        self.sessions.discard(session)
+        self.paced.pop(session, None)
+        if session.src_registered:
+            self.selector.unregister(session.source.fd)
+        self.selector.unregister(session.sock)
+        try:
+            session.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        session.sock.close()
+        session.source.close()
+        logging.info("stream closed after sending %s bytes in %ss", session.sent, round(time() - session.started, 3))
+
+
+def send_stream(source, status="200 OK"):
+    """
+    Return a response body for `source`. The connection is detached to the StreamEngine when the server supports it,
+    otherwise the source is streamed from the current worker thread.
+    """
+    handoff = cherrypy.request.wsgi_environ.get(HANDOFF_KEY)
+    if not handoff:
+        cherrypy.response.status = status
+        if source.length is not None:
+            cherrypy.response.headers["Content-Length"] = str(source.length)
+        return source.iter_chunks()
+    # Headers as cherrypy would send them, which adds the session cookie
+    response = cherrypy.response
+    response.status = status
+    response.finalize()
+    handoff(response.status, [(key.decode("ISO-8859-1"), value.decode("ISO-8859-1"))
+                              for key, value in response.header_list], source)
+    return []
@@ -0,0 +1,396 @@
+import os
+import re
+import struct
+import logging
+from pysonic.types import MPX_TYPES, FLAC_TYPES, WAV_TYPES
+
+
+logging = logging.getLogger("tagreader")
+
+HEAD_SIZE = 64 * 1024  # read in one go from the start of a file, enough for the tags of most files
+FRAME_SEARCH = 8 * 1024  # how far past the tags an mp3's first frame may start before the file counts as unusual
+RE_NUMBERS = re.compile(r'^([0-9]+)')
+RE_YEAR = re.compile(r'([0-9]{4})')
+
+# ID3v2 frame id -> metadata key, for v2.3/v2.4 and v2.2 frame ids
+ID3_FRAMES = {"TIT2": "title", "TPE1": "artist", "TALB": "album", "TRCK": "track", "TDRC": "year", "TYER": "year",
+              "TCON": "genre",
+              "TT2": "title", "TP1": "artist", "TAL": "album", "TRK": "track", "TYE": "year", "TCO": "genre"}
+VORBIS_FIELDS = {"title": "title", "artist": "artist", "album": "album", "tracknumber": "track", "date": "year",
+                 "genre": "genre"}
+
+# MPEG audio: version bits -> (bitrates in kbps per layer, sample rates)
+MPEG_VERSIONS = {
+    3: ({1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+         2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+         3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]},
+        [44100, 48000, 32000]),  # MPEG 1
+    2: ({1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+         2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+         3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]},
+        [22050, 24000, 16000]),  # MPEG 2
+    0: ({1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+         2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+         3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]},
+        [11025, 12000, 8000]),  # MPEG 2.5
+}
+
+
+class Unusual(Exception):
+    """
+    The file is laid out in a way the fast reader doesn't handle, mutagen should read it
+    """
+    pass
+
+
+class HeadReader(object):
+    def __init__(self, fd, size):
+        """
+        Reads parts of a file with pread, serving them from one block read from the start of the file when they fall
+        inside it. Counts the reads made and bytes read, and remembers the ranges read.
+        """
+        self.fd = fd
+        self.size = size
+        self.reads = 0
+        self.bytes_read = 0
+        self.ranges = []  # (offset, length) of each pread
+        self.head = self.pread(0, HEAD_SIZE)
+
+    def pread(self, offset, length):
+        self.ranges.append((offset, length))
+        data = os.pread(self.fd, length, offset)
+        self.reads += 1
+        self.bytes_read += len(data)
+        return data
+
+    def read(self, offset, length):
+        if offset + length <= len(self.head):
+            return self.head[offset:offset + length]
+        data = self.pread(offset, length)
+        if len(data) < length:
+            raise Unusual("file ends early")
+        return data
+
+
+def read_tags(path, ftype):
+    """
+    Read the tags and stream information of a music file from only its head and tail
+    :return: dict of metadata with the keys PysonicFilesystemScanner.scan_mutagen_metadata() returns plus the number
+             of reads made and bytes read, or None if the file is unusual and should be read with mutagen
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    reader = None
+    try:
+        # only the parts asked for should be read, not the readahead after them
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+        reader = HeadReader(fd, os.fstat(fd).st_size)
+        if ftype in MPX_TYPES:
+            meta = read_mp3(reader)
+        elif ftype in FLAC_TYPES:
+            meta = read_flac(reader)
+        elif ftype in WAV_TYPES:
+            meta = read_wav(reader)
+        else:
+            return None
+    except (Unusual, OSError, struct.error, ValueError):
+        return None
+    finally:
+        if hasattr(os, "posix_fadvise"):
+            # a scan passes over each file once, it shouldn't push the pages of files being streamed out of the cache.
+            # Only what was read is dropped: the rest may be cached for someone streaming this very file.
+            for offset, length in reader.ranges if reader else [(0, HEAD_SIZE)]:
+                os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+    logging.debug("read %s bytes of %s", reader.bytes_read, path)
+    meta.update(format=ftype, reads=reader.reads, bytes_read=reader.bytes_read)
+    return meta
+
+
+def prefetch_head(path):
+    """
+    Ask the kernel to start reading the head of a file in the background, so it is cached by the time read_tags() gets
+    to it
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, HEAD_SIZE, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def decode_text(data):
+    """
+    Decode an ID3v2 text frame into its values
+    """
+    encoding = {0: "latin-1", 1: "utf-16", 2: "utf-16-be", 3: "utf-8"}.get(data[0])
+    if encoding is None:
+        raise Unusual("unknown text encoding")
+    return [value.strip("\ufeff") for value in data[1:].decode(encoding).split("\x00") if value]
+
+
+def read_id3v2(reader, offset=0):
+    """
+    Read the text frames of an ID3v2 tag at `offset` into {metadata key: list of values}
+    :return: tuple of the frames and the offset just past the tag, which is `offset` when there is no tag
+    """
+    header = reader.read(offset, 10)
+    if header[:3] != b"ID3":
+        return {}, offset
+    major, flags = header[3], header[5]
+    size = syncsafe(header[6:10])
+    end = offset + 10 + size + (10 if flags & 0x10 else 0)
+    if major not in (2, 3, 4) or flags & 0x80:  # unsynchronised tags are left to mutagen
+        raise Unusual("unsupported ID3v2 tag")
+    position = offset + 10
+    if flags & 0x40 and major == 3:
+        position += 4 + struct.unpack(">I", reader.read(position, 4))[0]
+    elif flags & 0x40 and major == 4:
+        position += syncsafe(reader.read(position, 4))
+
+    frames = {}
+    header_size = 6 if major == 2 else 10
+    while position + header_size <= offset + 10 + size:
+        frame = reader.read(position, header_size)
+        if frame[0] == 0:  # padding
+            break
+        if major == 2:
+            frame_id, frame_size, frame_flags = frame[:3], int.from_bytes(frame[3:6], "big"), 0
+        else:
+            frame_id = frame[:4]
+            frame_size = syncsafe(frame[4:8]) if major == 4 else struct.unpack(">I", frame[4:8])[0]
+            frame_flags = frame[9]
+        if not frame_id.isalnum() or not frame_id.isupper():
+            raise Unusual("bad ID3v2 frame")
+        position += header_size
+        key = ID3_FRAMES.get(frame_id.decode("ascii"))
+        if key and frame_size:
+            # compressed, encrypted, unsynchronised or length prefixed frames
+            if frame_flags & (0x0F if major == 4 else 0xC0):
+                raise Unusual("unsupported ID3v2 frame")
+            values = decode_text(reader.read(position, frame_size))
+            if values:
+                frames.setdefault(key, values)
+        position += frame_size
+    if "genre" in frames:
+        # numeric and "(17)Rock" style references to ID3v1 genres, translated the way mutagen does on load
+        from mutagen.id3 import TCON
+        frames["genre"] = TCON(encoding=3, text=frames["genre"]).genres
+        if not frames["genre"]:
+            del frames["genre"]
+    return frames, end
+
+
+def read_id3v1(reader):
+    """
+    Read an ID3v1 tag from the end of the file into {metadata key: list of values}, None if there is none
+    """
+    if reader.size < 128:
+        return None
+    tag = reader.read(reader.size - 128, 128)
+    if tag[:3] != b"TAG":
+        return None
+
+    def text(data):
+        return data.split(b"\x00")[0].strip().decode("latin-1")
+
+    frames = {key: [text(tag[start:start + length])]
+              for key, start, length in [("title", 3, 30), ("artist", 33, 30), ("album", 63, 30), ("year", 93, 4)]}
+    if tag[125] == 0 and tag[126]:
+        frames["track"] = [str(tag[126])]
+    from mutagen._constants import GENRES  # imported here like the rest of mutagen, see scan_mutagen_metadata()
+    if tag[127] < len(GENRES):
+        frames["genre"] = [GENRES[tag[127]]]
+    return {key: values for key, values in frames.items() if values[0]}
+
+
+def tag_meta(frames):
+    """
+    Turn {metadata key: list of values} into the metadata the scanner stores, the way the mutagen reader does
+    """
+    meta = {}
+    for key in ("title", "artist", "album"):
+        if key in frames:
+            meta[key] = "".join(frames[key])
+    if "track" in frames:
+        track = RE_NUMBERS.findall("".join(frames["track"]))
+        if track:
+            meta["track"] = int(track[0])
+    if "year" in frames:
+        year = RE_YEAR.findall(frames["year"][0])
+        if year:
+            meta["year"] = int(year[0])
+    if "genre" in frames:
+        meta["genre"] = frames["genre"][0]
+    return meta
+
+
+def read_mp3(reader):
+    frames, audio_start = read_id3v2(reader)
+    id3v1 = read_id3v1(reader)
+    for key, values in (id3v1 or {}).items():
+        frames.setdefault(key, values)
+    meta = tag_meta(frames)
+
+    data = reader.read(audio_start, min(FRAME_SEARCH, reader.size - audio_start))
+    for position in range(len(data) - 4):
+        if data[position] != 0xFF or data[position + 1] & 0xE0 != 0xE0:
+            continue
+        frame = parse_mpeg_header(data[position:position + 4])
+        if not frame:
+            continue
+        # a real frame is followed by another one where the first says it ends
+        following = data[position + frame["length"]:position + frame["length"] + 4]
+        if len(following) == 4 and not parse_mpeg_header(following):
+            continue
+        break
+    else:
+        raise Unusual("no mpeg frame found")
+
+    audio_size = reader.size - audio_start - position - (128 if id3v1 is not None else 0)
+    vbr_frames, vbr_bytes = read_vbr_header(data[position:], frame)
+    if vbr_frames:
+        meta["length"] = int(vbr_frames * frame["samples"] / frame["sample_rate"])
+        if meta["length"]:
+            meta["bitrate"] = int((vbr_bytes or audio_size) * 8 / (vbr_frames * frame["samples"] /
+                                                                   frame["sample_rate"]))
+    else:
+        meta["bitrate"] = frame["bitrate"]
+        meta["length"] = int(audio_size * 8 / frame["bitrate"])
+    return meta
+
+
+def parse_mpeg_header(header):
+    """
+    Return the properties of an MPEG audio frame header, None if the bytes aren't one
+    """
+    value = struct.unpack(">I", header)[0]
+    if value >> 21 != 0x7FF:
+        return None
+    version, layer = (value >> 19) & 3, 4 - ((value >> 17) & 3)
+    bitrate_index, rate_index, padding = (value >> 12) & 0xF, (value >> 10) & 3, (value >> 9) & 1
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrates, sample_rates = MPEG_VERSIONS[version]
+    bitrate, sample_rate = bitrates[layer][bitrate_index] * 1000, sample_rates[rate_index]
+    if layer == 1:
+        samples, length = 384, (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 3 and version != 3:
+        samples, length = 576, 72 * bitrate // sample_rate + padding
+    else:
+        samples, length = 1152, 144 * bitrate // sample_rate + padding
+    return dict(version=version, layer=layer, mono=(value >> 6) & 3 == 3, bitrate=bitrate, sample_rate=sample_rate,
+                samples=samples, length=length)
+
+
+def read_vbr_header(data, frame):
+    """
+    Return the (frame count, byte count) a Xing, Info or VBRI header in the first frame gives, None for either that
+    isn't known
+    """
+    if frame["version"] == 3:
+        offset = 4 + (17 if frame["mono"] else 32)
+    else:
+        offset = 4 + (9 if frame["mono"] else 17)
+    if data[offset:offset + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[offset + 4:offset + 8])[0]
+        position = offset + 8
+        frames = count = None
+        if flags & 1:
+            frames = struct.unpack(">I", data[position:position + 4])[0]
+            position += 4
+        if flags & 2:
+            # the count includes the frame holding this header, which isn't audio
+            count = max(0, struct.unpack(">I", data[position:position + 4])[0] - frame["length"])
+        return frames, count
+    if data[36:40] == b"VBRI":
+        count, frames = struct.unpack(">II", data[46:54])
+        return frames, count
+    return None, None
+
+
+def read_flac(reader):
+    _, offset = read_id3v2(reader)  # some taggers put ID3 in front of flac files
+    if reader.read(offset, 4) != b"fLaC":
+        raise Unusual("not a flac stream")
+    position = offset + 4
+    meta = {}
+    sample_rate = samples = None
+    while True:
+        block = reader.read(position, 4)
+        last, block_type, length = block[0] & 0x80, block[0] & 0x7F, int.from_bytes(block[1:4], "big")
+        position += 4
+        if block_type == 0:  # STREAMINFO
+            info = reader.read(position, 34)
+            sample_rate = (info[10] << 12) | (info[11] << 4) | (info[12] >> 4)
+            samples = ((info[13] & 0xF) << 32) | struct.unpack(">I", info[14:18])[0]
+        elif block_type == 4:  # VORBIS_COMMENT
+            meta = tag_meta(read_vorbis_comment(reader.read(position, length)))
+        elif block_type == 127:
+            raise Unusual("invalid flac metadata block")
+        position += length
+        if last:
+            break
+    if not sample_rate:
+        raise Unusual("no flac stream info")
+    if samples:
+        length = samples / sample_rate
+        meta["length"] = int(length)
+        meta["bitrate"] = int((reader.size - position) * 8 / length)
+    return meta
+
+
+def read_vorbis_comment(data):
+    """
+    Read a vorbis comment block into {metadata key: list of values}
+    """
+    vendor_length = struct.unpack("<I", data[:4])[0]
+    position = 4 + vendor_length
+    count = struct.unpack("<I", data[position:position + 4])[0]
+    position += 4
+    frames = {}
+    for _ in range(count):
+        length = struct.unpack("<I", data[position:position + 4])[0]
+        comment = data[position + 4:position + 4 + length].decode("utf-8", "replace")
+        position += 4 + length
+        name, _, value = comment.partition("=")
+        key = VORBIS_FIELDS.get(name.lower())
+        if key and value:
+            frames.setdefault(key, []).append(value)
+    return frames
+
+
+def read_wav(reader):
+    header = reader.read(0, 12)
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise Unusual("not a wave file")
+    position = 12
+    byte_rate = data_size = None
+    frames = {}
+    while position + 8 <= reader.size:
+        chunk_id, chunk_size = struct.unpack("<4sI", reader.read(position, 8))
+        if chunk_id == b"fmt ":
+            byte_rate = struct.unpack("<I", reader.read(position + 16, 4))[0]
+        elif chunk_id == b"data":
+            data_size = chunk_size
+        elif chunk_id.lower() == b"id3 ":
+            frames, _ = read_id3v2(reader, position + 8)
+        position += 8 + chunk_size + (chunk_size & 1)
+    if not byte_rate or data_size is None:
+        raise Unusual("no wave format or data chunk")
+    meta = tag_meta(frames)
+    meta["length"] = int(data_size / byte_rate)
+    meta["bitrate"] = byte_rate * 8
+    return meta
@@ -0,0 +1,529 @@
+import os
+import logging
+import subprocess
+from time import time
+from threading import Thread, Lock, Condition, Event
+from collections import OrderedDict, defaultdict
+from pysonic.database import NotFoundError
+from pysonic.streaming import PipeSource, SharedOutput, SharedSource
+
+
+logging = logging.getLogger("transcode")
+
+
+class TranscodeProfile(object):
+    def __init__(self, name, codec, container, mimetype, suffix, bitrates, quality=None, args=()):
+        """
+        An output format for transcoding
+        :param name: value of the subsonic format parameter that selects this profile
+        :param codec: ffmpeg audio encoder
+        :param container: ffmpeg output format
+        :param bitrates: bitrate ladder in kbps; requests are rounded down to a step
+        :param quality: for vbr encoders, {ladder step: ffmpeg -q:a value}
+        :param args: extra encoder arguments
+        """
+        self.name = name
+        self.codec = codec
+        self.container = container
+        self.mimetype = mimetype
+        self.suffix = suffix
+        self.bitrates = sorted(bitrates)
+        self.quality = quality
+        self.args = list(args)
+
+    def pick_bitrate(self, kbps):
+        """
+        Return the highest step of the bitrate ladder not above `kbps`
+        """
+        steps = [step for step in self.bitrates if step <= kbps]
+        return steps[-1] if steps else self.bitrates[0]
+
+    def encoder_args(self, bitrate):
+        if self.quality:
+            return ["-c:a", self.codec, "-q:a", str(self.quality[bitrate])] + self.args
+        return ["-c:a", self.codec, "-b:a", "{}k".format(bitrate)] + self.args
+
+
+# LAME's vbr presets and the average bitrate each produces
+MP3_VBR_QUALITY = {245: 0, 225: 1, 190: 2, 175: 3, 165: 4, 130: 5, 115: 6, 100: 7, 85: 8, 65: 9}
+
+PROFILES = {profile.name: profile for profile in [
+    TranscodeProfile("mp3", "libmp3lame", "mp3", "audio/mpeg", "mp3", [32, 48, 64, 96, 128, 160, 192, 256, 320]),
+    TranscodeProfile("mp3vbr", "libmp3lame", "mp3", "audio/mpeg", "mp3", MP3_VBR_QUALITY.keys(),
+                     quality=MP3_VBR_QUALITY),
+    TranscodeProfile("opus", "libopus", "ogg", "audio/ogg", "opus", [24, 32, 48, 64, 96, 128, 160, 192, 256],
+                     args=["-vbr", "on"]),
+    TranscodeProfile("aac", "aac", "adts", "audio/aac", "aac", [48, 64, 96, 128, 160, 192, 256, 320]),
+]}
+RAW_FORMAT = "raw"  # subsonic's name for sending the original file
+PACE_BURST = 30  # seconds of audio transcoded for a stream as fast as possible before pacing applies
+SEGMENT_TIMEOUT = 120  # seconds an HLS segment may take to transcode before ffmpeg is killed
+
+
+def pick_transcode(song, max_bitrate, options, profile):
+    """
+    Decide how to send a song to a client accepting up to `max_bitrate` kbps. Returns the bitrate to send at and the
+    profile to transcode with, or None if the file should be sent as-is.
+    :param song: entry from PysonicLibrary.get_song()
+    :param profile: requested TranscodeProfile, None for the original file
+    """
+    media_bitrate = song["bitrate"] / 1024 if song.get("bitrate") else 320
+    if profile is None:
+        return int(media_bitrate), None
+    to_bitrate = min(max_bitrate, options.max_bitrate, media_bitrate)
+    if song["format"] == profile.mimetype == "audio/mpeg" and \
+            (options.skip_transcode or (song.get("bitrate") and media_bitrate == to_bitrate)):
+        return int(to_bitrate), None
+    return profile.pick_bitrate(to_bitrate), profile
+
+
+def transcode_args(fpath, bitrate, output="-", profile=PROFILES["mp3"]):
+    return ["ffmpeg", "-i", fpath, "-map", "0:0"] + profile.encoder_args(bitrate) + \
+        ["-v", "0", "-f", profile.container, output]
+
+
+def segment_args(fpath, bitrate, start, duration, output):
+    """
+    ffmpeg arguments to transcode `duration` seconds of a file from `start` into an MPEG-TS segment. Timestamps are
+    offset by `start` so consecutive segments play back as one stream.
+    """
+    return ["ffmpeg", "-ss", str(start), "-t", str(duration), "-i", fpath, "-map", "0:0", "-c:a", "libmp3lame",
+            "-b:a", "{}k".format(bitrate), "-output_ts_offset", str(start), "-v", "0", "-f", "mpegts", "-y", output]
+
+
+class PysonicTranscodeStore(object):
+    def __init__(self, path, max_bytes, clean=True):
+        """
+        Directory of finished transcodes named by song id, bitrate and kind: the transcode profile's name for whole
+        songs, or the name of an HLS segment. Least recently used files are deleted once the store holds more than
+        `max_bytes`. Several processes may share a store; files added by the others are picked up when looked for.
+        :param clean: delete partial transcodes left behind by an earlier run. Pass False while other processes may be
+                      transcoding into the store.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.files = OrderedDict()  # file name -> size, least recently used first
+        self.size = 0
+        os.makedirs(path, exist_ok=True)
+        for entry in sorted(os.scandir(path), key=lambda entry: entry.stat().st_mtime):
+            if entry.name.endswith(".part"):
+                if clean:
+                    os.unlink(entry.path)  # left behind by an interrupted transcode
+            else:
+                self.files[entry.name] = entry.stat().st_size
+                self.size += self.files[entry.name]
+        self._trim()
+
+    @staticmethod
+    def filename(song_id, bitrate, kind="mp3"):
+        return "{}-{}.{}".format(song_id, bitrate, kind)
+
+    def get(self, song_id, bitrate, kind="mp3"):
+        """
+        Return the path of a stored transcode, or None
+        """
+        name = self.filename(song_id, bitrate, kind)
+        path = os.path.join(self.path, name)
+        try:
+            size = os.path.getsize(path)  # other processes sharing the store add and delete files too
+        except FileNotFoundError:
+            with self.lock:
+                self.size -= self.files.pop(name, 0)
+            return None
+        with self.lock:
+            if name in self.files:
+                self.files.move_to_end(name)
+            else:
+                self.size += size
+                self.files[name] = size
+                self._trim()
+        return path
+
+    def temp_path(self, song_id, bitrate, kind="mp3"):
+        """
+        Return a unique path to transcode into before the result is added with add()
+        """
+        return os.path.join(self.path, "{}.{}.part".format(self.filename(song_id, bitrate, kind), os.urandom(4).hex()))
+
+    def add(self, song_id, bitrate, temp_path, kind="mp3"):
+        """
+        Move a finished transcode into the store. Returns its path.
+        """
+        name = self.filename(song_id, bitrate, kind)
+        path = os.path.join(self.path, name)
+        size = os.path.getsize(temp_path)
+        os.rename(temp_path, path)
+        with self.lock:
+            self.size += size - self.files.pop(name, 0)
+            self.files[name] = size
+            self._trim()
+        return path
+
+    def _trim(self):
+        while self.size > self.max_bytes and len(self.files) > 1:
+            name, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+
+class SharedTranscode(object):
+    def __init__(self, key, proc, output):
+        self.key = key
+        self.proc = proc
+        self.output = output
+        self.readers = 0
+        self.started = time()
+
+
+class SharedSegment(object):
+    def __init__(self):
+        self.done = Event()
+        self.failed = False
+
+
+class PysonicTranscodeBroker(object):
+    def __init__(self, store, pace=None, burst=0, stall_timeout=None):
+        """
+        Single-flight transcoding for streams: requests for a song in the same format and bitrate as a transcode still
+        in progress attach to it instead of starting another ffmpeg. Each transcode's output goes to a SharedOutput
+        that every stream reads from the start and then follows; a thread per transcode copies ffmpeg's output into it.
+        The transcoder is killed once its last stream ends, and a completed transcode is added to the store. HLS
+        segments are transcoded once in the same way, see segment().
+        :param pace: multiple of real time to transcode at once `burst` seconds of audio are done, no limit if None
+        :param stall_timeout: seconds ffmpeg may produce nothing before it is killed
+        """
+        self.store = store
+        self.pace = pace
+        self.burst = burst
+        self.stall_timeout = stall_timeout
+        self.lock = Lock()
+        self.transcodes = {}  # (song id, bitrate, profile name) -> SharedTranscode
+        self.segments = {}  # (song id, bitrate, segment name) -> SharedSegment being transcoded
+
+    def stream(self, song_id, fpath, bitrate, profile):
+        """
+        Return a SharedSource streaming the song, transcoded with `profile` at `bitrate` kbps
+        """
+        key = (song_id, bitrate, profile.name)
+        with self.lock:
+            transcode = self.transcodes.get(key)
+            if transcode is None:
+                args = transcode_args(fpath, bitrate, profile=profile)
+                logging.info(' '.join(args))
+                proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+                output = SharedOutput(self.store.temp_path(song_id, bitrate, profile.name))
+                transcode = self.transcodes[key] = SharedTranscode(key, proc, output)
+                Thread(target=self.pump, args=(transcode, bitrate), daemon=True,
+                       name="transcode-{}".format(song_id)).start()
+            else:
+                logging.info("joining transcode of song %s as %s at %sk", song_id, profile.name, bitrate)
+            transcode.readers += 1
+            return SharedSource(transcode.output, on_close=lambda source: self.detach(transcode),
+                                stall_timeout=self.stall_timeout)
+
+    def segment(self, song_id, fpath, bitrate, index, start, duration, timeout=SEGMENT_TIMEOUT):
+        """
+        Return a file descriptor of HLS segment `index`, `duration` seconds long from `start`, or None if it couldn't be
+        transcoded. Segments come from the store when they're there; otherwise requests for the same segment wait on a
+        single ffmpeg run. The file is opened before it's handed to the store, so trimming the store can't delete it
+        from under the caller.
+        """
+        kind = "{:05d}.ts".format(index)
+        key = (song_id, bitrate, kind)
+        while True:
+            fd = self.open_stored(song_id, bitrate, kind)
+            if fd is not None:
+                return fd
+            with self.lock:
+                segment = self.segments.get(key)
+                if segment is None:
+                    segment = self.segments[key] = SharedSegment()
+                    break
+            segment.done.wait()
+            if segment.failed:
+                return None
+        try:
+            fd = self.transcode_segment(song_id, fpath, bitrate, kind, start, duration, timeout)
+            segment.failed = fd is None
+            return fd
+        finally:
+            with self.lock:
+                del self.segments[key]
+            segment.done.set()
+
+    def open_stored(self, song_id, bitrate, kind):
+        path = self.store.get(song_id, bitrate, kind)
+        if path:
+            try:
+                return os.open(path, os.O_RDONLY)
+            except FileNotFoundError:  # trimmed since
+                pass
+        return None
+
+    def transcode_segment(self, song_id, fpath, bitrate, kind, start, duration, timeout):
+        temp_path = self.store.temp_path(song_id, bitrate, kind)
+        started = time()
+        try:
+            proc = subprocess.run(segment_args(fpath, bitrate, start, duration, temp_path), stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+            failure = proc.returncode and "code {}".format(proc.returncode)
+        except subprocess.TimeoutExpired:
+            failure = "timeout after {}s".format(timeout)
+        if not failure:
+            try:
+                fd = os.open(temp_path, os.O_RDONLY)
+            except FileNotFoundError:
+                failure = "no output"
+        if failure:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            logging.error("segment %s of %s failed with %s", kind, song_id, failure)
+            return None
+        self.store.add(song_id, bitrate, temp_path, kind)
+        logging.info("transcoded segment %s of %s in %ss", kind, song_id, round(time() - started, 3))
+        return fd
+
+    def detach(self, transcode):
+        with self.lock:
+            transcode.readers -= 1
+            if transcode.readers:
+                return
+            if self.transcodes.get(transcode.key) is transcode:
+                del self.transcodes[transcode.key]
+            if transcode.proc.poll() is None:
+                # every listener went away or skipped ahead, nobody will hear the rest
+                transcode.proc.kill()
+            if transcode.output.done:
+                transcode.output.close()
+
+    def pump(self, transcode, bitrate):
+        """
+        Copy a transcoder's output into its SharedOutput, paced like a stream of its own
+        """
+        bytes_per_second = bitrate * 1000 / 8
+        source = PipeSource(transcode.proc, rate=bytes_per_second * self.pace if self.pace else None,
+                            burst=bytes_per_second * self.burst, stall_timeout=self.stall_timeout)
+        song_id, bitrate, kind = transcode.key
+        saved = False
+        try:
+            for data in source.iter_chunks():
+                transcode.output.append(data)
+            transcode.proc.wait()
+            duration = round(time() - transcode.started, 3)
+            if transcode.proc.returncode == 0:
+                logging.warning("transcoded song %s as %s at %sk in %ss", song_id, kind, bitrate, duration)
+                self.store.add(song_id, bitrate, transcode.output.save(), kind)
+                saved = True
+            elif transcode.proc.returncode < 0:
+                logging.info("stopped transcode of song %s after %ss, its streams ended", song_id, duration)
+            else:
+                logging.error("transcode of song %s exited with code %s after %ss", song_id,
+                              transcode.proc.returncode, duration)
+        except Exception:
+            # such as running out of space for the spill file; listeners get what was transcoded until then
+            logging.exception("transcode of song %s as %s at %sk failed", song_id, kind, bitrate)
+            source.close()
+        finally:
+            if not saved and os.path.exists(transcode.output.spill_path):
+                os.unlink(transcode.output.spill_path)  # readers keep reading through the open file
+            with self.lock:
+                if self.transcodes.get(transcode.key) is transcode:
+                    del self.transcodes[transcode.key]
+                transcode.output.finish()
+                if not transcode.readers:
+                    transcode.output.close()
+
+
+class PrefetchJob(object):
+    def __init__(self, username, song_id, bitrate, profile, fpath):
+        self.username = username
+        self.song_id = song_id
+        self.bitrate = bitrate
+        self.profile = profile
+        self.fpath = fpath
+        self.proc = None
+        self.cancelled = False
+        self.done = False
+
+
+class PysonicPrefetcher(object):
+    def __init__(self, library, store, writer, auth, options, depth=2, workers=1, cpu_budget=0.5, window=60):
+        """
+        Transcodes the tracks a user is likely to play next into the transcode store, in the format and at the bitrate
+        of their last stream, so that starting the next track is served from disk instead of waiting on ffmpeg.
+        Upcoming tracks come from the user's saved play queue, or from the last playlist they fetched if the track
+        being streamed is on it. Prefetch transcoders run at the lowest cpu priority, and new ones are held back while
+        prefetching has used more than `cpu_budget` cores averaged over `window` seconds. Starting a track that wasn't
+        predicted cancels the user's outstanding prefetches.
+        :param depth: number of upcoming tracks to prefetch
+        :param workers: number of concurrent prefetch transcoders
+        :param cpu_budget: cpu cores prefetching may use on average
+        """
+        self.library = library
+        self.store = store
+        self.writer = writer
+        self.auth = auth
+        self.options = options
+        self.depth = depth
+        self.workers = workers
+        self.cpu_budget = cpu_budget
+        self.window = window
+        self.credit = cpu_budget * window  # cpu seconds prefetching may spend right now
+        self.credit_updated = time()
+        self.cond = Condition()
+        self.queue = []
+        self.user_jobs = defaultdict(list)  # username -> queued and running jobs
+        self.playlists = {}  # username -> song ids of the playlist they fetched last
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = Thread(target=self.run, daemon=True, name="prefetch-{}".format(i))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            for jobs in self.user_jobs.values():
+                for job in jobs:
+                    self._cancel(job)
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def saw_playlist(self, username, song_ids):
+        self.playlists[username] = song_ids
+
+    def predict(self, username, song_id):
+        """
+        Return the ids of the songs expected to be played after `song_id`
+        """
+        sources = []
+        try:
+            queue = self.writer.get_play_queue(self.auth.get_user(username)["id"])
+            if queue:
+                sources.append(queue["songs"])
+        except NotFoundError:
+            pass
+        sources.append(self.playlists.get(username, []))
+        for songs in sources:
+            if song_id in songs:
+                position = songs.index(song_id) + 1
+                return songs[position:position + self.depth]
+        return []
+
+    def played(self, username, song_id, max_bitrate, profile):
+        """
+        Called when a user starts streaming a song. Queues transcodes of the songs predicted to follow it with the
+        profile and bitrate the client asked for, and cancels prefetches that no longer match.
+        """
+        wanted = []
+        for next_id in self.predict(username, song_id) if profile else []:
+            try:
+                song = self.library.get_song(next_id)
+            except (NotFoundError, OSError):
+                continue
+            bitrate, next_profile = pick_transcode(song, max_bitrate, self.options, profile)
+            if next_profile and not self.store.get(next_id, bitrate, next_profile.name):
+                wanted.append((next_id, bitrate, next_profile, song["_fullpath"]))
+
+        with self.cond:
+            if not self.running:
+                return
+            jobs = []
+            for job in self.user_jobs[username]:
+                if (job.song_id, job.bitrate, job.profile, job.fpath) in wanted:
+                    wanted.remove((job.song_id, job.bitrate, job.profile, job.fpath))
+                    jobs.append(job)
+                else:
+                    self._cancel(job)
+            for next_id, bitrate, next_profile, fpath in wanted:
+                job = PrefetchJob(username, next_id, bitrate, next_profile, fpath)
+                jobs.append(job)
+                self.queue.append(job)
+            self.user_jobs[username] = jobs
+            self.cond.notify_all()
+
+    def _cancel(self, job):
+        # Must hold self.cond
+        job.cancelled = True
+        if job.proc and not job.done:
+            job.proc.kill()
+        if job in self.queue:
+            self.queue.remove(job)
+
+    def _refill(self):
+        now = time()
+        self.credit = min(self.cpu_budget * self.window,
+                          self.credit + (now - self.credit_updated) * self.cpu_budget)
+        self.credit_updated = now
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                # Wait for the cpu budget to allow another transcode
+                self._refill()
+                while self.running and self.credit <= 0:
+                    self.cond.wait(min(-self.credit / self.cpu_budget, 5))
+                    self._refill()
+                if not self.running:
+                    return
+                if not self.queue:
+                    continue
+                job = self.queue.pop(0)
+            try:
+                self.transcode(job)
+            except Exception:
+                logging.exception("prefetch of song %s failed", job.song_id)
+            finally:
+                with self.cond:
+                    if job in self.user_jobs[job.username]:
+                        self.user_jobs[job.username].remove(job)
+
+    def transcode(self, job):
+        kind = job.profile.name
+        if self.store.get(job.song_id, job.bitrate, kind):
+            return
+        start = time()
+        temp_path = self.store.temp_path(job.song_id, job.bitrate, kind)
+        with self.cond:
+            if job.cancelled:
+                return
+            job.proc = subprocess.Popen(transcode_args(job.fpath, job.bitrate, temp_path, job.profile),
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            os.setpriority(os.PRIO_PROCESS, job.proc.pid, 19)
+        except OSError:
+            pass  # already exited
+
+        # Reap the process ourselves to learn how much cpu it used
+        _, status, usage = os.wait4(job.proc.pid, 0)
+        with self.cond:
+            job.done = True
+            job.proc.returncode = os.waitstatus_to_exitcode(status)
+            self.credit -= usage.ru_utime + usage.ru_stime
+
+        produced = os.path.exists(temp_path)
+        if job.proc.returncode == 0 and produced and not job.cancelled:
+            self.store.add(job.song_id, job.bitrate, temp_path, kind)
+            logging.info("prefetched song %s as %s at %sk in %ss", job.song_id, kind, job.bitrate,
+                         round(time() - start, 3))
+            return
+        if produced:
+            os.unlink(temp_path)
+        if job.cancelled:
+            return
+        if job.proc.returncode == 0:
+            logging.warning("prefetch transcoder for song %s exited without writing %s", job.song_id, temp_path)
+        else:
+            logging.warning("prefetch transcoder for song %s exited with %s", job.song_id, job.proc.returncode)
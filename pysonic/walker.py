@@ -0,0 +1,90 @@
+import os
+import logging
+from queue import Queue
+from threading import Thread, BoundedSemaphore, Event
+
+
+logging = logging.getLogger("walker")
+
+ROOT_WALKERS = 4  # directories of one library root listed at once
+DEVICE_WALKERS = 8  # directories of one device listed at once, across all roots on it
+
+
+class PysonicWalker(object):
+    def __init__(self, roots, root_walkers=ROOT_WALKERS, device_walkers=DEVICE_WALKERS):
+        """
+        Walks several directory trees at once with a pool of threads listing directories with os.scandir, so walking a
+        slow disk or network mount is bound by how many listings it serves at once rather than by the round trip time of
+        each. Each device gets a queue of directories to list and its own threads; how many directories of a single
+        root are listed at once is capped by `root_walkers`.
+        :param roots: paths of the trees to walk
+        """
+        self.roots = roots
+        self.root_walkers = max(1, root_walkers)
+        self.device_walkers = max(1, device_walkers)
+
+    def walk(self):
+        """
+        Yield (root, path, dirnames, filenames) for every directory of every root, like os.walk does for one, in the
+        order their listings finish. Symlinked directories are listed among dirnames but not descended into, and
+        directories that can't be listed are skipped.
+        """
+        results = Queue()
+        stop = Event()
+        devices = {}  # st_dev -> queue of (root, path)
+        limits = {}
+        pending = 0
+        for root in self.roots:
+            try:
+                device = os.stat(root).st_dev
+            except OSError as e:
+                logging.error("can't walk %s: %s", root, e)
+                continue
+            if device not in devices:
+                devices[device] = Queue()
+            limits[root] = BoundedSemaphore(self.root_walkers)
+            devices[device].put((root, root))
+            pending += 1
+
+        for device, queue in devices.items():
+            for number in range(self.device_walkers):
+                Thread(target=self._list_dirs, args=(queue, limits, results, stop), daemon=True,
+                       name="walker-{}-{}".format(device, number)).start()
+        try:
+            while pending:
+                root, path, dirs, files, queued = results.get()
+                # subdirs were queued before the listing was handed over, so the count never drops to 0 early
+                pending += queued - 1
+                if dirs is not None:
+                    yield root, path, dirs, files
+        finally:
+            stop.set()
+            for queue in devices.values():
+                for _ in range(self.device_walkers):
+                    queue.put(None)
+
+    def _list_dirs(self, queue, limits, results, stop):
+        while True:
+            item = queue.get()
+            if item is None or stop.is_set():
+                return
+            root, path = item
+            dirs = []
+            files = []
+            descend = []
+            try:
+                with limits[root], os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            dirs.append(entry.name)
+                            if not entry.is_symlink():
+                                descend.append(entry.path)
+                        else:
+                            files.append(entry.name)
+            except OSError as e:
+                logging.warning("can't list %s: %s", path, e)
+                results.put((root, path, None, None, 0))
+                continue
+            for subdir in descend:
+                queue.put((root, subdir))
+            results.put((root, path, dirs, files, len(descend)))
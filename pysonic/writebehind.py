@@ -0,0 +1,183 @@
+import logging
+from time import time
+from threading import Thread, Lock, Event
+from collections import defaultdict
+
+
+logging = logging.getLogger("writebehind")
+
+
+class PysonicWriteBehind(object):
+    def __init__(self, db, interval=30, max_pending=500, on_write=None, bus=None):
+        """
+        Buffers play activity - scrobbles, saved play queues and now playing state - in memory and writes it to the
+        database in batched transactions. Repeated events coalesce: many plays of a song become one update and only the
+        latest play queue per user is written. Batches are flushed every `interval` seconds, when `max_pending` events
+        have accumulated, and on stop(). When other server processes share the database, play queues are written
+        through instead so every process serves the latest one, and now playing state is published to the others.
+        :param db: PysonicDatabase
+        :param interval: seconds between flushes
+        :param max_pending: number of buffered events that triggers an early flush
+        :param on_write: called with the ids of songs whose plays were written
+        :param bus: PysonicChangeBus, set when other processes share the database. Pass its "nowplaying" changes to
+                    apply_change().
+        """
+        self.db = db
+        self.on_write = on_write
+        self.bus = bus
+        self.interval = interval
+        self.max_pending = max_pending
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.running = False
+        self.thread = None
+
+        self.song_plays = defaultdict(int)
+        self.song_played = {}
+        self.play_queues = {}
+        self.flushing_queues = {}  # queues being written by flush(), still served to readers
+        self.pending = 0
+
+        # Kept in memory only
+        self.now_playing = {}
+        self.queue_current = {}
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True, name="writebehind")
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the flusher thread and write anything still buffered
+        """
+        self.running = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("failed to write play activity")
+
+    def _added(self):
+        self.pending += 1
+        if self.pending >= self.max_pending:
+            self.wakeup.set()
+
+    def scrobble(self, username, song_id, when=None, submission=True, client=None):
+        """
+        Record a scrobble. Submissions count as a play, otherwise the song is marked as now playing.
+        :param when: unix timestamp the song was played at
+        """
+        when = int(when or time())
+        with self.lock:
+            if submission:
+                self.song_plays[song_id] += 1
+                self.song_played[song_id] = max(self.song_played.get(song_id, 0), when)
+                self._added()
+            else:
+                self.now_playing[username] = dict(song_id=song_id, started=when, client=client)
+        if not submission:
+            self._publish_now_playing(username, song_id, when, client)
+
+    def save_play_queue(self, user_id, username, song_ids, current=None, position=None, client=None):
+        """
+        Record a user's play queue. When the current song changes it is marked as now playing and last played.
+        """
+        now = int(time())
+        queue = (song_ids, current, position, now, client)
+        with self.lock:
+            started = current is not None and self.queue_current.get(user_id) != current
+            if started:
+                self.queue_current[user_id] = current
+                self.song_played[current] = now
+                self.now_playing[username] = dict(song_id=current, started=now, client=client)
+            if not self.bus:
+                self.play_queues[user_id] = queue
+            if started or not self.bus:
+                self._added()
+        if self.bus:
+            # another process may serve this user's next getPlayQueue
+            self.db.apply_play_activity({}, {}, {user_id: queue})
+            if started:
+                self._publish_now_playing(username, current, now, client)
+
+    def _publish_now_playing(self, username, song_id, started, client):
+        if self.bus:
+            self.bus.publish("nowplaying", [username, song_id, started, client])
+
+    def apply_change(self, kind, items):
+        """
+        Take now playing state published by another process sharing the database
+        """
+        if kind != "nowplaying":
+            return
+        username, song_id, started, client = items
+        with self.lock:
+            if started >= self.now_playing.get(username, {}).get("started", 0):
+                self.now_playing[username] = dict(song_id=song_id, started=started, client=client)
+
+    def get_play_queue(self, user_id):
+        """
+        Return the user's play queue as a dict, preferring one that hasn't been written yet
+        """
+        with self.lock:
+            queue = self.play_queues.get(user_id) or self.flushing_queues.get(user_id)
+        if queue is None:
+            return self.db.get_play_queue(user_id)
+        songs, current, position, changed, changedby = queue
+        return dict(userid=user_id, songs=songs, current=current, position=position, changed=changed,
+                    changedby=changedby)
+
+    def get_now_playing(self, max_age=3600):
+        """
+        Return {username: now playing info} for songs started in the last `max_age` seconds
+        """
+        cutoff = time() - max_age
+        with self.lock:
+            return {username: dict(info) for username, info in self.now_playing.items() if info["started"] > cutoff}
+
+    def flush(self):
+        """
+        Write buffered activity in one transaction
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            song_plays, self.song_plays = self.song_plays, defaultdict(int)
+            song_played, self.song_played = self.song_played, {}
+            play_queues, self.play_queues = self.play_queues, {}
+            pending, self.pending = self.pending, 0
+            self.flushing_queues = play_queues
+        start = time()
+        try:
+            self.db.apply_play_activity(song_plays, song_played, play_queues)
+        except Exception:
+            self._requeue(song_plays, song_played, play_queues, pending)
+            raise
+        finally:
+            with self.lock:
+                self.flushing_queues = {}
+        logging.info("wrote %s play events in %ss", pending, round(time() - start, 3))
+        if self.on_write and (song_plays or song_played):
+            self.on_write(list(set(song_plays) | set(song_played)))
+
+    def _requeue(self, song_plays, song_played, play_queues, pending):
+        """
+        Merge a batch that failed to write back into the buffers so the next flush retries it
+        """
+        with self.lock:
+            for song_id, count in song_plays.items():
+                self.song_plays[song_id] += count
+            for song_id, played in song_played.items():
+                self.song_played[song_id] = max(self.song_played.get(song_id, 0), played)
+            for user_id, queue in play_queues.items():
+                self.play_queues.setdefault(user_id, queue)
+            self.pending += pending
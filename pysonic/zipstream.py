@@ -0,0 +1,218 @@
+import os
+import zlib
+import struct
+from time import localtime
+from pysonic.streaming import CHUNK_SIZE
+
+
+ZIP64_LIMIT = 0xFFFFFFFF
+UTF8_NAMES = 0x0800  # general purpose flag bit 11, names are utf-8
+DATA_DESCRIPTOR = 0x0008  # general purpose flag bit 3, crc32 and sizes follow the file's contents
+
+
+def dos_time(mtime):
+    """
+    Return the (time, date) pair a zip header stores a modification time as
+    """
+    t = localtime(max(mtime, 315532800))  # dos dates start in 1980
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipEntry(object):
+    def __init__(self, name, path, size, mtime, crc32=None):
+        """
+        A file to store in a zip stream
+        :param name: path of the file inside the archive
+        :param path: path of the file on disk
+        :param crc32: checksum of the file's contents, or None to compute it while the file is sent
+        """
+        self.name = name.encode("utf-8")
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.crc32 = crc32
+
+
+class LatePart(object):
+    """
+    Bytes of the archive that depend on checksums computed while sending it, built once they're reached
+    """
+    def __init__(self, size, render):
+        self.size = size
+        self.render = render
+
+
+class ZipSource(object):
+    """
+    Stream an uncompressed zip archive of files on disk. Only the zip headers are built in memory; file contents are
+    sent with sendfile() by the StreamEngine, one file open at a time. As nothing is compressed the archive's length
+    is known before the first byte is sent. Archives over 4GB are written as zip64.
+
+    Files whose crc32 isn't known yet are written with a data descriptor: their checksum is computed from the page
+    cache as each chunk is sent and written after the contents and in the central directory, so nothing has to be read
+    before the response starts.
+    """
+    def __init__(self, entries, chunk_size=CHUNK_SIZE, on_checksums=None):
+        """
+        :param entries: list of ZipEntry
+        :param on_checksums: called with the entries whose crc32 was computed, once all their contents have been sent
+        """
+        self.chunk_size = chunk_size
+        self.on_checksums = on_checksums
+        self.computed = [entry for entry in entries if entry.crc32 is None]
+        # size of the archive without zip64 records: local and central headers, names, contents and the end record
+        plain_size = sum(30 + 46 + 2 * len(entry.name) + entry.size for entry in entries) + \
+            16 * len(self.computed) + 22
+        self.zip64 = plain_size > ZIP64_LIMIT or len(entries) > 0xFFFF
+        self.parts = self.build(entries)
+        self.length = sum(len(part) if type(part) is bytes else part.size for part in self.parts)
+        self.index = 0  # part being sent
+        self.offset = 0  # position within it
+        self.fd = None
+        self.crc = 0  # of the part being sent so far, when it's a file being checksummed
+
+    def build(self, entries):
+        """
+        Lay out the archive as a list of header bytes, the ZipEntry objects whose contents go between them and
+        LateParts for the data descriptors and central directory
+        """
+        parts = []
+        offsets = []
+        offset = 0
+        version = 45 if self.zip64 else 20
+        for entry in entries:
+            time, date = dos_time(entry.mtime)
+            if entry.crc32 is None:
+                # crc and sizes are left out of the local header, they follow in the data descriptor
+                flags, crc, size = UTF8_NAMES | DATA_DESCRIPTOR, 0, 0
+            else:
+                flags, crc, size = UTF8_NAMES, entry.crc32, entry.size
+            if self.zip64:
+                sizes = (ZIP64_LIMIT, ZIP64_LIMIT)
+                extra = struct.pack("<HHQQ", 1, 16, size, size)
+            else:
+                sizes = (size, size)
+                extra = b""
+            header = struct.pack("<IHHHHHI", 0x04034b50, version, flags, 0, time, date, crc) + \
+                struct.pack("<IIHH", *sizes, len(entry.name), len(extra)) + entry.name + extra
+            parts += [header, entry]
+            offsets.append(offset)
+            offset += len(header) + entry.size
+            if entry.crc32 is None:
+                descriptor = LatePart(24 if self.zip64 else 16, lambda entry=entry: self.descriptor(entry))
+                parts.append(descriptor)
+                offset += descriptor.size
+
+        central_size = sum(46 + len(entry.name) + (28 if self.zip64 else 0) for entry in entries)
+        end_size = 22 + (56 + 20 if self.zip64 else 0)
+        parts.append(LatePart(central_size + end_size, lambda: self.central(entries, offsets, offset)))
+        return parts
+
+    def descriptor(self, entry):
+        if self.zip64:
+            return struct.pack("<IIQQ", 0x08074b50, entry.crc32, entry.size, entry.size)
+        return struct.pack("<IIII", 0x08074b50, entry.crc32, entry.size, entry.size)
+
+    def central(self, entries, offsets, offset):
+        """
+        Return the central directory and end records, once every entry's crc32 is known
+        """
+        if self.on_checksums and self.computed:
+            self.on_checksums(self.computed)
+        version = 45 if self.zip64 else 20
+        computed = set(self.computed)
+        central = []
+        for entry, entry_offset in zip(entries, offsets):
+            time, date = dos_time(entry.mtime)
+            flags = UTF8_NAMES | (DATA_DESCRIPTOR if entry in computed else 0)
+            if self.zip64:
+                sizes = (ZIP64_LIMIT, ZIP64_LIMIT)
+                central_extra = struct.pack("<HHQQQ", 1, 24, entry.size, entry.size, entry_offset)
+            else:
+                sizes = (entry.size, entry.size)
+                central_extra = b""
+            central.append(struct.pack("<IHHHHHHI", 0x02014b50, version, version, flags, 0, time, date,
+                                       entry.crc32) +
+                           struct.pack("<IIHHHHHII", *sizes, len(entry.name), len(central_extra), 0, 0, 0,
+                                       0o100644 << 16, ZIP64_LIMIT if self.zip64 else entry_offset) +
+                           entry.name + central_extra)
+
+        central = b"".join(central)
+        if self.zip64:
+            end = struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, len(entries), len(entries), len(central),
+                              offset) + \
+                struct.pack("<IIQI", 0x07064b50, 0, offset + len(central), 1) + \
+                struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, ZIP64_LIMIT, ZIP64_LIMIT, 0)
+        else:
+            end = struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, len(entries), len(entries), len(central), offset, 0)
+        return central + end
+
+    def open(self):
+        pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def send(self, sock):
+        """
+        Send the next chunk to a non-blocking socket. Returns the number of bytes sent, 0 once the archive is done.
+        """
+        while self.index < len(self.parts):
+            part = self.parts[self.index]
+            if type(part) is LatePart:
+                part = self.parts[self.index] = part.render()
+            if type(part) is bytes:
+                remaining = len(part) - self.offset
+            else:
+                remaining = part.size - self.offset
+            if remaining == 0:
+                if type(part) is ZipEntry and part.crc32 is None:
+                    part.crc32 = self.crc
+                    self.crc = 0
+                self.close()
+                self.index += 1
+                self.offset = 0
+                continue
+            if type(part) is bytes:
+                sent = sock.send(part[self.offset:self.offset + self.chunk_size])
+            else:
+                if self.fd is None:
+                    self.fd = os.open(part.path, os.O_RDONLY)
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                sent = os.sendfile(sock.fileno(), self.fd, self.offset, min(self.chunk_size, remaining))
+                if sent == 0:
+                    raise OSError("{} shrank while being sent".format(part.path))
+                if part.crc32 is None:
+                    # the chunk was just read into the page cache by sendfile
+                    self.crc = zlib.crc32(os.pread(self.fd, sent, self.offset), self.crc)
+            self.offset += sent
+            return sent
+        return 0
+
+    def iter_chunks(self):
+        """
+        Fallback used when the connection can't be detached; streams from the worker thread.
+        """
+        for part in self.parts:
+            if type(part) is LatePart:
+                part = part.render()
+            if type(part) is bytes:
+                yield part
+                continue
+            crc = 0
+            with open(part.path, "rb") as f:
+                remaining = part.size
+                while remaining > 0:
+                    data = f.read(min(self.chunk_size, remaining))
+                    if not data:
+                        raise OSError("{} shrank while being sent".format(part.path))
+                    remaining -= len(data)
+                    if part.crc32 is None:
+                        crc = zlib.crc32(data, crc)
+                    yield data
+            if part.crc32 is None:
+                part.crc32 = crc
@@ -10,4 +10,4 @@ setup(name='pysonic',
       author='dpedu',
       author_email='dave@davepedu.com',
       packages=['pysonic'],
-      entry_points={'console_scripts': ['pysonicd=pysonic.daemon:main']})
+      entry_points={'console_scripts': ['pysonicd=pysonic.daemon:main', 'pysonic-backup=pysonic.backup:main']})